@@ -61,7 +61,8 @@ class VideoConferenceClient:
         self.root.destroy()
 
 
-# 创建 Tkinter 主窗口
-root = tk.Tk()
-app = VideoConferenceClient(root)
-root.mainloop()
+if __name__ == '__main__':
+    # 创建 Tkinter 主窗口
+    root = tk.Tk()
+    app = VideoConferenceClient(root)
+    root.mainloop()
@@ -1,12 +1,26 @@
 # client.py
 import cv2
+import random
 import socket
-import struct
 import time
 import numpy as np
 import sounddevice as sd
 import threading
 
+import audio_codec
+from audio_codec import PAYLOAD_IMA_ADPCM
+from config import FEC_AUDIO_GROUP, FEC_VIDEO_GROUP
+from fec import FecDecoder, FecEncoder
+from nack import NackGenerator, PacketHistory
+from jitter_buffer import JitterMixer
+from rate_control import RateController, ReceiverFeedback
+from rtcp import RtcpSession
+from rtp import (CONTROL_FEEDBACK, CONTROL_NACK, FLAG_DTX, FLAG_FEC, FLAG_RTX, MEDIA_HEADER, STREAM_AUDIO,
+                 STREAM_CAMERA, STREAM_CONTROL, STREAM_RTCP, FrameAssembler, MediaStream, packetize_jpeg, parse_header,
+                 video_timestamp)
+from util import FrameEncoderPool
+from vad import DtxSender
+
 # 服务器IP和端口
 SERVER_IP = '127.0.0.1'  # 根据实际情况修改
 VIDEO_SEND_PORT = 5004
@@ -15,12 +29,32 @@ AUDIO_SEND_PORT = 5005
 AUDIO_RECV_PORT = 5007
 
 VIDEO_PAYLOAD_TYPE = 26  # JPEG
-AUDIO_PAYLOAD_TYPE = 10  # L16 mono 44100
+AUDIO_PAYLOAD_TYPE = PAYLOAD_IMA_ADPCM  # 4 bit/样本，约为原始L16的1/3.4
 
 AUDIO_RATE = 16000  # 采样率
 AUDIO_CHANNELS = 1  # 单声道
 AUDIO_CHUNK = 2048  # 每个音频块的帧数
 
+CONFERENCE_ID = 0
+PARTICIPANT_SSRC = random.getrandbits(32)  # 本客户端的参与者ID，音视频共用
+
+# 接收线程收到别人对我们视频的反馈，发送线程按它调整质量、分辨率和帧率
+rate_controller = RateController()
+
+# 发送线程记下最近发出的视频包，接收线程收到NACK时从这里重传
+video_history = PacketHistory()
+
+# 音视频走不同的转发端口，各自一份RTCP统计
+video_rtcp = RtcpSession(CONFERENCE_ID, PARTICIPANT_SSRC)
+audio_rtcp = RtcpSession(CONFERENCE_ID, PARTICIPANT_SSRC, clock_rates={STREAM_AUDIO: AUDIO_RATE})
+
+
+def rtcp_stats():
+    """
+    :return: dict, RTCP statistics of the video and audio streams, see rtcp.RtcpSession.stats
+    """
+    return {'video': video_rtcp.stats(), 'audio': audio_rtcp.stats()}
+
 
 def send_video(video_send_socket):
     cap = cv2.VideoCapture(0)
@@ -29,41 +63,50 @@ def send_video(video_send_socket):
         print("[视频发送] 无法打开摄像头")
         return
 
-    sequence_number = 0  # RTP序列号
-    ssrc = 12345  # 随机选择一个SSRC
+    # 头部里固定的字段只设置一次，序列号由stream自己递增
+    stream = MediaStream(STREAM_CAMERA, VIDEO_PAYLOAD_TYPE, CONFERENCE_ID, PARTICIPANT_SSRC)
+    # 每FEC_VIDEO_GROUP个包加一个异或校验包，丢一个包不用等重传
+    fec = FecEncoder(stream, FEC_VIDEO_GROUP)
+    # 编码放到编码线程里，采集线程发出上一帧后就去读下一帧，两者重叠
+    encoder = FrameEncoderPool(workers=1)
+    pending = None  # (Future, timestamp, width, height, quality) of the frame being encoded
+
+    def send_encoded(future, timestamp, width, height, quality):
+        buffer = future.result()
+        # 按MTU切分成多个包，最后一个包带marker标志
+        packets = packetize_jpeg(buffer, stream, timestamp, width, height, quality)
+        for packet in packets:
+            for out in fec.protect(packet):
+                video_send_socket.sendto(out, (SERVER_IP, VIDEO_SEND_PORT))
+            video_history.put_packet(packet)
+            video_rtcp.on_sent(stream, timestamp, len(packet))
+        rate_controller.on_frame_sent(len(buffer))
 
     while True:
         ret, frame = cap.read()
         if not ret:
             print("[视频发送] 无法读取摄像头帧")
             break
+        # 当前帧率下不该发的帧直接丢掉，不排队
+        if not rate_controller.should_send():
+            continue
 
-        # 压缩帧以减少数据量
-        encoded, buffer = cv2.imencode('.jpg', frame, [int(cv2.IMWRITE_JPEG_QUALITY), 50])
-        jpeg_bytes = buffer.tobytes()
-
-        # 封装RTP包
-        version = 2
-        padding = 0
-        extension = 0
-        csrc_count = 0
-        marker = 0
-        payload_type = VIDEO_PAYLOAD_TYPE  # JPEG
-        timestamp = int(time.time())  # 简单的时间戳
-
-        rtp_header = struct.pack('!BBHII',
-                                 (version << 6) | (padding << 5) | (extension << 4) | csrc_count,
-                                 (marker << 7) | payload_type,
-                                 sequence_number,
-                                 timestamp,
-                                 ssrc)
-
-        rtp_packet = rtp_header + jpeg_bytes
-        video_send_socket.sendto(rtp_packet, (SERVER_IP, VIDEO_SEND_PORT))
-        # print(f"[视频发送] 序列号={sequence_number}, 大小={len(rtp_packet)} 字节")
-        sequence_number = (sequence_number + 1) % 65536
+        # 压缩帧以减少数据量，质量和分辨率由码率控制决定
+        frame = rate_controller.prepare(frame)
+        quality = rate_controller.quality
+        height, width = frame.shape[:2]
+        encoding = (encoder.submit(frame, quality), video_timestamp(), width, height, quality)
+        if pending is not None:
+            send_encoded(*pending)
+        pending = encoding
+        report = video_rtcp.report()
+        if report is not None:
+            video_send_socket.sendto(report, (SERVER_IP, VIDEO_SEND_PORT))
         if cv2.waitKey(1) & 0xFF == ord('q'):
             break
+    if pending is not None:
+        send_encoded(*pending)  # 最后一帧还在编码线程里，发出去再停
+    encoder.shutdown()
     cap.release()
     video_send_socket.close()
 
@@ -71,6 +114,10 @@ def send_video(video_send_socket):
 def receive_video(video_recv_socket):
     # 设置接收超时
     video_recv_socket.settimeout(5)
+    assembler = FrameAssembler()
+    feedback = ReceiverFeedback(CONFERENCE_ID, PARTICIPANT_SSRC)
+    fec = FecDecoder()
+    nack = NackGenerator(CONFERENCE_ID, PARTICIPANT_SSRC)
 
     while True:
         try:
@@ -78,19 +125,43 @@ def receive_video(video_recv_socket):
             data, _ = video_recv_socket.recvfrom(65535)
             if not data:
                 continue
-            # 解析RTP头部（前12字节）
-            if len(data) < 12:
-                print("[视频接收] 数据包长度不足12字节，无法解析RTP头部")
+            header = parse_header(data)
+            if header is None:
                 continue
-            rtp_header = data[:12]
-            payload = data[12:]  # 提取负载部分
-
-            # Debug: 打印负载长度
-            print(f"[视频接收] 接收到的负载长度: {len(payload)} 字节")
-
-            if len(payload) == 0:
-                print("[视频接收] 接收到的负载为空")
+            if header.stream_type == STREAM_CONTROL:
+                # 别的接收端对我们视频的反馈
+                if header.payload_type == CONTROL_FEEDBACK:
+                    rate_controller.on_feedback(memoryview(data)[MEDIA_HEADER.size:])
+                elif header.payload_type == CONTROL_NACK:
+                    # 中继缓存里也没有的包，由我们自己重传
+                    for packet in video_history.answer(data):
+                        video_recv_socket.sendto(packet, (SERVER_IP, VIDEO_SEND_PORT))
+                continue
+            if header.stream_type == STREAM_RTCP:
+                video_rtcp.on_report(data)
                 continue
+            # 校验包只用来恢复丢掉的包，统计和反馈只看真正收到的媒体包
+            # 重传包来得晚，也不算进去
+            packets = fec.push(data)
+            if not header.flags & (FLAG_FEC | FLAG_RTX):
+                video_rtcp.on_media(header)
+                # 统计丢包、抖动和延迟趋势，定期反馈给发送者
+                for packet in feedback.on_packet(header, len(data)):
+                    video_recv_socket.sendto(packet, (SERVER_IP, VIDEO_SEND_PORT))
+            if not header.flags & FLAG_FEC:
+                packets.append(data)
+            # 序列号有缺口就发NACK，中继或者发送者在这一帧的播放期限内重传
+            for packet in packets:
+                nack.on_packet(parse_header(packet))
+            for packet in nack.poll():
+                video_recv_socket.sendto(packet, (SERVER_IP, VIDEO_SEND_PORT))
+            # 按时间戳重组分片，帧不完整时继续等待
+            completed = None
+            for packet in packets:
+                completed = assembler.push(packet) or completed
+            if completed is None:
+                continue
+            ssrc, timestamp, payload = completed
 
             # 解码JPEG图像
             nparr = np.frombuffer(payload, dtype=np.uint8)
@@ -115,39 +186,28 @@ def receive_video(video_recv_socket):
 def send_audio(audio_send_socket):
     # 打开音频流
     def callback(indata, frames, time_info, status):
-        nonlocal sequence_number, timestamp
+        nonlocal timestamp
         if status:
             print(f"[音频发送] 状态: {status}")
-        # 将音频数据转换为bytes
-        audio_bytes = indata.tobytes()
-
-        version = 2
-        padding = 0
-        extension = 0
-        csrc_count = 0
-        marker = 0
-        payload_type = AUDIO_PAYLOAD_TYPE  # L16 mono
         timestamp += frames
 
-        rtp_header = struct.pack('!BBHII',
-                                 (version << 6) | (padding << 5) | (extension << 4) | csrc_count,
-                                 (marker << 7) | payload_type,
-                                 sequence_number,
-                                 timestamp,
-                                 ssrc)
-
-        rtp_packet = rtp_header + audio_bytes
-
-        # 发送RTP包
-        audio_send_socket.sendto(rtp_packet, (SERVER_IP, AUDIO_SEND_PORT))
-
-        print(f"[音频发送] 序列号={sequence_number}, 大小={len(rtp_packet)} 字节")
-
-        # 更新序列号
-        sequence_number = (sequence_number + 1) % 65536
-
-    sequence_number = 0
-    ssrc = 67890  # 随机选择一个SSRC
+        # 说话时发编码后的音频，静音时只发静音描述和偶尔的保活包
+        packet = dtx.packet(indata, timestamp)
+        if packet is None:
+            return
+        if packet[0] & 0x0F != STREAM_AUDIO:
+            audio_send_socket.sendto(packet, (SERVER_IP, AUDIO_SEND_PORT))  # 保活包
+            return
+        for out in fec.protect(packet):
+            audio_send_socket.sendto(out, (SERVER_IP, AUDIO_SEND_PORT))
+        audio_rtcp.on_sent(stream, timestamp, len(packet))
+        report = audio_rtcp.report()
+        if report is not None:
+            audio_send_socket.sendto(report, (SERVER_IP, AUDIO_SEND_PORT))
+
+    stream = MediaStream(STREAM_AUDIO, AUDIO_PAYLOAD_TYPE, CONFERENCE_ID, PARTICIPANT_SSRC)
+    dtx = DtxSender(stream, AUDIO_RATE, AUDIO_CHANNELS)
+    fec = FecEncoder(stream, FEC_AUDIO_GROUP)
     timestamp = 0
 
     with sd.InputStream(samplerate=AUDIO_RATE, channels=AUDIO_CHANNELS,
@@ -168,20 +228,37 @@ def receive_audio(audio_recv_socket):
     # 设置接收超时
     audio_recv_socket.settimeout(5)
 
+    # 每个发言者(SSRC)一个按序列号排序的抖动缓冲区，回调里把各自的下一帧混在一起写进outdata
+    mixer = JitterMixer(AUDIO_CHUNK, AUDIO_CHANNELS, AUDIO_RATE)
+    fec = FecDecoder()
+
+    def buffer_packet(packet, header):
+        jitter_buffer = mixer.buffer(header.ssrc)
+        payload = memoryview(packet)[MEDIA_HEADER.size:]  # 提取负载部分
+        if header.flags & FLAG_DTX:
+            # 对方不说话了，之后由抖动缓冲区放舒适噪声
+            if len(payload):
+                jitter_buffer.push_silence(header.sequence_number, header.timestamp, payload[0])
+            return
+
+        if len(payload) == 0:
+            print("[音频接收] 接收到的负载为空")
+            return
+
+        # 按头部里的负载类型解码，放进抖动缓冲区对应的位置
+        try:
+            samples = audio_codec.decode(payload, header.payload_type, AUDIO_CHANNELS)
+        except Exception as e:
+            print(f"[音频接收] 解码失败: {e}")
+            return
+        jitter_buffer.push(header.sequence_number, header.timestamp, samples)
+
     # 打开音频播放流
     def callback(outdata, frames, time_info, status):
-        nonlocal audio_buffer
         if status:
             print(f"[音频接收] 状态: {status}")
-        # 填充输出缓冲区
-        if len(audio_buffer) >= frames * AUDIO_CHANNELS * 2:  # 16-bit PCM
-            out_chunk = audio_buffer[:frames * AUDIO_CHANNELS * 2]
-            audio_buffer = audio_buffer[frames * AUDIO_CHANNELS * 2:]
-            outdata[:] = np.frombuffer(out_chunk, dtype=np.int16).reshape(-1, AUDIO_CHANNELS)
-        else:
-            outdata[:] = np.zeros((frames, AUDIO_CHANNELS), dtype=np.int16)
-
-    audio_buffer = bytearray()
+        # 填充输出缓冲区，离开的发言者在这里被清掉
+        mixer.pop_into(outdata)
 
     with sd.OutputStream(samplerate=AUDIO_RATE, channels=AUDIO_CHANNELS,
                          callback=callback, blocksize=AUDIO_CHUNK,
@@ -193,22 +270,20 @@ def receive_audio(audio_recv_socket):
                 data, _ = audio_recv_socket.recvfrom(65535)
                 if not data:
                     continue
-                # 解析RTP头部（前12字节）
-                if len(data) < 12:
-                    print("[音频接收] 数据包长度不足12字节，无法解析RTP头部")
+                # 解析媒体包头部
+                header = parse_header(data)
+                if header is None:
+                    print("[音频接收] 无法解析媒体包头部")
                     continue
-                rtp_header = data[:12]
-                payload = data[12:]  # 提取负载部分
-
-                # Debug: 打印负载长度
-                print(f"[音频接收] 接收到的负载长度: {len(payload)} 字节")
-
-                if len(payload) == 0:
-                    print("[音频接收] 接收到的负载为空")
+                if header.stream_type == STREAM_RTCP:
+                    audio_rtcp.on_report(data)
                     continue
-
-                # 将音频数据添加到缓冲区
-                audio_buffer.extend(payload)
+                # 校验包恢复出来的帧也按序列号放进抖动缓冲区，没赶上播放时间的算迟到
+                for packet in fec.push(data):
+                    buffer_packet(packet, parse_header(packet))
+                if not header.flags & FLAG_FEC:
+                    audio_rtcp.on_media(header)
+                    buffer_packet(data, header)
             except socket.timeout:
                 continue
             except Exception as e:
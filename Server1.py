@@ -1,65 +1,43 @@
 # server.py
-import socket
-import threading
+import asyncio
+
+from config import MIX_AUDIO, RELAY_METRICS_PORT
+from metrics import MetricsRegistry, try_serve_metrics, watch_loop_lag
+from udp_relay import start_relay
 
 # 配置服务器
 SERVER_IP = '0.0.0.0'
 VIDEO_PORT = 5004
 AUDIO_PORT = 5005
-
-# 创建UDP套接字
-video_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-audio_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-
-video_socket.bind((SERVER_IP, VIDEO_PORT))
-audio_socket.bind((SERVER_IP, AUDIO_PORT))
-
-print(f"服务器已启动，监听视频端口 {SERVER_IP}:{VIDEO_PORT} 和音频端口 {SERVER_IP}:{AUDIO_PORT}")
-
-
-def handle_video():
-    while True:
-        try:
-            data, client_address = video_socket.recvfrom(65535)
-            if not data:
-                continue
-            print(f"[视频] 收到来自 {client_address} 的数据包，大小：{len(data)} 字节")
-
-            video_recv_port = 5006
-            video_socket.sendto(data, (client_address[0], video_recv_port))
-        except Exception as e:
-            print(f"[视频] 发生错误: {e}")
-            break
-
-
-def handle_audio():
-    while True:
-        try:
-            data, client_address = audio_socket.recvfrom(65535)
-            if not data:
-                continue
-            print(f"[音频] 收到来自 {client_address} 的数据包，大小：{len(data)} 字节")
-            # 回传到客户端的接收音频端口（5007）
-            audio_recv_port = 5007
-            audio_socket.sendto(data, (client_address[0], audio_recv_port))
-        except Exception as e:
-            print(f"[音频] 发生错误: {e}")
-            break
-
-
-# 启动线程处理视频和音频
-video_thread = threading.Thread(target=handle_video, daemon=True)
-audio_thread = threading.Thread(target=handle_audio, daemon=True)
-
-video_thread.start()
-audio_thread.start()
-
-# 保持主线程运行
-try:
-    while True:
-        pass
-except KeyboardInterrupt:
-    print("服务器关闭")
-finally:
-    video_socket.close()
-    audio_socket.close()
+VIDEO_RECV_PORT = 5006  # 客户端接收视频的端口
+AUDIO_RECV_PORT = 5007  # 客户端接收音频的端口
+AUDIO_RATE = 16000  # 客户端的音频采样率，混音模式按它确定每一拍的时长
+
+
+async def main():
+    metrics = MetricsRegistry()
+    # 视频和音频各一个UDP中继，转发到客户端的接收端口，不再每个包打印一行
+    video_transport, _ = await start_relay(SERVER_IP, VIDEO_PORT, recv_port=VIDEO_RECV_PORT, echo=True,
+                                           metrics=metrics, name='video')
+    # MIX_AUDIO打开时音频在服务器上混好，每个客户端只收到一路
+    audio_transport, _ = await start_relay(SERVER_IP, AUDIO_PORT, recv_port=AUDIO_RECV_PORT, echo=True,
+                                           mix_audio=MIX_AUDIO, audio_rate=AUDIO_RATE, metrics=metrics, name='audio')
+    # 转发量、延迟等指标用Prometheus格式从本机端口抓取，端口被占用时只是没有指标，服务器照常运行
+    metrics_server = await try_serve_metrics(metrics.collect, port=RELAY_METRICS_PORT)
+    lag_task = asyncio.create_task(watch_loop_lag(metrics))
+    print(f"服务器已启动，监听视频端口 {SERVER_IP}:{VIDEO_PORT} 和音频端口 {SERVER_IP}:{AUDIO_PORT}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        lag_task.cancel()
+        if metrics_server is not None:
+            metrics_server.close()
+        video_transport.close()
+        audio_transport.close()
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        print("服务器关闭")
@@ -7,6 +7,16 @@ import tkinter as tk
 from io import BytesIO
 import numpy as np
 
+from config import FEC_VIDEO_GROUP
+from fec import FecDecoder, FecEncoder
+from nack import NackGenerator, PacketHistory
+from rtp import (CONTROL_NACK, FLAG_FEC, STREAM_CAMERA, STREAM_CONTROL, FrameAssembler, MediaStream, packetize_jpeg,
+                 parse_header, video_timestamp)
+from render import VideoRenderer
+from util import FrameDecoderPool, encode_frame
+
+VIDEO_PAYLOAD_TYPE = 26  # JPEG
+
 
 class VideoConferenceClientUDP:
     def __init__(self, server_ip, server_port, root):
@@ -46,6 +56,18 @@ class VideoConferenceClientUDP:
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.sock.connect((self.server_ip,self.server_port))
         self.is_running = True
+        self.video_stream = MediaStream(STREAM_CAMERA, VIDEO_PAYLOAD_TYPE)
+        self.assembler = FrameAssembler()
+        # 发送端每组包后面加一个异或校验包，接收端丢了一个包可以直接算回来
+        self.fec_encoder = FecEncoder(self.video_stream, FEC_VIDEO_GROUP)
+        self.fec_decoder = FecDecoder()
+        # 丢了的包发NACK要重传；自己发出的包留一段时间，中继没有缓存时由我们重传
+        self.history = PacketHistory()
+        self.nack = NackGenerator(0, self.video_stream.ssrc)
+        # 收包线程只负责收包和拼帧，解码在线程池里做，Tk主线程定时把每个人最新的一帧画出来
+        self.decoder = FrameDecoderPool()
+        self.renderer = VideoRenderer(self.root, self.decoder.frames, lambda ssrc: self.remote_video_label)
+        self.renderer.start()
 
         self.receive_thread = threading.Thread(target=self.receive_and_display, daemon=True)
         self.receive_thread.start()
@@ -65,34 +87,30 @@ class VideoConferenceClientUDP:
             if self.cap:
                 self.cap.release()
                 self.cap = None
-            self.local_video_label.config(image='')
+            self.renderer.clear(self.local_video_label)
 
     def update_video(self):
         if self.is_camera_on and self.cap:
             ret, frame = self.cap.read()
             if ret:
                 frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-                image = Image.fromarray(frame_rgb).convert('RGB')
-                image_tk = ImageTk.PhotoImage(image)
-                self.local_video_label.config(image=image_tk)
-                self.local_video_label.image = image_tk
+                image = Image.fromarray(frame_rgb)
+                self.renderer.show(self.local_video_label, image)
 
-                # 压缩图像并发送
-                buffer = BytesIO()
-                image.save(buffer, format="JPEG")
-                jpeg_data = buffer.getvalue()
-                self.send_video(jpeg_data)
+                # 直接压缩BGR帧并发送
+                jpeg_data = encode_frame(frame, 75)
+                self.send_video(jpeg_data, image.width, image.height)
 
             self.root.after(10, self.update_video)
 
-    def send_video(self, jpeg_data):
-        """使用UDP发送视频帧"""
+    def send_video(self, jpeg_data, width=0, height=0):
+        """使用UDP发送视频帧，按MTU切分成多个包，不再受单个数据报大小限制"""
         try:
-            frame_length = len(jpeg_data)
-            if frame_length > 65507:  # UDP数据包大小限制
-                print("[警告] 单帧数据过大，可能无法发送")
-                return
-            self.sock.sendto(jpeg_data, (self.server_ip, self.server_port))
+            packets = packetize_jpeg(jpeg_data, self.video_stream, video_timestamp(), width, height)
+            for packet in packets:
+                for out in self.fec_encoder.protect(packet):
+                    self.sock.send(out)
+                self.history.put_packet(packet)
         except Exception as e:
             print(f"[错误] 发送视频数据失败: {e}")
             self.is_running = False
@@ -101,22 +119,34 @@ class VideoConferenceClientUDP:
         try:
             while self.is_running:
                 # 接收数据
-                frame_data, addr = self.sock.recvfrom(65536)  # 接收最大数据包
+                packet, addr = self.sock.recvfrom(65536)  # 接收最大数据包
 
-                if not frame_data:
+                if not packet:
                     print("[警告] 接收到的数据为空")
                     continue
-
-                try:
-                    # 尝试解码为图像
-                    buffer = BytesIO(frame_data)
-                    img = Image.open(buffer)
-                    imgtk = ImageTk.PhotoImage(image=img)
-                    self.remote_video_label.config(image=imgtk)
-                    self.remote_video_label.image = imgtk
-                except Exception as e:
-                    print(f"[错误] 解码图像失败: {e}")
+                header = parse_header(packet)
+                if header is None:
+                    continue
+                if header.stream_type == STREAM_CONTROL:
+                    if header.payload_type == CONTROL_NACK:
+                        for retransmission in self.history.answer(packet):
+                            self.sock.send(retransmission)
                     continue
+                # 校验包本身不是视频数据，只用它恢复出来的包
+                media_packets = self.fec_decoder.push(packet)
+                if not header.flags & FLAG_FEC:
+                    media_packets.append(packet)
+                completed = None
+                for media_packet in media_packets:
+                    self.nack.on_packet(parse_header(media_packet))
+                    completed = self.assembler.push(media_packet) or completed
+                for nack in self.nack.poll():
+                    self.sock.send(nack)
+                if completed is None:
+                    continue  # 帧还没收齐
+                ssrc, timestamp, frame_data = completed
+                # 每个发送者只保留最新的一帧，解码跟不上时旧帧直接丢掉，不会越积越多
+                self.decoder.submit(ssrc, frame_data)
         except Exception as e:
             print(f"[错误] 接收和显示线程出错: {e}")
             self.is_running = False
@@ -124,6 +154,8 @@ class VideoConferenceClientUDP:
     def on_closing(self):
         print("[关闭] 关闭客户端。")
         self.is_running = False
+        self.renderer.stop()
+        self.decoder.shutdown()
         if self.cap:
             self.cap.release()
         self.sock.close()
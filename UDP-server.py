@@ -1,5 +1,10 @@
-import socket
-import threading
+import asyncio
+
+from config import UDP_METRICS_PORT
+from metrics import MetricsRegistry, try_serve_metrics, watch_loop_lag
+from udp_relay import start_relay
+
+AUDIO_RATE = 16000  # mix_test 的音频采样率，RTCP 的抖动统计按它换算时间戳
 
 """
 这是测试用的server，以udp传送音频和视频，但是文本还是用tcp比价好
@@ -8,42 +13,36 @@ class VideoConferenceServerUDP:
     def __init__(self, server_ip, server_port):
         self.server_ip = server_ip
         self.server_port = server_port
-
-        self.clients = set()
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.sock.bind((self.server_ip, self.server_port))
-
+        self.transport = None
+        self.relay = None
+        self.metrics = MetricsRegistry()
+
+    async def serve(self):
+        # 按包里的参与者ID转发，同一轮事件循环里的发送集中在一起发出
+        self.transport, self.relay = await start_relay(self.server_ip, self.server_port, echo=True,
+                                                       audio_rate=AUDIO_RATE, metrics=self.metrics)
+        # 指标在本机的UDP_METRICS_PORT上用Prometheus格式提供，端口被占用时只是没有指标
+        metrics_server = await try_serve_metrics(self.metrics.collect, port=UDP_METRICS_PORT)
+        lag_task = asyncio.create_task(watch_loop_lag(self.metrics))
         print(f"[启动] 服务器正在 {self.server_ip}:{self.server_port} 上运行...")
+        try:
+            await asyncio.Event().wait()
+        finally:
+            lag_task.cancel()
+            if metrics_server is not None:
+                metrics_server.close()
+            self.transport.close()
 
     def start(self):
-        threading.Thread(target=self.receive_data, daemon=True).start()
-
-    def receive_data(self):
-        """接收客户端发送的视频帧"""
-        while True:
-            try:
-                frame_data, client_address = self.sock.recvfrom(65536)
-
-                if client_address not in self.clients:
-                    self.clients.add(client_address)
-                    print(f"[连接] 新客户端已加入: {client_address}")
-
-                self.broadcast(frame_data, client_address)
-            except Exception as e:
-                print(f"[错误] 接收数据失败: {e}")
-
-    def broadcast(self, data, source_address):
-        for client in list(self.clients):
-            # if client != source_address:
-            try:
-                self.sock.sendto(data, client)
-            except Exception as e:
-                print(f"[错误] 向 {client} 转发数据失败: {e}")
-                self.clients.remove(client)
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            self.stop()
 
     def stop(self):
         print("[关闭] 服务器已关闭。")
-        self.sock.close()
+        if self.transport is not None:
+            self.transport.close()
 
 
 if __name__ == "__main__":
@@ -51,9 +50,3 @@ if __name__ == "__main__":
     SERVER_PORT = 8888
     server = VideoConferenceServerUDP(SERVER_IP, SERVER_PORT)
     server.start()
-
-    try:
-        while True:
-            pass  # 保持主线程运行
-    except KeyboardInterrupt:
-        server.stop()
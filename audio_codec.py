@@ -0,0 +1,183 @@
+'''
+Audio codecs for the UDP audio streams, selected by the payload type of the media header
+    PAYLOAD_PCMU       0   G.711 mu-law, 8 bits per sample (2:1)
+    PAYLOAD_PCMA       8   G.711 A-law, 8 bits per sample (2:1)
+    PAYLOAD_L16       10   raw 16-bit PCM in host byte order, what the clients used to send
+    PAYLOAD_IMA_ADPCM 96   blocked IMA-ADPCM, 4 bits per sample + a 3-byte header per 33 samples (~3.4:1)
+G.711 is a table lookup in both directions. IMA-ADPCM is sequential within a block, so a frame is split into
+independent blocks (DVI4-style header: first sample + step index, RFC 3551 4.5.1) and the encoder/decoder loop runs
+over the sample position while numpy works on all blocks at once
+'''
+import struct
+
+import numpy as np
+
+PAYLOAD_PCMU = 0
+PAYLOAD_PCMA = 8
+PAYLOAD_L16 = 10
+PAYLOAD_IMA_ADPCM = 96
+
+ADPCM_BLOCK = 33  # samples per block: one in the header, 32 as nibbles
+ADPCM_BLOCK_HEADER = struct.Struct('!hB')  # first sample, step index
+ADPCM_FRAME_HEADER = struct.Struct('!H')  # samples per channel
+ADPCM_BLOCK_BYTES = ADPCM_BLOCK_HEADER.size + (ADPCM_BLOCK - 1) // 2
+
+IMA_INDEX_TABLE = np.array([-1, -1, -1, -1, 2, 4, 6, 8] * 2, dtype=np.int32)
+IMA_STEP_TABLE = np.array([
+    7, 8, 9, 10, 11, 12, 13, 14, 16, 17, 19, 21, 23, 25, 28, 31, 34, 37, 41, 45, 50, 55, 60, 66, 73, 80, 88, 97, 107,
+    118, 130, 143, 157, 173, 190, 209, 230, 253, 279, 307, 337, 371, 408, 449, 494, 544, 598, 658, 724, 796, 876, 963,
+    1060, 1166, 1282, 1411, 1552, 1707, 1878, 2066, 2272, 2499, 2749, 3024, 3327, 3660, 4026, 4428, 4871, 5358, 5894,
+    6484, 7132, 7845, 8630, 9493, 10442, 11487, 12635, 13899, 15289, 16818, 18500, 20350, 22385, 24623, 27086, 29794,
+    32767], dtype=np.int32)
+
+
+def _ulaw_tables():
+    """G.711 mu-law encode table for every int16 value and decode table for every code (CCITT reference)"""
+    pcm = np.arange(-32768, 32768, dtype=np.int32) >> 2
+    mask = np.where(pcm < 0, 0x7F, 0xFF)
+    magnitude = np.minimum(np.abs(pcm), 8159) + (0x84 >> 2)
+    segment = np.searchsorted(np.array([0x3F, 0x7F, 0xFF, 0x1FF, 0x3FF, 0x7FF, 0xFFF, 0x1FFF]), magnitude)
+    code = (segment << 4) | ((magnitude >> (segment + 1)) & 0x0F)
+    encode = (np.where(segment >= 8, 0x7F, code) ^ mask).astype(np.uint8)
+
+    code = ~np.arange(256, dtype=np.int32) & 0xFF
+    value = (((code & 0x0F) << 3) + 0x84) << ((code >> 4) & 0x07)
+    decode = np.where(code & 0x80, 0x84 - value, value - 0x84).astype(np.int16)
+    return encode, decode
+
+
+def _alaw_tables():
+    """G.711 A-law encode table for every int16 value and decode table for every code (CCITT reference)"""
+    pcm = np.arange(-32768, 32768, dtype=np.int32) >> 3
+    mask = np.where(pcm >= 0, 0xD5, 0x55)
+    magnitude = np.where(pcm >= 0, pcm, -pcm - 1)
+    segment = np.searchsorted(np.array([0x1F, 0x3F, 0x7F, 0xFF, 0x1FF, 0x3FF, 0x7FF, 0xFFF]), magnitude)
+    shift = np.where(segment < 2, 1, segment)
+    code = (segment << 4) | ((magnitude >> shift) & 0x0F)
+    encode = (np.where(segment >= 8, 0x7F, code) ^ mask).astype(np.uint8)
+
+    code = np.arange(256, dtype=np.int32) ^ 0x55
+    segment = (code & 0x70) >> 4
+    value = (code & 0x0F) << 4
+    value = np.where(segment == 0, value + 8, (value + 0x108) << np.maximum(segment - 1, 0))
+    decode = np.where(code & 0x80, value, -value).astype(np.int16)
+    return encode, decode
+
+
+ULAW_ENCODE, ULAW_DECODE = _ulaw_tables()
+ALAW_ENCODE, ALAW_DECODE = _alaw_tables()
+
+
+def _ima_tables():
+    """
+    per (step index, 3-bit magnitude code): the quantizer threshold, the reconstructed difference and the next step
+    index, so one ADPCM sample is a few table lookups instead of the successive-approximation arithmetic
+    """
+    step = IMA_STEP_TABLE[:, None]
+    code = np.arange(8)[None, :]
+    vpdiff = (step >> 3) + np.where(code & 4, step, 0) + np.where(code & 2, step >> 1, 0) + \
+        np.where(code & 1, step >> 2, 0)
+    threshold = np.where(code & 4, step, 0) + np.where(code & 2, step >> 1, 0) + np.where(code & 1, step >> 2, 0)
+    next_index = np.clip(np.arange(89)[:, None] + IMA_INDEX_TABLE[None, :8], 0, 88)
+    # 符号位不影响下一个步长，16个码字的表直接按码字查
+    return threshold[:, 1:].astype(np.int32), np.tile(vpdiff, 2).astype(np.int32), \
+        np.tile(next_index, 2).astype(np.int32)
+
+
+IMA_THRESHOLD, IMA_VPDIFF, IMA_NEXT_INDEX = _ima_tables()
+
+
+def as_pcm(pcm):
+    """:return: np.ndarray int16 view of PCM given as bytes-like or numpy array"""
+    if isinstance(pcm, np.ndarray):
+        return pcm.reshape(-1).astype(np.int16, copy=False)
+    return np.frombuffer(pcm, dtype=np.int16)
+
+
+def ima_adpcm_encode(pcm, channels=1):
+    samples = as_pcm(pcm).reshape(-1, channels).T  # one row per channel
+    count = samples.shape[1]
+    blocks_per_channel = max(1, -(-count // ADPCM_BLOCK))
+    # 每个声道补齐到整块，用最后一个样本填充，不会引入跳变
+    padded = np.pad(samples, ((0, 0), (0, blocks_per_channel * ADPCM_BLOCK - count)), mode='edge') if count else \
+        np.zeros((channels, ADPCM_BLOCK), dtype=np.int16)
+    blocks = padded.reshape(-1, ADPCM_BLOCK).astype(np.int32)
+    columns = np.ascontiguousarray(blocks.T)  # columns[j] = sample j of every block
+
+    predictor = columns[0].copy()
+    # 初始步长按块内相邻样本差的平均值估计，各块互不依赖
+    mean_diff = np.abs(np.diff(blocks, axis=1)).mean(axis=1)
+    index = np.minimum(np.searchsorted(IMA_STEP_TABLE, mean_diff), 88).astype(np.int32)
+    start_index = index.copy()
+    rows = np.arange(len(blocks))
+    nibbles = np.empty((ADPCM_BLOCK - 1, len(blocks)), dtype=np.int32)
+    for j in range(1, ADPCM_BLOCK):
+        diff = columns[j] - predictor
+        negative = diff < 0
+        # 幅度码 = 超过的阈值个数，和逐次逼近的结果一致
+        magnitude = (np.abs(diff)[:, None] >= IMA_THRESHOLD[index]).sum(axis=1)
+        vpdiff = IMA_VPDIFF[index, magnitude]
+        predictor = np.clip(np.where(negative, predictor - vpdiff, predictor + vpdiff), -32768, 32767)
+        nibble = magnitude | (negative << 3)
+        nibbles[j - 1] = nibble
+        index = IMA_NEXT_INDEX[index, nibble]
+
+    out = np.empty((len(blocks), ADPCM_BLOCK_BYTES), dtype=np.uint8)
+    out[:, 0:2] = blocks[:, :1].astype('>i2').view(np.uint8)
+    out[:, 2] = start_index
+    out[:, 3:] = (nibbles[0::2].T << 4) | nibbles[1::2].T  # first sample in the high nibble, like DVI4
+    return ADPCM_FRAME_HEADER.pack(count) + out.tobytes()
+
+
+def ima_adpcm_decode(payload, channels=1):
+    count, = ADPCM_FRAME_HEADER.unpack_from(payload)
+    data = np.frombuffer(payload, dtype=np.uint8, offset=ADPCM_FRAME_HEADER.size)
+    blocks = data[:len(data) // ADPCM_BLOCK_BYTES * ADPCM_BLOCK_BYTES].reshape(-1, ADPCM_BLOCK_BYTES)
+    nibbles = np.empty((ADPCM_BLOCK - 1, len(blocks)), dtype=np.int32)
+    nibbles[0::2] = (blocks[:, 3:] >> 4).T
+    nibbles[1::2] = (blocks[:, 3:] & 0x0F).T
+
+    columns = np.empty((ADPCM_BLOCK, len(blocks)), dtype=np.int16)
+    predictor = blocks[:, 0:2].copy().view('>i2').reshape(-1).astype(np.int32)
+    index = blocks[:, 2].astype(np.int32)
+    columns[0] = predictor
+    for j in range(1, ADPCM_BLOCK):
+        nibble = nibbles[j - 1]
+        vpdiff = IMA_VPDIFF[index, nibble]
+        predictor = np.clip(np.where(nibble & 8, predictor - vpdiff, predictor + vpdiff), -32768, 32767)
+        columns[j] = predictor
+        index = IMA_NEXT_INDEX[index, nibble]
+    return columns.T.reshape(channels, -1)[:, :count].T.reshape(-1)
+
+
+def encode(pcm, payload_type, channels=1):
+    """
+    :param pcm: bytes-like or np.ndarray, interleaved 16-bit PCM
+    :param payload_type: int, PAYLOAD_*
+    :return: bytes, the encoded payload
+    """
+    if payload_type == PAYLOAD_PCMU:
+        return ULAW_ENCODE[as_pcm(pcm).view(np.uint16) ^ 0x8000].tobytes()
+    if payload_type == PAYLOAD_PCMA:
+        return ALAW_ENCODE[as_pcm(pcm).view(np.uint16) ^ 0x8000].tobytes()
+    if payload_type == PAYLOAD_IMA_ADPCM:
+        return ima_adpcm_encode(pcm, channels)
+    if payload_type == PAYLOAD_L16:
+        return as_pcm(pcm).tobytes()
+    raise Exception(f'Unsupported audio payload type {payload_type}')
+
+
+def decode(payload, payload_type, channels=1):
+    """
+    :param payload: bytes-like, an encoded payload
+    :return: np.ndarray, interleaved int16 PCM
+    """
+    if payload_type == PAYLOAD_PCMU:
+        return ULAW_DECODE[np.frombuffer(payload, dtype=np.uint8)]
+    if payload_type == PAYLOAD_PCMA:
+        return ALAW_DECODE[np.frombuffer(payload, dtype=np.uint8)]
+    if payload_type == PAYLOAD_IMA_ADPCM:
+        return ima_adpcm_decode(payload, channels)
+    if payload_type == PAYLOAD_L16:
+        return np.frombuffer(payload, dtype=np.int16)
+    raise Exception(f'Unsupported audio payload type {payload_type}')
@@ -0,0 +1,91 @@
+'''
+Server-side N-1 audio mixing (MCU audio mode)
+Every tick each participant contributes at most one decoded frame to an int32 accumulator; every recipient gets the
+sum minus its own frame, clipped to int16. Recipients that did not contribute in a tick all get the same full mix,
+so it is computed (and encoded by the caller) once. A client receives exactly one audio stream whatever the size of
+the conference
+'''
+from collections import deque
+
+import numpy as np
+
+from audio_codec import as_pcm
+from config import *
+
+
+class AudioMixer:
+    def __init__(self, frame_len, prebuffer=MIXER_PREBUFFER, max_depth=MIXER_MAX_DEPTH):
+        """
+        :param frame_len: int, interleaved samples of one frame (samples per channel * channels)
+        :param prebuffer: int, frames queued from a participant before it is mixed in, absorbs arrival jitter
+        :param max_depth: int, queued frames above which the oldest are skipped (sender clock faster than the tick)
+        """
+        self.frame_len = frame_len
+        self.prebuffer = prebuffer
+        self.max_depth = max(max_depth, prebuffer)
+        self.queues = {}  # self.queues[participant] = deque of int16 frames
+        self.active = set()  # participants whose queue reached prebuffer and that are mixed in every tick
+        self.accumulator = np.zeros(frame_len, dtype=np.int32)
+        self.scratch = np.zeros(frame_len, dtype=np.int32)
+        self.skipped = 0
+        self.underruns = 0
+
+    def push(self, participant, pcm):
+        """
+        :param pcm: bytes-like or np.ndarray, one decoded frame of 16-bit PCM, padded or cut to frame_len
+        """
+        frame = as_pcm(pcm)
+        if len(frame) != self.frame_len:
+            frame = np.resize(frame, self.frame_len) if len(frame) else np.zeros(self.frame_len, dtype=np.int16)
+        queue = self.queues.get(participant)
+        if queue is None:
+            queue = self.queues[participant] = deque()
+        queue.append(frame)
+        while len(queue) > self.max_depth:
+            queue.popleft()
+            self.skipped += 1
+
+    def remove(self, participant):
+        self.queues.pop(participant, None)
+        self.active.discard(participant)
+
+    def mix(self, recipients, include_own=False):
+        """
+        one tick: take the next frame of every active participant and mix it
+        :param recipients: iterable of participants to produce a mix for
+        :param include_own: bool, do not subtract the recipient's own signal (loopback tests)
+        :return: dict, mixes[recipient] = np.ndarray int16 frame, recipients that did not contribute share one
+                 array object; empty when nobody contributed
+        """
+        acc = self.accumulator
+        acc[:] = 0
+        own = {}
+        for participant, queue in self.queues.items():
+            if participant not in self.active:
+                if len(queue) < self.prebuffer:
+                    continue
+                self.active.add(participant)
+            if not queue:
+                # 没有按时到达的帧：这一拍不混这个人，重新攒够预缓冲再加入
+                self.active.discard(participant)
+                self.underruns += 1
+                continue
+            frame = queue.popleft()
+            acc += frame
+            own[participant] = frame
+        if not own:
+            return {}
+        full = np.clip(acc, -32768, 32767).astype(np.int16)
+        if include_own:
+            return {recipient: full for recipient in recipients}
+        mixes = {}
+        scratch = self.scratch
+        for recipient in recipients:
+            frame = own.get(recipient)
+            if frame is None:
+                mixes[recipient] = full
+            else:
+                np.subtract(acc, frame, out=scratch)
+                np.clip(scratch, -32768, 32767, out=scratch)
+                mixes[recipient] = scratch.astype(np.int16)
+        return mixes
@@ -0,0 +1,71 @@
+'''
+Audio codec benchmark: encode/decode throughput in frames per second of CPU, payload size and SNR of every payload
+type in audio_codec, against the zlib-on-PCM of the old mix_test
+
+usage: python bench_audio_codec.py [frame_samples] [sample_rate] [seconds_of_audio]
+'''
+import sys
+import time
+import zlib
+
+import numpy as np
+
+import audio_codec
+from audio_codec import PAYLOAD_IMA_ADPCM, PAYLOAD_L16, PAYLOAD_PCMA, PAYLOAD_PCMU
+
+CODECS = [('L16', PAYLOAD_L16), ('PCMU', PAYLOAD_PCMU), ('PCMA', PAYLOAD_PCMA), ('IMA-ADPCM', PAYLOAD_IMA_ADPCM)]
+
+
+def speech_like(seconds, rate):
+    """voiced harmonics with a syllable-rate envelope plus some noise"""
+    rng = np.random.default_rng(0)
+    t = np.arange(int(seconds * rate)) / rate
+    pitch = 120 + 30 * np.sin(2 * np.pi * 0.7 * t)
+    phase = 2 * np.pi * np.cumsum(pitch) / rate
+    voice = sum(np.sin(k * phase) / k for k in range(1, 12))
+    envelope = np.clip(np.sin(2 * np.pi * 3 * t), 0, None) ** 0.5
+    signal = 6000 * envelope * voice + rng.normal(0, 150, len(t))
+    return np.clip(signal, -32768, 32767).astype(np.int16)
+
+
+def snr(reference, decoded):
+    reference = reference.astype(np.float64)
+    noise = np.sum((reference - decoded.astype(np.float64)) ** 2)
+    return float('inf') if noise == 0 else 10 * np.log10(np.sum(reference ** 2) / noise)
+
+
+def run(frames, encode, decode):
+    start = time.process_time()
+    payloads = [encode(frame) for frame in frames]
+    encode_cpu = time.process_time() - start
+    start = time.process_time()
+    decoded = [decode(payload) for payload in payloads]
+    decode_cpu = time.process_time() - start
+    return payloads, np.concatenate(decoded), encode_cpu, decode_cpu
+
+
+def main():
+    frame_samples = int(sys.argv[1]) if len(sys.argv) > 1 else 2048
+    rate = int(sys.argv[2]) if len(sys.argv) > 2 else 16000
+    seconds = float(sys.argv[3]) if len(sys.argv) > 3 else 30
+    signal = speech_like(seconds, rate)
+    frames = [signal[i:i + frame_samples] for i in range(0, len(signal) - frame_samples + 1, frame_samples)]
+    reference = np.concatenate(frames)
+    print(f'{len(frames)} frames of {frame_samples} samples at {rate} Hz')
+    print(f'{"codec":<10} {"bytes/frame":>11} {"kbit/s":>8} {"ratio":>6} {"SNR dB":>7} {"encode fps":>11} '
+          f'{"decode fps":>11}')
+
+    tests = [('zlib L16', lambda f: zlib.compress(f.tobytes()),
+              lambda p: np.frombuffer(zlib.decompress(p), dtype=np.int16))]
+    tests += [(name, lambda f, pt=pt: audio_codec.encode(f, pt), lambda p, pt=pt: audio_codec.decode(p, pt))
+              for name, pt in CODECS]
+    for name, encode, decode in tests:
+        payloads, decoded, encode_cpu, decode_cpu = run(frames, encode, decode)
+        size = sum(len(p) for p in payloads) / len(payloads)
+        print(f'{name:<10} {size:11.0f} {size * 8 * rate / frame_samples / 1e3:8.1f} '
+              f'{frame_samples * 2 / size:6.2f} {snr(reference, decoded):7.1f} '
+              f'{len(frames) / max(encode_cpu, 1e-9):11.0f} {len(frames) / max(decode_cpu, 1e-9):11.0f}')
+
+
+if __name__ == '__main__':
+    main()
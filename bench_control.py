@@ -0,0 +1,116 @@
+'''
+Control plane benchmark of MainServer
+N clients each keep `depth` join/quit requests in flight on their control connection (depth 1 is the old
+one-request-at-a-time behaviour) and report requests per second and reply latency, then fresh clients measure
+the time from sending join to receiving the first frame of a participant that is already sharing its camera
+
+usage: python bench_control.py [clients] [requests_per_client] [depth] [media_joins]
+'''
+import asyncio
+import multiprocessing
+import socket
+import sys
+import time
+
+from conf_protocol import ControlClient
+from load_gen import free_port, serve_tcp, stop_server, wait_listening
+
+HOST = '127.0.0.1'
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+async def join_quit(port, conference_id, requests, depth, latencies):
+    client = ControlClient()
+    await client.connect(HOST, port)
+    sent = {}
+    window = []
+    for i in range(requests):
+        future = client.send('join' if i % 2 == 0 else 'quit', conference_id=conference_id)
+        sent[future] = time.perf_counter()
+        future.add_done_callback(lambda f: latencies.append(time.perf_counter() - sent[f]))
+        window.append(future)
+        if len(window) >= depth:
+            await client.writer.drain()
+            reply = await window.pop(0)
+            if reply['status'] != 'ok':
+                raise Exception(f'request failed: {reply}')
+    await client.writer.drain()
+    await asyncio.gather(*window)
+    await client.close()
+
+
+async def share_camera(info, stop):
+    """one participant sending a small frame every 1/30 s to the camera port"""
+    reader, writer = await asyncio.open_connection(info['host'], info['data_ports']['camera'])
+    frame = bytes(2000)
+    while not stop.is_set():
+        writer.write(len(frame).to_bytes(4, byteorder='big') + frame)
+        await writer.drain()
+        await asyncio.sleep(1 / 30)
+    writer.close()
+
+
+async def join_to_first_media(port, conference_id):
+    """:return: float, seconds from sending join until the first camera frame is read"""
+    start = time.perf_counter()
+    client = ControlClient()
+    await client.connect(HOST, port)
+    info = await client.request('join', conference_id=conference_id)
+    reader, writer = await asyncio.open_connection(info['host'], info['data_ports']['camera'])
+    header = await reader.readexactly(8)  # 长度 + 来源号
+    await reader.readexactly(int.from_bytes(header[:4], byteorder='big'))
+    elapsed = time.perf_counter() - start
+    writer.close()
+    await client.request('quit')
+    await client.close()
+    return elapsed
+
+
+async def run(port, clients, requests, depth, media_joins):
+    manager = ControlClient()
+    await manager.connect(HOST, port)
+    info = await manager.request('create')
+    conference_id = info['conference_id']
+
+    for window in sorted({1, depth}):
+        latencies = []
+        start = time.perf_counter()
+        await asyncio.gather(*(join_quit(port, conference_id, requests, window, latencies) for _ in range(clients)))
+        elapsed = time.perf_counter() - start
+        print(f'depth {window:3d}: {clients * requests / elapsed:9.0f} requests/s, latency '
+              f'p50 {percentile(latencies, 0.5) * 1000:.2f} ms p99 {percentile(latencies, 0.99) * 1000:.2f} ms')
+
+    stop = asyncio.Event()
+    sender = asyncio.create_task(share_camera(info, stop))
+    await asyncio.sleep(0.2)
+    joins = [await join_to_first_media(port, conference_id) for _ in range(media_joins)]
+    stop.set()
+    await sender
+    print(f'join to first media ({media_joins} joins): p50 {percentile(joins, 0.5) * 1000:.2f} ms '
+          f'p99 {percentile(joins, 0.99) * 1000:.2f} ms')
+    await manager.request('cancel')
+    await manager.close()
+
+
+def main():
+    clients = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    requests = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    depth = int(sys.argv[3]) if len(sys.argv) > 3 else 32
+    media_joins = int(sys.argv[4]) if len(sys.argv) > 4 else 50
+
+    port = free_port(socket.SOCK_STREAM)
+    server = multiprocessing.Process(target=serve_tcp, args=(HOST, port, 1))
+    server.start()
+    try:
+        wait_listening(HOST, port)
+        asyncio.run(run(port, clients, requests, depth, media_joins))
+    finally:
+        stop_server(server)
+
+
+if __name__ == '__main__':
+    main()
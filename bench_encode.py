@@ -0,0 +1,68 @@
+'''
+JPEG encode benchmark: the old PIL path of the clients (BGR->RGB, PIL.Image, save into BytesIO) against
+util.encode_frame on the numpy frame, and FrameEncoderPool encoding a screen and a camera frame in parallel
+
+usage: python bench_encode.py [repeats]
+'''
+import sys
+import time
+from io import BytesIO
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from util import FrameEncoderPool, encode_frame, turbo_jpeg
+
+SIZES = [(480, 480), (1280, 720), (1920, 1080)]
+QUALITY = 75
+
+
+def test_frame(width, height):
+    """smooth gradients plus some noise, closer to a camera picture than pure noise"""
+    x = np.linspace(0, 255, width, dtype=np.float32)
+    y = np.linspace(0, 255, height, dtype=np.float32)[:, None]
+    frame = np.empty((height, width, 3), dtype=np.uint8)
+    frame[..., 0] = x
+    frame[..., 1] = y
+    frame[..., 2] = (x + y) / 2
+    noise = np.random.default_rng(0).integers(0, 16, frame.shape, dtype=np.uint8)
+    return cv2.add(frame, noise)
+
+
+def pil_path(frame):
+    frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+    buffer = BytesIO()
+    Image.fromarray(frame_rgb).convert('RGB').save(buffer, format='JPEG', quality=QUALITY)
+    return buffer.getvalue()
+
+
+def timeit(func, repeats):
+    func()  # warm up
+    start = time.perf_counter()
+    for _ in range(repeats):
+        func()
+    return (time.perf_counter() - start) / repeats
+
+
+def main():
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    pool = FrameEncoderPool()
+    print(f'encoder: {"TurboJPEG" if turbo_jpeg is not None else "cv2.imencode"}, quality {QUALITY}, '
+          f'{repeats} repeats')
+    print(f'{"size":>10} {"PIL path":>10} {"encode_frame":>13} {"speedup":>8} {"2 streams serial":>17} '
+          f'{"2 streams pool":>15}')
+    for width, height in SIZES:
+        frame = test_frame(width, height)
+        other = test_frame(width, height)
+        pil = timeit(lambda: pil_path(frame), repeats)
+        fast = timeit(lambda: encode_frame(frame, QUALITY), repeats)
+        serial = timeit(lambda: (encode_frame(frame, QUALITY), encode_frame(other, QUALITY)), repeats)
+        parallel = timeit(lambda: pool.encode_all([frame, other], QUALITY), repeats)
+        print(f'{width}x{height:<5} {pil * 1e3:8.2f}ms {fast * 1e3:11.2f}ms {pil / fast:7.2f}x '
+              f'{serial * 1e3:15.2f}ms {parallel * 1e3:13.2f}ms')
+    pool.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+'''
+FEC benchmark: fraction of video frames and audio frames that can not be played under random packet loss, with and
+without XOR parity (fec.py), plus the bandwidth overhead and the CPU cost per packet
+
+usage: python bench_fec.py [video_group] [audio_group]
+'''
+import random
+import sys
+import time
+
+import cv2
+import numpy as np
+
+from config import *
+from fec import FecDecoder, FecEncoder
+from rtp import FLAG_FEC, MEDIA_HEADER, STREAM_AUDIO, STREAM_CAMERA, FrameAssembler, MediaStream, packetize_jpeg
+from util import encode_frame
+
+LOSS_RATES = [0.01, 0.02, 0.05]
+VIDEO_FRAMES = 600
+AUDIO_FRAMES = 3000
+
+
+def video_packets(group):
+    """the packets of VIDEO_FRAMES detailed 640x480 frames (34 packets each), parity packets in between"""
+    noise = np.random.default_rng(0).integers(0, 255, (60, 80, 3), dtype=np.uint8)
+    jpeg = encode_frame(cv2.resize(noise, (640, 480), interpolation=cv2.INTER_CUBIC), 50)
+    stream = MediaStream(STREAM_CAMERA, 26, 0, 1)
+    encoder = FecEncoder(stream, group)
+    packets = []
+    for i in range(VIDEO_FRAMES):
+        for packet in packetize_jpeg(jpeg, stream, i * 3000, 640, 480):
+            packets.extend(encoder.protect(packet))
+    return packets
+
+
+def audio_packets(group):
+    stream = MediaStream(STREAM_AUDIO, 10, 0, 2)
+    encoder = FecEncoder(stream, group)
+    packets = []
+    for i in range(AUDIO_FRAMES):
+        packets.extend(encoder.protect(stream.packet(bytes(640), i * 320)))
+    return packets
+
+
+def lose(packets, rate, seed):
+    rng = random.Random(seed)
+    return [packet for packet in packets if rng.random() >= rate]
+
+
+def video_frames_played(packets):
+    decoder = FecDecoder()
+    assembler = FrameAssembler(timeout=1e9)
+    frames = 0
+    for packet in packets:
+        for media in decoder.push(packet) + ([] if packet[1] & FLAG_FEC else [packet]):
+            if assembler.push(media, now=0) is not None:
+                frames += 1
+    return frames
+
+
+def audio_frames_played(packets):
+    decoder = FecDecoder()
+    sequence_numbers = set()
+    for packet in packets:
+        for media in decoder.push(packet) + ([] if packet[1] & FLAG_FEC else [packet]):
+            sequence_numbers.add(MEDIA_HEADER.unpack_from(media)[6])
+    return len(sequence_numbers)
+
+
+def main():
+    video_group = int(sys.argv[1]) if len(sys.argv) > 1 else FEC_VIDEO_GROUP
+    audio_group = int(sys.argv[2]) if len(sys.argv) > 2 else FEC_AUDIO_GROUP
+    for name, make, played, total, group in [
+            ('video', video_packets, video_frames_played, VIDEO_FRAMES, video_group),
+            ('audio', audio_packets, audio_frames_played, AUDIO_FRAMES, audio_group)]:
+        plain = make(0)
+        protected = make(group)
+        overhead = sum(map(len, protected)) / sum(map(len, plain)) - 1
+        print(f'{name}: {len(plain)} packets, k={group}, FEC overhead {100 * overhead:.1f}% bytes')
+        for rate in LOSS_RATES:
+            lost_plain = 1 - played(lose(plain, rate, 1)) / total
+            start = time.process_time()
+            lost_fec = 1 - played(lose(protected, rate, 1)) / total
+            decode_cpu = time.process_time() - start
+            print(f'  {100 * rate:3.0f}% packet loss: frames lost {100 * lost_plain:5.1f}% without FEC, '
+                  f'{100 * lost_fec:5.1f}% with FEC ({1e6 * decode_cpu / len(protected):.1f} us/packet to receive)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+'''
+Rate control simulation: one sender behind a bottleneck link whose capacity changes over time (a FIFO queue with
+tail drop at 1s of queueing), receiver feedback through ReceiverFeedback, settings from RateController.
+Prints the chosen settings and the frame delay per phase, with and without the controller, and checks that the
+controller gets back to at least RECOVERY_SHARE of the usable bitrate within RECOVERY_TIME whenever the capacity rises
+
+usage: python bench_rate_control.py
+'''
+import cv2
+import numpy as np
+
+from rate_control import RateController, ReceiverFeedback
+from rtp import MEDIA_HEADER, STREAM_CAMERA, VIDEO_CLOCK_RATE, MediaStream, packetize_jpeg, parse_header
+from util import encode_frame
+
+CAMERA_FPS = 30
+FEEDBACK_DELAY = 0.02  # seconds for a feedback message to get back to the sender
+MAX_QUEUE_DELAY = 1.0  # the bottleneck drops packets that would wait longer than this
+PHASES = [(20e6, 10), (1e6, 20), (300e3, 20), (5e6, 30)]  # (capacity bits/s, seconds)
+RECOVERY_SHARE = 0.5  # of min(capacity, RATE_MAX_BITRATE)
+RECOVERY_TIME = 15  # seconds
+
+
+def camera_frame():
+    """a detailed 640x480 picture, so the full-quality stream needs more than 10 Mbit/s"""
+    noise = np.random.default_rng(0).integers(0, 255, (60, 80, 3), dtype=np.uint8)
+    return cv2.resize(noise, (640, 480), interpolation=cv2.INTER_CUBIC)
+
+
+def simulate(adaptive):
+    frame = camera_frame()
+    controller = RateController()
+    feedback = ReceiverFeedback(0, 1)
+    stream = MediaStream(STREAM_CAMERA, 26, 0, 2)
+    queue_free = 0.0  # time the bottleneck finishes sending what it already has
+    t = 0.0
+    last_capacity = 0
+    for capacity, duration in PHASES:
+        delays = []
+        lost = sent = 0
+        start, end = t, t + duration
+        recovered = None  # seconds until the sender reached RECOVERY_SHARE of what the link can take
+        while t < end:
+            if controller.should_send(t):
+                scaled = controller.prepare(frame)
+                jpeg = encode_frame(scaled, controller.quality)
+                arrival = None
+                for packet in packetize_jpeg(jpeg, stream, int(t * VIDEO_CLOCK_RATE), scaled.shape[1],
+                                             scaled.shape[0]):
+                    sent += 1
+                    done = max(queue_free, t) + len(packet) * 8 / capacity
+                    if done - t > MAX_QUEUE_DELAY:
+                        lost += 1
+                        continue
+                    queue_free = arrival = done
+                    for report in feedback.on_packet(parse_header(packet), len(packet), arrival):
+                        if adaptive:
+                            controller.on_feedback(memoryview(report)[MEDIA_HEADER.size:], arrival + FEEDBACK_DELAY)
+                if arrival is not None:
+                    delays.append(arrival - t)
+                if adaptive:
+                    bitrate = len(jpeg) * 8 * controller.fps
+                    controller.on_frame_sent(len(jpeg), t)
+                    if recovered is None and bitrate >= RECOVERY_SHARE * min(capacity, controller.max_bitrate):
+                        recovered = t - start
+            t += 1 / CAMERA_FPS
+        rising = capacity > last_capacity
+        recovery = ''
+        if rising and recovered is not None:
+            recovery = f', {RECOVERY_SHARE:.0%} of the link after {recovered:4.1f} s'
+        print(f'  {capacity / 1e6:5.1f} Mbit/s: quality {controller.quality:2d} {controller.fps:2d} fps '
+              f'1/{controller.scale} scale, frame delay median {np.median(delays) * 1e3:6.0f} ms '
+              f'max {max(delays) * 1e3:6.0f} ms, packet loss {100 * lost / max(sent, 1):5.1f}%{recovery}')
+        if adaptive and rising:
+            # 带宽变大以后估计值要能涨回来，不能一直停在拥塞时的设置上
+            assert recovered is not None and recovered <= RECOVERY_TIME, \
+                f'sender did not recover to {RECOVERY_SHARE:.0%} of {capacity / 1e6:.1f} Mbit/s in {RECOVERY_TIME} s'
+        last_capacity = capacity
+
+
+def main():
+    print('fixed settings')
+    simulate(False)
+    print('RateController')
+    simulate(True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+'''
+Loopback benchmark of the TCP relay path (4-byte length prefix + frame, ConferenceServer adds a 4-byte source id
+after the length of the frames it forwards)
+Compares the old thread-per-client relay (recv + bytearray.extend, one `raw_length + frame_data` per recipient)
+with ConferenceServer (recv_into + sendmsg, one shared buffer for all recipients) by the same end-to-end numbers:
+throughput, and the latency from the sender writing a frame until a receiver has read all of it (the send time
+travels in the first 8 bytes of the frame)
+
+usage: python bench_relay.py [clients] [frames] [frame_size]
+'''
+import asyncio
+import socket
+import struct
+import sys
+import threading
+import time
+
+from conf_server import ConferenceServer
+
+SEND_TIME = struct.Struct('!d')
+
+
+class LegacyRelay:
+    """copy of the old MainServer.handle_client loop"""
+
+    def __init__(self):
+        self.clients = []
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(64)
+        self.port = self.listener.getsockname()[1]
+        threading.Thread(target=self.accept, daemon=True).start()
+
+    def accept(self):
+        while True:
+            conn, _ = self.listener.accept()
+            self.clients.append(conn)
+            threading.Thread(target=self.handle_client, args=(conn,), daemon=True).start()
+
+    def recvall(self, conn, n):
+        data = bytearray()
+        while len(data) < n:
+            packet = conn.recv(n - len(data))
+            if not packet:
+                return None
+            data.extend(packet)
+        return data
+
+    def handle_client(self, conn):
+        while True:
+            raw_length = self.recvall(conn, 4)
+            if not raw_length:
+                break
+            frame_data = self.recvall(conn, int.from_bytes(raw_length, byteorder='big'))
+            if not frame_data:
+                break
+            for c in self.clients:
+                if c != conn:
+                    c.sendall(raw_length + frame_data)
+
+
+def start_conference_server():
+    loop = asyncio.new_event_loop()
+    server = ConferenceServer(0, '127.0.0.1')
+    ready = threading.Event()
+
+    def run():
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(server.start())
+        ready.set()
+        loop.run_forever()
+
+    threading.Thread(target=run, daemon=True).start()
+    ready.wait()
+    return server
+
+
+def recvall(conn, n):
+    buf = bytearray(n)
+    view = memoryview(buf)
+    received = 0
+    while received < n:
+        count = conn.recv_into(view[received:])
+        if not count:
+            return None
+        received += count
+    return buf
+
+
+def run_clients(port, num_clients, num_frames, frame_size, header_size=4):
+    """
+    :param header_size: int, bytes before each forwarded frame
+    :return: (frames delivered, seconds, list of per-frame latencies in seconds)
+    """
+    conns = [socket.create_connection(('127.0.0.1', port)) for _ in range(num_clients)]
+    time.sleep(0.2)  # let the relay register everyone
+    received = [0] * (num_clients - 1)
+    latencies = []
+
+    def receiver(i, conn):
+        conn.settimeout(1)
+        try:
+            while received[i] < num_frames:
+                header = recvall(conn, header_size)
+                frame = None if header is None else recvall(conn, int.from_bytes(header[:4], 'big'))
+                if frame is None:
+                    break
+                latencies.append(time.perf_counter() - SEND_TIME.unpack_from(frame)[0])
+                received[i] += 1
+        except socket.timeout:
+            pass
+
+    threads = [threading.Thread(target=receiver, args=(i, c)) for i, c in enumerate(conns[1:])]
+    for t in threads:
+        t.start()
+    frame = bytearray(frame_size.to_bytes(4, 'big') + bytes(frame_size))
+    start = time.perf_counter()
+    for _ in range(num_frames):
+        SEND_TIME.pack_into(frame, 4, time.perf_counter())
+        conns[0].sendall(frame)
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+    for conn in conns:
+        conn.close()
+    return sum(received), elapsed, latencies
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))] if values else 0.0
+
+
+def report(name, delivered, elapsed, latencies, frame_size):
+    mb = delivered * frame_size / elapsed / 1e6
+    print(f'{name:<18} delivered {delivered:6d} frames in {elapsed:6.2f}s  {delivered / elapsed:8.1f} frames/s '
+          f'{mb:8.1f} MB/s  latency p50 {percentile(latencies, 0.5) * 1000:7.2f} ms '
+          f'p99 {percentile(latencies, 0.99) * 1000:7.2f} ms')
+
+
+def main():
+    num_clients = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    num_frames = int(sys.argv[2]) if len(sys.argv) > 2 else 300
+    frame_size = int(sys.argv[3]) if len(sys.argv) > 3 else 100_000
+    print(f'{num_clients} clients (1 sender), {num_frames} frames of {frame_size} bytes')
+
+    legacy = LegacyRelay()
+    report('thread relay', *run_clients(legacy.port, num_clients, num_frames, frame_size), frame_size)
+
+    server = start_conference_server()
+    # screen 端口不跳帧，两边转发的帧数一样
+    report('ConferenceServer', *run_clients(server.data_serve_ports['screen'], num_clients, num_frames, frame_size, 8),
+           frame_size)
+
+
+if __name__ == '__main__':
+    main()
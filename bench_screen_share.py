@@ -0,0 +1,76 @@
+'''
+Screen sharing benchmark: a synthetic slide/code session (static text, a moving cursor, a line typed now and then)
+sent as a full JPEG every tick against ScreenEncoder's dirty tiles, bitrate and encode CPU per frame.
+Also checks that the receiver canvas matches the screen after every update
+
+usage: python bench_screen_share.py [frames] [fps]
+'''
+import sys
+import time
+
+import cv2
+import numpy as np
+
+from config import *
+from rtp import STREAM_SCREEN, VIDEO_CLOCK_RATE, MediaStream, packetize_jpeg
+from screen_share import TILE_PAYLOAD_TYPE, ScreenEncoder, ScreenReceiver
+from util import encode_frame
+
+WIDTH, HEIGHT = 1920, 1080
+
+
+def document():
+    screen = np.full((HEIGHT, WIDTH, 3), 250, dtype=np.uint8)
+    rng = np.random.default_rng(0)
+    for y in range(60, HEIGHT - 40, 28):
+        text = ''.join(chr(c) for c in rng.integers(33, 126, int(rng.integers(20, 110))))
+        cv2.putText(screen, text, (40, y), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (30, 30, 30), 1, cv2.LINE_AA)
+    return screen
+
+
+def main():
+    num_frames = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    fps = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    base = document()
+    stream = MediaStream(STREAM_SCREEN, TILE_PAYLOAD_TYPE)
+    encoder = ScreenEncoder()
+    receiver = ScreenReceiver()
+
+    full_bytes = full_cpu = tile_bytes = tile_cpu = 0
+    mismatches = 0
+    screen = base.copy()
+    for i in range(num_frames):
+        now = i / fps
+        frame = screen.copy()
+        x, y = 200 + (i * 7) % 1400, 300 + (i * 3) % 500
+        cv2.circle(frame, (x, y), 6, (0, 0, 255), -1)  # cursor
+        if i % 20 == 19:  # type a line
+            cv2.putText(screen, f'line {i}', (40 + (i % 7) * 200, 1000), cv2.FONT_HERSHEY_SIMPLEX, 0.6,
+                        (200, 30, 30), 1, cv2.LINE_AA)
+
+        start = time.process_time()
+        full_bytes += len(encode_frame(frame, SCREEN_QUALITY))
+        full_cpu += time.process_time() - start
+
+        start = time.process_time()
+        update = encoder.encode(frame, now)
+        tile_cpu += time.process_time() - start
+        if update is not None:
+            tile_bytes += len(update)
+            received = None
+            for packet in packetize_jpeg(update, stream, i * VIDEO_CLOCK_RATE // fps, WIDTH, HEIGHT):
+                received = receiver.push(packet) or received
+            # JPEG is lossy: compare with a tolerance
+            if received is None or np.abs(received[1].astype(np.int16) - frame).mean() > 4:
+                mismatches += 1
+
+    seconds = num_frames / fps
+    print(f'{num_frames} frames of {WIDTH}x{HEIGHT} at {fps} fps, tile {SCREEN_TILE_SIZE}px, '
+          f'full refresh every {SCREEN_REFRESH_INTERVAL}s')
+    print(f'full JPEG   {full_bytes * 8 / seconds / 1e3:10.1f} kbit/s  {full_cpu / num_frames * 1e3:7.2f} ms CPU/frame')
+    print(f'dirty tiles {tile_bytes * 8 / seconds / 1e3:10.1f} kbit/s  {tile_cpu / num_frames * 1e3:7.2f} ms CPU/frame')
+    print(f'receiver canvas mismatches: {mismatches}')
+
+
+if __name__ == '__main__':
+    main()
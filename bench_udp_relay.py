@@ -0,0 +1,102 @@
+'''
+Loopback packet-rate benchmark of the asyncio UDP relay
+The relay runs in its own process, N clients each send media packets with their own SSRC and receive what the
+relay fans out to them, the relay reports its packet counters and CPU time at the end
+
+usage: python bench_udp_relay.py [clients] [packets_per_client] [packet_size] [packets_per_second_per_client]
+'''
+import asyncio
+import multiprocessing
+import socket
+import sys
+import threading
+import time
+
+from rtp import MEDIA_HEADER, STREAM_CAMERA, MediaStream
+from udp_relay import start_relay
+
+
+def relay_process(port_queue, stop_event, result_queue):
+    async def main():
+        transport, relay = await start_relay('127.0.0.1', 0)
+        port_queue.put(transport.get_extra_info('sockname')[1])
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, stop_event.wait)
+        result_queue.put((relay.packets_in, relay.packets_out, time.process_time()))
+        transport.close()
+
+    asyncio.run(main())
+
+
+def client(port, ssrc, num_packets, packet_size, rate, expected, received, index, start_barrier):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 << 20)
+    sock.connect(('127.0.0.1', port))
+    stream = MediaStream(STREAM_CAMERA, 26, 0, ssrc)
+    sock.send(stream.packet(b'', 0))  # register before everyone starts
+    sock.settimeout(1)
+    start_barrier.wait()
+
+    def receive():
+        try:
+            while received[index] < expected:
+                sock.recv(65536)
+                received[index] += 1
+        except socket.timeout:
+            pass
+
+    receiver = threading.Thread(target=receive)
+    receiver.start()
+    payload = bytes(packet_size - MEDIA_HEADER.size)
+    start = time.perf_counter()
+    for seq in range(num_packets):
+        sock.send(stream.packet(payload, seq))
+        if seq % 10 == 9:
+            # pace to the offered rate in small bursts, like a real 30fps/50pps media sender
+            delay = start + (seq + 1) / rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+    receiver.join()
+    sock.close()
+
+
+def main():
+    num_clients = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    num_packets = int(sys.argv[2]) if len(sys.argv) > 2 else 5000
+    packet_size = int(sys.argv[3]) if len(sys.argv) > 3 else 1200
+    rate = int(sys.argv[4]) if len(sys.argv) > 4 else 500
+
+    port_queue, result_queue = multiprocessing.Queue(), multiprocessing.Queue()
+    stop_event = multiprocessing.Event()
+    process = multiprocessing.Process(target=relay_process, args=(port_queue, stop_event, result_queue))
+    process.start()
+    port = port_queue.get()
+
+    expected = num_packets * (num_clients - 1)
+    received = [0] * num_clients
+    start_barrier = threading.Barrier(num_clients + 1)
+    threads = [threading.Thread(target=client, args=(port, 1000 + i, num_packets, packet_size, rate, expected,
+                                                     received, i, start_barrier)) for i in range(num_clients)]
+    for t in threads:
+        t.start()
+    time.sleep(0.2)
+    start_barrier.wait()
+    start = time.perf_counter()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start - 1  # the receivers stop after a 1s idle timeout
+
+    stop_event.set()
+    packets_in, packets_out, cpu = result_queue.get()
+    process.join()
+    delivered = sum(received)
+    print(f'{num_clients} clients x {num_packets} packets of {packet_size} bytes at {rate} pkt/s each')
+    print(f'relay in  {packets_in:8d} packets  {packets_in / elapsed:10.0f} pkt/s')
+    print(f'relay out {packets_out:8d} packets  {packets_out / elapsed:10.0f} pkt/s')
+    total = num_clients * expected
+    print(f'delivered {delivered:8d} / {total} ({100 * (1 - delivered / total):.2f}% loss)')
+    print(f'relay CPU {cpu:.2f}s  ({1e6 * cpu / max(packets_out, 1):.2f} us per forwarded packet)')
+
+
+if __name__ == '__main__':
+    main()
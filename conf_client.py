@@ -1,16 +1,22 @@
 from util import *
+import asyncio
 import socket
-import cv2
+import time
 import tkinter as tk
 from tkinter import Label, Button
-from PIL import Image, ImageTk
 import threading
+from concurrent.futures import Future, ThreadPoolExecutor
 from Camera import *
+from conf_protocol import ControlClient
+from jitter_buffer import JitterMixer
+from render import VideoRenderer
+from screen_share import ScreenCanvas, ScreenEncoder
 
 """
 现在客户端连接到服务器之后先不出现UI界面，先在控制面板里面输入当前指令
 如果是创建一个会议，就会打开一个UI界面，里面有一个按钮可以控制摄像头是否打开
 如果取消会议，就关闭这个UI界面
+控制连接走 conf_protocol 的长度前缀 JSON 请求，由后台线程里的 asyncio 事件循环收发，命令行线程只等结果
 """
 
 
@@ -19,97 +25,479 @@ class ConferenceClient:
         # sync client
         self.is_working = True
         self.on_meeting = False  # status
-        self.conns = None  # you may need to maintain multiple conns for a single conference
-        self.support_data_types = []  # for some types of data
-        self.share_data = {}
+        self.conference_id = None
+        self.is_manager = False
+        self.conns = {}  # self.conns[data_type] = socket to the ConferenceServer data port
+        self.support_data_types = ['screen', 'camera', 'audio']  # for some types of data
+        self.share_data = {data_type: False for data_type in self.support_data_types}
         self.root = None
         self.conference_info = None  # you may need to save and update some conference_info regularly
+        self.lock = threading.Lock()
 
+        self.decoder = None  # FrameDecoderPool, decoded frames of the received video streams
+        self.encoder = None  # FrameEncoderPool, encodes the camera frames off the capture thread
         self.recv_data = None  # you may need to save received streamd data from other clients in conference
+        self.renderer = None
+        self.videos = None  # tk.Frame holding the labels of the received streams
+        self.remote_labels = {}  # self.remote_labels[(data_type, source)] = tk.Label showing that sender's stream
+        self.last_seen = {}  # self.last_seen[(data_type, source)] = time.monotonic() of its last frame
+        self.audio_mixer = None  # JitterMixer, one buffer per audio sender, mixed once per playback period
+
+        # P2P mode: send straight to the other members, still receive from the ConferenceServer so that a member
+        # falling back to the relay is heard at once
+        self.mode = 'Client-Server'
+        self.peer_conns = {}  # self.peer_conns[(host, port)] = {data_type: socket} for sending to that member
+        self.inbound_conns = set()  # direct connections other members opened to us
+        # 其他成员收到模式事件就会连过来，可能比我们自己处理完 join 的回复还早
+        self.meeting_started = threading.Event()
+        self.mode_lock = threading.Lock()
+        # 回复和事件都在事件循环线程里按到达顺序记下最新的模式，由一个线程去连接/断开，不会乱序
+        self.wanted_mode = None  # (conference_id, mode, peers)
+        self.mode_updates = ThreadPoolExecutor(max_workers=1)
+        self.p2p_listener = socket.create_server(('', 0))
+        self.p2p_port = self.p2p_listener.getsockname()[1]
+        threading.Thread(target=self.accept_peers, daemon=True).start()
+
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+        self.control = ControlClient(on_event=self.on_event)
+
+    def run(self, coroutine):
+        """run a coroutine in the control event loop and wait for its result"""
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result(TIMEOUT_SERVER + 1)
+
+    def request(self, op, **args):
+        """
+        :return: dict, the reply of the server, None if the control connection failed
+        """
+        try:
+            reply = self.run(self.control_request(op, **args))
+        except Exception as e:
+            print(f'[Error]: {op} request failed: {e!r}')
+            return None
+        if reply.get('status') != 'ok':
+            print(f'[Warn]: {op} refused: {reply.get("message")}')
+            return None
+        return reply
+
+    async def control_request(self, op, **args):
+        reply = await self.control.request(op, **args)
+        if reply.get('status') == 'ok' and 'mode' in reply:
+            self.want_mode(reply)
+        return reply
+
+    def want_mode(self, message):
+        """called in the control event loop with a join reply or a mode event"""
+        self.wanted_mode = (message['conference_id'], message['mode'], message['peers'])
+        self.mode_updates.submit(self.apply_mode)
+
+    def on_event(self, event):
+        """server events, called in the control event loop"""
+        if event.get('event') == 'cancelled' and event.get('conference_id') == self.conference_id:
+            print(f'\n[Info]: Conference {self.conference_id} was cancelled by its manager')
+            self.close_conference()
+        elif event.get('event') == 'mode':
+            self.want_mode(event)  # 连接其他成员会阻塞，不能放在事件循环里做
+        elif event.get('event') == 'error':
+            print(f'\n[Error]: {event.get("message")}')
 
     def create_conference(self):
         """
         create a conference: send create-conference request to server and obtain necessary data to
-        点击创建会议的client默认是管理员，然后系统直接从1开始生成会议号
+        点击创建会议的client默认是管理员，由服务器分配会议号，创建者直接进入会议
         """
         print("Creating conference...")
+        reply = self.request('create', p2p_port=self.p2p_port)
+        if reply is None:
+            return
+        print(f'[Info]: Conference {reply["conference_id"]} created')
+        self.start_conference(reply)
+        self.open_window()
+
+    def open_window(self):
         self.root = tk.Tk()
         self.window = VideoConferenceClient(self.root)
-        self.on_meeting = True  # 标记用户现在处于会议中
+        self.root.title(f'Conference {self.conference_id}')
+        buttons = tk.Frame(self.root)
+        buttons.pack(side='top', fill='x')
+        for data_type in self.support_data_types:
+            button = Button(buttons, text=f'共享 {data_type}')
+            button.config(command=lambda d=data_type, b=button: self.on_switch_button(d, b))
+            button.pack(side='left', expand=True, fill='x')
+        self.videos = tk.Frame(self.root)
+        self.videos.pack(expand=True, fill='both')
+        self.renderer = VideoRenderer(self.root, self.recv_data, self.label_for)
+        self.output_data()
         self.root.protocol("WM_DELETE_WINDOW", self.on_window_close)
+        self.root.after(200, self.check_meeting)
         self.root.mainloop()
+        self.renderer = None
+        self.remote_labels = {}
+        self.videos = None
+        self.root = None
+
+    def on_switch_button(self, data_type, button):
+        self.share_switch(data_type)
+        button.config(text=f'停止 {data_type}' if self.share_data[data_type] else f'共享 {data_type}')
+
+    def label_for(self, key):
+        """:return: tk.Label of a received stream, created on its first frame. Tk thread only"""
+        label = self.remote_labels.get(key)
+        if label is None and self.videos is not None:
+            label = self.remote_labels[key] = Label(self.videos)
+            label.pack(side='left', expand=True)
+        return label
+
+    def check_meeting(self):
+        """
+        会议被管理员取消时关掉窗口，Tk 只能在自己的线程里操作，所以轮询状态；
+        顺便去掉 PARTICIPANT_TIMEOUT 内没再收到画面的发送者
+        """
+        if not self.on_meeting:
+            self.destroy_window()
+            return
+        now = time.monotonic()
+        for key in [key for key in self.remote_labels if now - self.last_seen.get(key, now) > PARTICIPANT_TIMEOUT]:
+            label = self.remote_labels.pop(key)
+            self.renderer.clear(label)
+            label.destroy()
+        self.root.after(200, self.check_meeting)
 
     def on_window_close(self):
         """
-        当用户点击窗口关闭按钮时执行的操作。
+        当用户点击窗口关闭按钮时执行的操作：管理员关窗口就是取消会议，其他人是退出会议
         """
-        # 更新状态，表示会议已取消
         print("Window is closing...")
-        self.on_meeting = False
+        if self.on_meeting:
+            if self.is_manager:
+                self.cancel_conference()
+            else:
+                self.quit_conference()
+        self.destroy_window()
 
-        if self.root:
-            self.root.destroy()  # 关闭UI窗口，但不退出整个程序
+    def destroy_window(self):
+        if self.renderer is not None:
+            self.renderer.stop()
+        self.window.on_closing()  # 释放本地预览的摄像头并关闭UI窗口，但不退出整个程序
 
     def cancel_conference(self):
         """
         cancel your on-going conference (when you are the conference manager): ask server to close all clients
         """
+        if not self.on_meeting:
+            print('[Warn]: Not in a conference')
+            return
+        if not self.is_manager:
+            print('[Warn]: Only the manager can cancel the conference')
+            return
+        if self.request('cancel', conference_id=self.conference_id) is not None:
+            print(f'[Info]: Conference {self.conference_id} cancelled')
+        self.close_conference()
 
     def join_conference(self, conference_id):
         """
         join a conference: send join-conference request with given conference_id, and obtain necessary data to
         """
-        pass
+        if self.on_meeting:
+            print(f'[Warn]: Already in conference {self.conference_id}, quit it first')
+            return
+        reply = self.request('join', conference_id=int(conference_id), p2p_port=self.p2p_port)
+        if reply is None:
+            return
+        print(f'[Info]: Joined conference {reply["conference_id"]}')
+        self.start_conference(reply)
+        self.open_window()
 
     def quit_conference(self):
         """
         quit your on-going conference
         """
-        pass
+        if not self.on_meeting:
+            print('[Warn]: Not in a conference')
+            return
+        self.request('quit')
+        self.close_conference()
 
     def keep_share(self, data_type, send_conn, capture_function, compress=None, fps_or_frequency=30):
         '''
         running task: keep sharing (capture and send) certain type of data from server or clients (P2P)
         you can create different functions for sharing various kinds of data
+        fps_or_frequency None: capture_function blocks until the next chunk is ready (audio)
+        compress may return None when there is nothing to send (an unchanged screen), or a Future: then the frame is
+        encoded while the next one is captured and sent one interval later
+        '''
+        interval = 1 / fps_or_frequency if fps_or_frequency else 0
+        pending = None  # Future of the previous frame, still being encoded by the pool
+        try:
+            while self.share_data[data_type] and self.on_meeting:
+                start = time.monotonic()
+                data = capture_function()
+                if compress is not None:
+                    data = compress(data)
+                if isinstance(data, Future):
+                    data, pending = None if pending is None else pending.result(), data
+                if data is not None:
+                    self.send_frame(data_type, send_conn, len(data).to_bytes(4, byteorder='big') + bytes(data))
+                delay = interval - (time.monotonic() - start)
+                if delay > 0:
+                    time.sleep(delay)
+            if pending is not None and self.on_meeting:  # 最后一帧还在编码线程里，发出去再停
+                data = pending.result()
+                self.send_frame(data_type, send_conn, len(data).to_bytes(4, byteorder='big') + bytes(data))
+        except Exception as e:  # 连接被关掉或者设备出错，都停止共享
+            if self.on_meeting:
+                print(f'[Warn]: Stop sharing {data_type}: {e!r}')
+        finally:
+            self.share_data[data_type] = False
+            if data_type == 'camera':
+                devices.release('camera')
+            elif data_type == 'audio':
+                devices.release('audio_in')
+
+    def send_frame(self, data_type, send_conn, frame):
+        """send one length-prefixed frame to every peer in P2P mode, otherwise to the ConferenceServer"""
+        if self.mode == 'P2P':
+            try:
+                for conns in self.peer_conns.values():
+                    conns[data_type].sendall(frame)
+                return
+            except OSError as e:
+                # 直连断了就自己退回服务器转发，其他成员一直在收服务器的数据，不会漏掉
+                print(f'[Warn]: Direct connection lost ({e!r}), falling back to the server')
+                self.mode = 'Client-Server'
+        send_conn.sendall(frame)
+
+    def apply_mode(self):
+        """
+        switch between streaming to the ConferenceServer and streaming straight to the peers ([host, port] of the
+        other members) of the wanted mode, the new connections are opened before the senders use them
+        """
+        with self.mode_lock:
+            if self.wanted_mode is None:
+                return
+            conference_id, mode, peers = self.wanted_mode
+            if not self.on_meeting or conference_id != self.conference_id:
+                return  # 已经离开了这个会议，或者 start_conference 之后会再来一次
+            old = self.peer_conns
+            new = {}
+            if mode == 'P2P':
+                for peer in map(tuple, peers):
+                    conns = old.get(peer) or self.connect_peer(peer)
+                    if conns is None:
+                        mode = 'Client-Server'  # 有一个成员连不上就全部走服务器
+                        break
+                    new[peer] = conns
+            if mode != 'P2P':
+                new, old = {}, {**old, **new}
+            self.peer_conns, self.mode = new, mode
+            for peer, conns in old.items():
+                if peer not in new:
+                    for conn in conns.values():
+                        conn.close()
+        print(f'[Info]: Conference {self.conference_id} in {mode} mode' + (f' with {len(new)} peer(s)' if new else ''))
+
+    def connect_peer(self, peer):
+        """:return: dict data_type -> socket to the member at `peer`, None if it can not be reached"""
+        conns = {}
+        try:
+            for data_type in self.support_data_types:
+                conn = conns[data_type] = socket.create_connection(peer, timeout=TIMEOUT_SERVER)
+                conn.settimeout(None)
+                hello = data_type.encode()  # 第一帧说明这条连接传的是哪种数据
+                conn.sendall(len(hello).to_bytes(4, byteorder='big') + hello)
+        except OSError as e:
+            print(f'[Warn]: Can not connect the member at {peer[0]}:{peer[1]}: {e!r}')
+            for conn in conns.values():
+                conn.close()
+            return None
+        return conns
+
+    def accept_peers(self):
         '''
-        pass
+        running task: accept the direct connections of other members in P2P mode
+        '''
+        while self.is_working:
+            conn, addr = self.p2p_listener.accept()
+            threading.Thread(target=self.recv_peer, args=(conn,), daemon=True).start()
+
+    def recv_peer(self, conn):
+        try:
+            conn.settimeout(TIMEOUT_SERVER)
+            header = conn.recv(4, socket.MSG_WAITALL)
+            data_type = conn.recv(int.from_bytes(header, byteorder='big'), socket.MSG_WAITALL).decode()
+            conn.settimeout(None)
+        except (OSError, UnicodeDecodeError):
+            conn.close()
+            return
+        if not self.meeting_started.wait(TIMEOUT_SERVER) or data_type not in self.support_data_types:
+            conn.close()
+            return
+        self.inbound_conns.add(conn)
+        try:
+            self.keep_recv(conn, data_type, source=conn.getpeername())  # 直连只有这一个发送者
+        finally:
+            self.inbound_conns.discard(conn)
+            conn.close()
 
     def share_switch(self, data_type):
         '''
         switch for sharing certain type of data (screen, camera, audio, etc.)
         '''
-        pass
+        if not self.on_meeting or data_type not in self.conns:
+            print(f'[Warn]: Can not share {data_type} outside a conference')
+            return
+        if self.share_data[data_type]:
+            self.share_data[data_type] = False  # keep_share 在下一次采集后退出
+            return
+        self.share_data[data_type] = True
+        if data_type == 'audio':
+            args = (capture_voice, None, None)
+        elif data_type == 'camera':
+            args = (capture_camera_frame, self.encoder.submit, 30)
+        else:
+            # 屏幕只发变化了的块，每次开始共享用新的编码器，第一帧是整屏
+            args = (capture_screen_frame, ScreenEncoder().encode, 15)
+        threading.Thread(target=self.keep_share, args=(data_type, self.conns[data_type]) + args, daemon=True).start()
 
-    def keep_recv(self, recv_conn, data_type, decompress=None):
+    def keep_recv(self, recv_conn, data_type, decompress=None, source=None):
         '''
         running task: keep receiving certain type of data (save or output)
         you can create other functions for receiving various kinds of data
+        音频放进发送者自己的抖动缓冲区，由 keep_play 混音播放；视频交给解码线程池，只留每个发送者最新的一帧
+        给界面；屏幕收到的是变化块，贴到发送者自己的画布上
+        :param source: None for the ConferenceServer, whose frames carry a 4-byte source id after the length,
+                       otherwise the fixed sender of a direct connection
+        '''
+        reader = recv_conn.makefile('rb')
+        header_size = 8 if source is None else 4
+        canvases = {}  # canvases[source] = ScreenCanvas, 每个共享屏幕的人一块
+        audio_seq = {}  # audio_seq[source] = 下一块音频的序号，TCP 不丢不乱序，按收到的顺序编号
+        try:
+            while self.on_meeting:
+                header = reader.read(header_size)
+                if len(header) < header_size:
+                    break
+                if header_size == 8:
+                    source = header[4:]
+                data = reader.read(int.from_bytes(header[:4], byteorder='big'))
+                if decompress is not None:
+                    data = decompress(data)
+                if data_type == 'audio':
+                    seq = audio_seq.get(source, 0)
+                    audio_seq[source] = seq + 1
+                    self.audio_mixer.buffer(source).push(seq & 0xFFFF, seq * CHUNK & 0xFFFFFFFF, data)
+                    continue
+                self.last_seen[(data_type, source)] = time.monotonic()
+                if data_type == 'screen':
+                    canvas = canvases.get(source)
+                    if canvas is None:
+                        canvas = canvases[source] = ScreenCanvas()
+                    screen = canvas.apply(data)  # 画布会被后面的更新继续修改，交给界面的是一份 RGB 拷贝
+                    if screen is not None:
+                        image = Image.fromarray(cv2.cvtColor(screen, cv2.COLOR_BGR2RGB))
+                        self.recv_data.put((data_type, source), image)
+                else:
+                    self.decoder.submit((data_type, source), data)
+        except (OSError, ValueError):  # close_conference 关掉了连接
+            pass
+        finally:
+            reader.close()
+
+    def keep_play(self):
+        '''
+        running task: every CHUNK play the mix of the next chunk of each audio sender, so several senders are heard
+        together instead of one after another
         '''
+        frame = np.zeros(CHUNK * CHANNELS, dtype=np.int16)
+        try:
+            while self.on_meeting:
+                if not self.audio_mixer.buffers:
+                    time.sleep(CHUNK / RATE)
+                    continue
+                self.audio_mixer.pop_into(frame)
+                devices.output_stream().write(frame.tobytes())  # 阻塞写，输出设备控制节奏
+        except Exception as e:  # close_conference 关掉了输出流
+            if self.on_meeting:
+                print(f'[Warn]: Stop playing audio: {e!r}')
 
     def output_data(self):
         '''
         running task: output received stream data
+        视频由 VideoRenderer 在 Tk 主循环里绘制，音频由 keep_play 混音播放
         '''
+        if self.renderer is not None:
+            self.renderer.start()
 
-    def start_conference(self):
+    def start_conference(self, conference_info):
         '''
         init conns when create or join a conference with necessary conference_info
         and
         start necessary running task for conference
         '''
+        self.conference_info = conference_info
+        self.conference_id = conference_info['conference_id']
+        self.is_manager = conference_info.get('manager', False)
+        self.decoder = FrameDecoderPool()
+        self.encoder = FrameEncoderPool()
+        self.recv_data = self.decoder.frames
+        self.audio_mixer = JitterMixer(CHUNK, CHANNELS, RATE)
+        self.last_seen = {}
+        self.on_meeting = True  # 标记用户现在处于会议中
+        threading.Thread(target=self.keep_play, daemon=True).start()
+        for data_type in self.support_data_types:
+            port = conference_info['data_ports'][data_type]
+            try:
+                conn = socket.create_connection((conference_info['host'], port), timeout=TIMEOUT_SERVER)
+            except OSError as e:
+                print(f'[Warn]: Can not connect the {data_type} port {port}: {e!r}')
+                continue
+            conn.settimeout(None)
+            self.conns[data_type] = conn
+            threading.Thread(target=self.keep_recv, args=(conn, data_type), daemon=True).start()
+        self.meeting_started.set()
+        self.mode_updates.submit(self.apply_mode)
 
     def close_conference(self):
         '''
         close all conns to servers or other clients and cancel the running tasks
         pay attention to the exception handling
         '''
+        with self.lock:
+            if not self.on_meeting:
+                return
+            self.on_meeting = False  # 共享和接收线程看到这个标记后退出
+            for data_type in self.share_data:
+                self.share_data[data_type] = False
+            conns, self.conns = self.conns, {}
+            self.meeting_started.clear()
+        with self.mode_lock:
+            peer_conns, self.peer_conns, self.mode = self.peer_conns, {}, 'Client-Server'
+        for conn in [c for conns_of_peer in peer_conns.values() for c in conns_of_peer.values()]:
+            conn.close()
+        for conn in list(self.inbound_conns) + list(conns.values()):
+            try:
+                conn.shutdown(socket.SHUT_RDWR)  # 让阻塞在 recv 上的线程立刻返回
+            except OSError:
+                pass
+            conn.close()
+        if self.decoder is not None:
+            self.decoder.shutdown()
+        if self.encoder is not None:
+            self.encoder.shutdown()
+        devices.release('audio_out')
+        print(f'[Info]: Left conference {self.conference_id}')
+        self.conference_id = None
+        self.is_manager = False
 
     def start(self):
         """
         execute functions based on the command line input
         """
-        client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        client_socket.connect((SERVER_IP, MAIN_SERVER_PORT))
+        try:
+            self.run(self.control.connect(SERVER_IP, MAIN_SERVER_PORT))
+        except OSError as e:
+            print(f'[Error]: Can not connect the server {SERVER_IP}:{MAIN_SERVER_PORT}: {e!r}')
+            return
 
         while True:
             if not self.on_meeting:
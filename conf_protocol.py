@@ -0,0 +1,112 @@
+'''
+Length-prefixed control protocol between the clients and MainServer
+Every message is a 4-byte big-endian length followed by a UTF-8 JSON object, like the frames of the data ports.
+Requests carry an 'id' chosen by the client and an 'op' ('create', 'join', 'quit', 'cancel'), the reply echoes the
+id with a 'status' ('ok' or 'error' plus 'message'). Replies may come out of order (create waits for a conference
+worker, join does not), so a client can pipeline any number of requests on one connection.
+Messages without an id are events pushed by the server, e.g. {'event': 'cancelled', 'conference_id': 3}
+A client that passes 'p2p_port' with create/join accepts direct media connections there; join replies and
+{'event': 'mode', ...} events carry the conference 'mode' ('P2P' or 'Client-Server') and the [host, port] 'peers'
+to stream to in P2P mode
+'''
+import asyncio
+import itertools
+import json
+
+from config import *
+
+MAX_MESSAGE_SIZE = 64 << 10
+
+
+def encode_message(message):
+    """:return: bytes, the length prefix and the JSON body"""
+    body = json.dumps(message, separators=(',', ':')).encode()
+    return len(body).to_bytes(4, byteorder='big') + body
+
+
+async def read_message(reader):
+    """
+    :param reader: asyncio.StreamReader
+    :return: dict, or None when the peer closed the connection
+    """
+    try:
+        length = int.from_bytes(await reader.readexactly(4), byteorder='big')
+        if length > MAX_MESSAGE_SIZE:
+            raise Exception(f'control message of {length} bytes is too large')
+        message = json.loads(await reader.readexactly(length))
+    except asyncio.IncompleteReadError:
+        return None
+    if not isinstance(message, dict):
+        raise Exception('control message is not a JSON object')
+    return message
+
+
+class ControlClient:
+    """
+    asyncio side of the protocol: request() can be called concurrently, replies are matched by request id
+    """
+
+    def __init__(self, on_event=None):
+        """
+        :param on_event: callable(dict) for server events, called in the event loop
+        """
+        self.on_event = on_event
+        self.reader = None
+        self.writer = None
+        self.ids = itertools.count(1)
+        self.waiting = {}  # self.waiting[request id] = Future of the reply
+        self.read_task = None
+
+    async def connect(self, host=SERVER_IP, port=MAIN_SERVER_PORT):
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+        self.read_task = asyncio.create_task(self.read_replies())
+
+    async def read_replies(self):
+        try:
+            while True:
+                message = await read_message(self.reader)
+                if message is None:
+                    break
+                future = self.waiting.pop(message.get('id'), None)
+                if future is not None:
+                    if not future.done():
+                        future.set_result(message)
+                elif 'event' in message and self.on_event is not None:
+                    self.on_event(message)
+        except Exception as e:  # 连接断开或者收到不合法的消息
+            error = e
+        else:
+            error = ConnectionError('control connection closed')
+        for future in self.waiting.values():
+            if not future.done():
+                future.set_exception(error)
+        self.waiting.clear()
+
+    def send(self, op, **args):
+        """
+        queue one request without waiting for the reply
+        :return: asyncio.Future of the reply dict
+        """
+        if self.read_task is None or self.read_task.done():
+            raise ConnectionError('control connection is not open')
+        request_id = next(self.ids)
+        future = asyncio.get_running_loop().create_future()
+        self.waiting[request_id] = future
+        self.writer.write(encode_message({'id': request_id, 'op': op, **args}))
+        return future
+
+    async def request(self, op, timeout=TIMEOUT_SERVER, **args):
+        """:return: dict, the reply"""
+        future = self.send(op, **args)
+        await self.writer.drain()
+        return await asyncio.wait_for(future, timeout)
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except ConnectionError:
+                pass
+        if self.read_task is not None:
+            await asyncio.gather(self.read_task, return_exceptions=True)
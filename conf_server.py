@@ -1,139 +1,966 @@
 import asyncio
-import threading
-from util import *
+import multiprocessing
+import os
+import random
 import socket
+import threading
+import time
+from collections import OrderedDict, deque
+from config import *
+from audio_mixer import AudioMixer
+from conf_protocol import encode_message, read_message
+from metrics import MetricsRegistry, RateLimitedLog, merge, try_serve_metrics, watch_loop_lag
+
+
+HAS_SENDMSG = hasattr(socket.socket, 'sendmsg')  # not available on Windows
+log_limited = RateLimitedLog()
+MIX_SOURCE = bytes(4)  # source id of the N-1 audio mix made by the server
+
+
+async def recv_exactly(loop, conn, view):
+    """
+    fill the whole memoryview from a non-blocking socket with recv_into, no intermediate bytes objects
+    :return: bool, False if the peer closed the connection
+    """
+    received = 0
+    while received < len(view):
+        n = await loop.sock_recv_into(conn, view[received:])
+        if n == 0:
+            return False
+        received += n
+    return True
+
+
+async def wait_writable(loop, conn):
+    future = loop.create_future()
+    loop.add_writer(conn.fileno(), lambda: future.done() or future.set_result(None))
+    try:
+        await future
+    finally:
+        loop.remove_writer(conn.fileno())
+
+
+async def send_buffers(loop, conn, buffers):
+    """
+    send several buffers with one scatter-gather sendmsg, so header and payload never get concatenated
+    """
+    if not HAS_SENDMSG:
+        for buf in buffers:
+            await loop.sock_sendall(conn, buf)
+        return
+    views = [memoryview(buf) for buf in buffers]
+    while views:
+        try:
+            sent = conn.sendmsg(views)
+        except (BlockingIOError, InterruptedError):
+            await wait_writable(loop, conn)
+            continue
+        while sent:
+            if sent >= len(views[0]):
+                sent -= len(views[0])
+                views.pop(0)
+            else:
+                views[0] = views[0][sent:]
+                sent = 0
+
+
+class _Subscriber:
+    """
+    one receiver of a data stream: own pending queue and own writer task,
+    so a slow link only delays itself instead of the sender and the other receivers
+    """
+
+    def __init__(self, conn, latest_only, maxlen, latency=None, lossless=False):
+        """
+        :param latency: metrics.Histogram, time from a frame being offered until it is written to the socket
+        :param lossless: bool, never drop a frame: the senders wait in wait_room() while maxlen frames are pending
+        """
+        self.conn = conn
+        self.latest_only = latest_only
+        self.lossless = lossless
+        self.maxlen = maxlen
+        # video: keep only the newest frame of each sender (latest-frame-wins)
+        # audio: bounded fifo, the oldest chunk is dropped when full
+        # screen: fifo bounded by the senders themselves, a lost delta would corrupt the receiver's canvas
+        if latest_only:
+            self.pending = OrderedDict()
+        else:
+            self.pending = deque() if lossless else deque(maxlen=maxlen)
+        self.wakeup = asyncio.Event()
+        self.has_room = asyncio.Event()
+        self.has_room.set()
+        self.closed = False
+        self.dropped = 0
+        self.sent = 0
+        self.sent_bytes = 0
+        self.received = 0  # frames this connection sent to the server
+        self.received_bytes = 0
+        self.source = b''  # 4-byte id of this sender, sent after the length of every frame it forwards
+        self.latency = latency
+        self.task = None
+
+    def offer(self, source, frame):
+        frame = (frame, time.monotonic())
+        if self.latest_only:
+            if source in self.pending:
+                self.dropped += 1
+            self.pending[source] = frame
+        else:
+            if len(self.pending) == self.pending.maxlen:
+                self.dropped += 1
+            self.pending.append(frame)
+            if self.lossless and len(self.pending) >= self.maxlen:
+                self.has_room.clear()
+        self.wakeup.set()
+
+    async def wait_room(self):
+        """wait until a lossless queue is below maxlen again, returns at once when the receiver is gone"""
+        while self.lossless and not self.closed and len(self.pending) >= self.maxlen:
+            await self.has_room.wait()
+
+    def next_frame(self):
+        if self.latest_only:
+            return self.pending.popitem(last=False)[1]
+        return self.pending.popleft()
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                await self.wakeup.wait()
+                self.wakeup.clear()
+                while self.pending:
+                    frame, offered = self.next_frame()
+                    if self.lossless and len(self.pending) < self.maxlen:
+                        self.has_room.set()
+                    await send_buffers(loop, self.conn, frame)
+                    self.sent += 1
+                    self.sent_bytes += len(frame[0]) + len(frame[1])
+                    if self.latency is not None:
+                        self.latency.observe(time.monotonic() - offered)
+        except (OSError, asyncio.CancelledError):
+            pass
+        finally:
+            self.closed = True
+            self.has_room.set()
+
+    def close(self):
+        self.closed = True  # 任务可能还没开始跑就被取消，等着的发送者要在这里放行
+        self.has_room.set()
+        self.task.cancel()
 
 
 class ConferenceServer:
-    def __init__(self, ):
+    def __init__(self, conference_id=None, server_ip=SERVER_IP, conf_serve_port=0, data_serve_ports=None,
+                 mix_audio=MIX_AUDIO, metrics=None):
         # async server
-        self.conference_id = None  # conference_id for distinguish difference conference
-        self.conf_serve_ports = None
-        self.data_serve_ports = {}
+        self.conference_id = conference_id  # conference_id for distinguish difference conference
+        self.server_ip = server_ip
+        self.conf_serve_ports = conf_serve_port
+        self.data_serve_ports = dict(data_serve_ports or {})
         self.data_types = ['screen', 'camera', 'audio']  # example data types in a video conference
-        self.clients_info = None
-        self.client_conns = None
-        self.mode = 'Client-Server'  # or 'P2P' if you want to support peer-to-peer conference mode
+        # camera video can skip stale frames; audio can not, nor can screen updates (dirty-tile deltas)
+        self.latest_only_types = {'camera'}
+        # screen updates are never dropped: a sender waits while one of its receivers has a full queue
+        self.lossless_types = {'screen'}
+        self.queue_sizes = {'audio': AUDIO_QUEUE_SIZE, 'screen': SCREEN_QUEUE_SIZE}
+        self.clients_info = {}  # self.clients_info[conn] = peername
+        self.client_conns = set()  # in-meeting control connections
+        self.subscribers = {data_type: {} for data_type in self.data_types}  # [data_type][conn] = _Subscriber
+        # cascading: trunks to the ConferenceServers of the same conference on other nodes, [data_type][conn]
+        self.trunks = {data_type: {} for data_type in self.data_types}
+        self.trunk_peers = {}  # self.trunk_peers[conn] = 'host:port' of the peer node
+        self.trunk_port = 0
+        self.servers = []
+        self.listeners = []
+        self.tasks = []
+        self.data_tasks = set()
+        self.running = False
+        # 'Client-Server', or 'P2P' while the MainServer has the members stream directly to each other; the data
+        # connections stay open in P2P mode so the conference can fall back to the relay at once
+        self.mode = 'Client-Server'
+        # MCU audio mode: audio frames (raw PCM chunks) are mixed here, every client gets one N-1 mix
+        self.mixer = AudioMixer(CHUNK * CHANNELS) if mix_audio else None
+        # 每个订阅者的计数都是它自己的属性，只在被抓取的时候才汇总，转发路径上不多做事
+        self.metrics = metrics or MetricsRegistry()
+        self.latency = self.metrics.histogram('conference_fanout_latency_seconds',
+                                              'time from a frame being received until it is sent to a subscriber',
+                                              ('conference', 'type'))
+        self.retired = {data_type: [0, 0, 0, 0, 0] for data_type in self.data_types}  # counters of closed connections
+        self.last_totals = None
+        self.metric_callbacks = []
+        for name, kind, help_text, attribute in [
+                ('conference_frames_received_total', 'counter', 'frames received from a participant', 'received'),
+                ('conference_bytes_received_total', 'counter', 'bytes received from a participant', 'received_bytes'),
+                ('conference_frames_sent_total', 'counter', 'frames sent to a participant', 'sent'),
+                ('conference_bytes_sent_total', 'counter', 'bytes sent to a participant, with length headers',
+                 'sent_bytes'),
+                ('conference_frames_dropped_total', 'counter', 'frames skipped because a subscriber was too slow',
+                 'dropped')]:
+            self.add_metric(name, kind, help_text, lambda sub, attribute=attribute: getattr(sub, attribute))
+        self.add_metric('conference_queue_depth', 'gauge', 'frames waiting to be sent to a subscriber',
+                        lambda sub: len(sub.pending))
+        for name, help_text, attribute in [
+                ('conference_trunk_bytes_sent_total', 'bytes sent to a peer node', 'sent_bytes'),
+                ('conference_trunk_bytes_received_total', 'bytes received from a peer node', 'received_bytes')]:
+            def collect(attribute=attribute):
+                return [((self.conference_id, self.trunk_peers.get(conn, '?'), data_type), getattr(trunk, attribute))
+                        for data_type, trunks in self.trunks.items() for conn, trunk in trunks.items()]
+            self.metrics.callback(name, 'counter', help_text, ('conference', 'peer', 'type'), collect)
+            self.metric_callbacks.append(collect)
+
+    def add_metric(self, name, kind, help_text, value):
+        """export one value per (participant, data type), read from the _Subscriber at collection time"""
+        def collect():
+            return [((self.conference_id, self.peer_name(conn), data_type), value(sub))
+                    for data_type, subs in self.subscribers.items() for conn, sub in subs.items()]
+        self.metrics.callback(name, kind, help_text, ('conference', 'participant', 'type'), collect)
+        self.metric_callbacks.append(collect)
+
+    def peer_name(self, conn):
+        peer = self.clients_info.get(conn)
+        return f'{peer[0]}:{peer[1]}' if peer else '?'
+
+    def totals(self):
+        """:return: [frames received, bytes received, frames sent, bytes sent, frames dropped], closed connections
+        included"""
+        totals = [sum(counts) for counts in zip(*self.retired.values())]
+        for subs in list(self.subscribers.values()) + list(self.trunks.values()):
+            for sub in subs.values():
+                for i, value in enumerate((sub.received, sub.received_bytes, sub.sent, sub.sent_bytes, sub.dropped)):
+                    totals[i] += value
+        return totals
 
+    def retire(self, data_type, sub):
+        retired = self.retired[data_type]
+        for i, value in enumerate((sub.received, sub.received_bytes, sub.sent, sub.sent_bytes, sub.dropped)):
+            retired[i] += value
 
-    async def handle_data(self, reader, writer, data_type):
+    async def accept_data(self, listener, data_type):
+        """
+        running task: accept data connections of one data type
+        """
+        loop = asyncio.get_running_loop()
+        while self.running:
+            conn, addr = await loop.sock_accept(listener)
+            conn.setblocking(False)
+            task = asyncio.create_task(self.handle_data(conn, data_type))
+            self.data_tasks.add(task)
+            task.add_done_callback(self.data_tasks.discard)
+
+    async def handle_data(self, conn, data_type):
         """
         running task: receive sharing stream data from a client and decide how to forward them to the rest clients
+        每个连接既是发送者也是接收者，收到的帧只放进其他人的队列，由各自的写任务发出去
+        """
+        loop = asyncio.get_running_loop()
+        lossless = data_type in self.lossless_types
+        subscriber = _Subscriber(conn, data_type in self.latest_only_types, self.queue_sizes.get(data_type),
+                                 self.latency.labels(self.conference_id, data_type), lossless)
+        subscriber.task = asyncio.create_task(subscriber.run())
+        # 来源号要在级联的所有节点上都不重复，用随机数而不是计数器；0 留给服务器混音
+        subscriber.source = random.randrange(1, 1 << 32).to_bytes(4, byteorder='big')
+        subscribers = self.subscribers[data_type]
+        subscribers[conn] = subscriber
+        trunks = self.trunks[data_type]
+        self.clients_info[conn] = conn.getpeername()
+        raw_length = bytearray(4)  # 长度头复用同一块缓冲区
+        length_view = memoryview(raw_length)
+        try:
+            while self.running:
+                if not await recv_exactly(loop, conn, length_view):
+                    break
+                frame_length = int.from_bytes(raw_length, byteorder='big')
+                # 帧数据直接 recv_into 到按长度分配好的缓冲区，然后被所有接收者只读共享，不再为每个人拼接一份
+                frame_data = bytearray(frame_length)
+                if not await recv_exactly(loop, conn, memoryview(frame_data)):
+                    break
+                subscriber.received += 1
+                subscriber.received_bytes += 4 + frame_length
+                # 长度后面带上发送者的来源号，接收端按来源分开画布、解码和播放
+                frame = (bytes(raw_length) + subscriber.source, frame_data)
+                # 每个流只经干线给每个对端节点发一份，由对端分发给它那里的订阅者
+                receivers = list(trunks.values())
+                if self.mixer is not None and data_type == 'audio':
+                    self.mixer.push(conn, memoryview(frame_data)[:frame_length & ~1])
+                else:
+                    receivers += [other for other_conn, other in subscribers.items() if other_conn is not conn]
+                if lossless:
+                    for other in receivers:
+                        await other.wait_room()  # 不读下一帧，TCP 把压力传回发送者
+                for other in receivers:
+                    other.offer(conn, frame)
+                # 数据已经在内核缓冲区里时 sock_recv_into 不会让出事件循环，这里主动让写任务先跑
+                await asyncio.sleep(0)
+        except OSError as e:
+            log_limited(('data', self.conference_id), f'[Conference {self.conference_id}]: {data_type} connection '
+                                                      f'{self.peer_name(conn)} lost: {e}')
+        finally:
+            self.retire(data_type, subscriber)
+            subscribers.pop(conn, None)
+            if self.mixer is not None and data_type == 'audio':
+                self.mixer.remove(conn)
+            self.clients_info.pop(conn, None)
+            subscriber.close()
+            conn.close()
+
+    async def accept_trunks(self, listener):
+        """
+        running task: accept the trunk connections of peer nodes, the first frame names the data type
         """
+        loop = asyncio.get_running_loop()
+        while self.running:
+            conn, addr = await loop.sock_accept(listener)
+            conn.setblocking(False)
+            task = asyncio.create_task(self.handle_trunk(conn, None, f'{addr[0]}:{addr[1]}'))
+            self.data_tasks.add(task)
+            task.add_done_callback(self.data_tasks.discard)
+
+    async def connect_trunk(self, host, port):
+        """open one trunk connection per data type to the ConferenceServer of this conference on a peer node"""
+        loop = asyncio.get_running_loop()
+        for data_type in self.data_types:
+            conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            conn.setblocking(False)
+            try:
+                await loop.sock_connect(conn, (host, port))
+                hello = data_type.encode()
+                await loop.sock_sendall(conn, len(hello).to_bytes(4, byteorder='big') + hello)
+            except OSError as e:
+                print(f'[Conference {self.conference_id}]: trunk to {host}:{port} failed: {e}')
+                conn.close()
+                return
+            task = asyncio.create_task(self.handle_trunk(conn, data_type, f'{host}:{port}'))
+            self.data_tasks.add(task)
+            task.add_done_callback(self.data_tasks.discard)
+
+    async def handle_trunk(self, conn, data_type, peer):
+        """
+        running task: one trunk connection to a peer node, frames carry the sender's source id after the length.
+        every node has a trunk to every other node of the conference, so frames from a trunk only go to the local
+        subscribers and never to another trunk
+        """
+        loop = asyncio.get_running_loop()
+        header = bytearray(8)  # 4字节长度 + 4字节来源
+        view = memoryview(header)
+        try:
+            if data_type is None:
+                if not await recv_exactly(loop, conn, view[:4]):
+                    conn.close()
+                    return
+                name = bytearray(min(int.from_bytes(header[:4], byteorder='big'), 16))
+                if not await recv_exactly(loop, conn, memoryview(name)) or name.decode() not in self.data_types:
+                    conn.close()
+                    return
+                data_type = name.decode()
+        except (OSError, UnicodeDecodeError):
+            conn.close()
+            return
+        lossless = data_type in self.lossless_types
+        trunk = _Subscriber(conn, data_type in self.latest_only_types, TRUNK_QUEUE_SIZE, lossless=lossless)
+        trunk.task = asyncio.create_task(trunk.run())
+        self.trunks[data_type][conn] = trunk
+        self.trunk_peers[conn] = peer
+        subscribers = self.subscribers[data_type]
+        mixed = set()  # 对端的发送者在混音器里的 key，干线断开时一起移除
+        try:
+            while self.running:
+                if not await recv_exactly(loop, conn, view):
+                    break
+                frame_length = int.from_bytes(header[:4], byteorder='big')
+                frame_data = bytearray(frame_length)
+                if not await recv_exactly(loop, conn, memoryview(frame_data)):
+                    break
+                trunk.received += 1
+                trunk.received_bytes += 8 + frame_length
+                source = (conn, bytes(header[4:]))
+                if self.mixer is not None and data_type == 'audio':
+                    mixed.add(source)
+                    self.mixer.push(source, memoryview(frame_data)[:frame_length & ~1])
+                else:
+                    frame = (bytes(header), frame_data)
+                    receivers = list(subscribers.values())
+                    if lossless:
+                        for other in receivers:
+                            await other.wait_room()
+                    for other in receivers:
+                        other.offer(source, frame)
+                await asyncio.sleep(0)
+        except OSError as e:
+            log_limited(('trunk', self.conference_id), f'[Conference {self.conference_id}]: {data_type} trunk '
+                                                       f'{peer} lost: {e}')
+        finally:
+            self.retire(data_type, trunk)
+            self.trunks[data_type].pop(conn, None)
+            self.trunk_peers.pop(conn, None)
+            for source in mixed:
+                self.mixer.remove(source)
+            trunk.close()
+            conn.close()
+
+    async def mix_audio(self):
+        """
+        running task: one tick per audio chunk, offer every audio subscriber its N-1 mix
+        """
+        loop = asyncio.get_running_loop()
+        period = CHUNK / RATE
+        next_tick = loop.time()
+        subscribers = self.subscribers['audio']
+        while self.running:
+            next_tick += period
+            delay = next_tick - loop.time()
+            if delay < -period:
+                next_tick = loop.time()  # 事件循环被卡住太久，不补发落下的拍子
+            await asyncio.sleep(max(0.0, delay))
+            encoded = {}  # 没说话的人拿到的是同一个混音，只转换一次
+            for conn, pcm in self.mixer.mix(subscribers).items():
+                frame = encoded.get(id(pcm))
+                if frame is None:
+                    data = pcm.tobytes()
+                    frame = encoded[id(pcm)] = (len(data).to_bytes(4, byteorder='big') + MIX_SOURCE, data)
+                subscribers[conn].offer(None, frame)
 
     async def handle_client(self, reader, writer):
         """
         running task: handle the in-meeting requests or messages from clients
         """
+        self.client_conns.add(writer)
+        try:
+            while self.running:
+                line = await reader.readline()
+                if not line or line.strip().lower() == b'quit':
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            self.client_conns.discard(writer)
+            writer.close()
+
+    def client_count(self):
+        return len(self.clients_info)
 
     async def log(self):
+        """
+        running task: one status line per LOG_INTERVAL with the rates since the last one, details are in the metrics
+        """
         while self.running:
-            print('Something about server status')
             await asyncio.sleep(LOG_INTERVAL)
+            totals = self.totals()
+            last, self.last_totals = self.last_totals or totals, totals
+            rates = [(now - before) / LOG_INTERVAL for now, before in zip(totals, last)]
+            counts = {data_type: len(subs) for data_type, subs in self.subscribers.items() if subs}
+            trunks = f'trunks {len(self.trunk_peers)}, ' if self.trunk_peers else ''
+            histograms = [self.latency.children.get((self.conference_id, t)) for t in self.data_types]
+            p99 = max([h.quantile(0.99) for h in histograms if h is not None and h.count] or [0.0])
+            print(f'[Conference {self.conference_id}]: {self.mode}, clients {counts}, {trunks}'
+                  f'in {rates[0]:.0f} frames/s {8 * rates[1] / 1e6:.1f} Mbit/s, '
+                  f'out {rates[2]:.0f} frames/s {8 * rates[3] / 1e6:.1f} Mbit/s, '
+                  f'dropped {rates[4]:.0f}/s, fan-out p99 {1000 * p99:.2f} ms')
 
     async def cancel_conference(self):
         """
         handle cancel conference request: disconnect all connections to cancel the conference
         """
+        self.running = False
+        for server in self.servers:
+            server.close()
+        # 先取消任务让它们从事件循环里注销，再关闭套接字
+        tasks = self.tasks + list(self.data_tasks)
+        tasks += [sub.task for subs in list(self.subscribers.values()) + list(self.trunks.values())
+                  for sub in subs.values()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for listener in self.listeners:
+            listener.close()
+        for subs in list(self.subscribers.values()) + list(self.trunks.values()):
+            for conn in subs:
+                conn.close()
+            subs.clear()
+        self.trunk_peers.clear()
+        for writer in list(self.client_conns):
+            writer.close()
+        self.client_conns.clear()
+        self.metrics.remove_callbacks(self.metric_callbacks)
+        for data_type in self.data_types:
+            self.latency.remove(self.conference_id, data_type)
 
-    def start(self):
+    async def start(self):
         '''
         start the ConferenceServer and necessary running tasks to handle clients in this conference
         '''
+        self.running = True
+        server = await asyncio.start_server(self.handle_client, self.server_ip, self.conf_serve_ports)
+        self.conf_serve_ports = server.sockets[0].getsockname()[1]
+        self.servers.append(server)
+        for data_type in self.data_types:
+            listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            listener.bind((self.server_ip, self.data_serve_ports.get(data_type, 0)))
+            listener.listen(socket.SOMAXCONN)
+            listener.setblocking(False)
+            self.data_serve_ports[data_type] = listener.getsockname()[1]
+            self.listeners.append(listener)
+            self.tasks.append(asyncio.create_task(self.accept_data(listener, data_type)))
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind((self.server_ip, self.trunk_port))
+        listener.listen(socket.SOMAXCONN)
+        listener.setblocking(False)
+        self.trunk_port = listener.getsockname()[1]
+        self.listeners.append(listener)
+        self.tasks.append(asyncio.create_task(self.accept_trunks(listener)))
+        self.tasks.append(asyncio.create_task(self.log()))
+        if self.mixer is not None:
+            self.tasks.append(asyncio.create_task(self.mix_audio()))
+
+
+def conference_worker(worker_id, server_ip, cmd_queue, status_queue):
+    """
+    worker process: host several ConferenceServers in one event loop and report heartbeats to the MainServer
+    """
+    asyncio.run(_conference_worker(worker_id, server_ip, cmd_queue, status_queue))
+
+
+async def _conference_worker(worker_id, server_ip, cmd_queue, status_queue):
+    loop = asyncio.get_running_loop()
+    conferences = {}
+    metrics = MetricsRegistry({'worker': worker_id})
+
+    async def heartbeat():
+        while True:
+            clients = sum(conf.client_count() for conf in conferences.values())
+            # 指标快照跟着心跳送给MainServer，由它统一对外提供
+            status_queue.put(('heartbeat', worker_id, len(conferences), clients, metrics.collect()))
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+
+    heartbeat_task = asyncio.create_task(heartbeat())
+    lag_task = asyncio.create_task(watch_loop_lag(metrics))
+    try:
+        while True:
+            cmd = await loop.run_in_executor(None, cmd_queue.get)
+            if cmd[0] == 'create':
+                conference_id = cmd[1]
+                conf = ConferenceServer(conference_id, server_ip, metrics=metrics)
+                await conf.start()
+                conferences[conference_id] = conf
+                status_queue.put(('created', worker_id, conference_id, conf.conf_serve_ports, conf.data_serve_ports,
+                                  conf.trunk_port))
+            elif cmd[0] == 'cancel':
+                conf = conferences.pop(cmd[1], None)
+                if conf is not None:
+                    await conf.cancel_conference()
+            elif cmd[0] == 'mode':
+                conf = conferences.get(cmd[1])
+                if conf is not None:
+                    conf.mode = cmd[2]
+            elif cmd[0] == 'trunk':
+                conf = conferences.get(cmd[1])
+                if conf is not None:
+                    await conf.connect_trunk(cmd[2], cmd[3])
+            elif cmd[0] == 'stop':
+                break
+    finally:
+        heartbeat_task.cancel()
+        lag_task.cancel()
+        for conf in conferences.values():
+            await conf.cancel_conference()
+
+
+class _Session:
+    """one control connection to the MainServer, i.e. one participant"""
+    __slots__ = ('writer', 'conference_id', 'managed', 'closed', 'p2p_endpoint', 'node')
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.conference_id = None
+        self.managed = set()  # conferences this participant created and that still exist
+        self.closed = False
+        self.p2p_endpoint = None  # (host, port) where the participant accepts direct media connections
+        self.node = None  # worker id of the ConferenceServer the participant streams to
 
 
 class MainServer:
-    def __init__(self, server_ip, main_port):
+    def __init__(self, server_ip, main_port, num_workers=CONF_WORKERS, metrics_port=METRICS_PORT,
+                 p2p_max_members=P2P_MAX_MEMBERS, node_capacity=CASCADE_NODE_CAPACITY):
         # async server
         self.server_ip = server_ip
         self.server_port = main_port
         self.main_server = None
         self.conference_conns = None
-        self.conference_servers = {}  # self.conference_servers[conference_id] = ConferenceManager
-        self.clients = []
-        self.clients_lock = threading.Lock()
+        self.conference_servers = {}  # self.conference_servers[conference_id] = endpoint info of its first node
+        # cascading: a conference can have a ConferenceServer (node) on several workers, connected by trunks
+        self.nodes = {}  # self.nodes[conference_id][worker_id] = endpoint info of the node on that worker
+        self.node_sizes = {}  # self.node_sizes[conference_id][worker_id] = members streaming to that node
+        self.pending_nodes = {}  # self.pending_nodes[conference_id] = Task starting one more node
+        self.node_capacity = node_capacity
+        self.num_workers = num_workers or os.cpu_count() or 1
+        self.workers = []  # self.workers[worker_id] = (process, cmd_queue)
+        self.worker_load = {}  # self.worker_load[worker_id] = [conferences, clients, last heartbeat time]
+        self.status_queue = None
+        self.status_thread = None
+        self.pending_creates = {}  # (conference_id, worker_id) -> Future resolved when the worker reports 'created'
+        self.members = {}  # self.members[conference_id] = set of _Session in the conference
+        self.managers = {}  # self.managers[conference_id] = _Session of the creator
+        self.modes = {}  # self.modes[conference_id] = 'Client-Server' or 'P2P'
+        self.p2p_max_members = p2p_max_members
+        self.next_conference_id = 1
+        self.loop = None
+        self.metrics_port = metrics_port  # Prometheus endpoint on METRICS_HOST, None turns it off
+        self.metrics = MetricsRegistry()
+        self.worker_metrics = {}  # self.worker_metrics[worker_id] = snapshot sent with its last heartbeat
+        self.metrics.callback('main_conferences', 'gauge', 'conferences known to the MainServer', (),
+                              lambda: [((), len(self.conference_servers))])
+        self.metrics.callback('main_conference_nodes', 'gauge', 'ConferenceServers of a conference', ('conference',),
+                              lambda: [((c,), len(nodes)) for c, nodes in self.nodes.items()])
+        self.metrics.callback('main_control_sessions', 'gauge', 'participants in a conference per the control plane',
+                              (), lambda: [((), sum(map(len, self.members.values())))])
+        self.metrics.callback('worker_clients', 'gauge', 'data connections per conference worker', ('worker',),
+                              lambda: [((w,), load[1]) for w, load in self.worker_load.items()])
+        self.metrics.callback('worker_heartbeat_age_seconds', 'gauge', 'time since the last worker heartbeat',
+                              ('worker',), lambda: [((w,), time.monotonic() - load[2])
+                                                    for w, load in self.worker_load.items()])
 
-    def handle_creat_conference(self, ):
+    def start_workers(self):
+        self.status_queue = multiprocessing.Queue()
+        for worker_id in range(self.num_workers):
+            cmd_queue = multiprocessing.Queue()
+            process = multiprocessing.Process(target=conference_worker, daemon=True,
+                                              args=(worker_id, self.server_ip, cmd_queue, self.status_queue))
+            process.start()
+            self.workers.append((process, cmd_queue))
+            self.worker_load[worker_id] = [0, 0, 0.0]
+        self.status_thread = threading.Thread(target=self.collect_status, daemon=True)
+        self.status_thread.start()
+
+    def stop_workers(self):
+        for process, cmd_queue in self.workers:
+            cmd_queue.put(('stop',))
+        for process, cmd_queue in self.workers:
+            process.join(TIMEOUT_SERVER)
+        self.status_queue.put(None)
+        self.status_thread.join(TIMEOUT_SERVER)
+
+    def collect_status(self):
+        """
+        running thread: forward heartbeats and replies of the workers into the event loop
+        """
+        while True:
+            msg = self.status_queue.get()
+            if msg is None:
+                break
+            try:
+                self.loop.call_soon_threadsafe(self.on_worker_status, msg)
+            except RuntimeError:
+                break  # 事件循环已经关闭，服务器正在退出
+
+    def on_worker_status(self, msg):
+        if msg[0] == 'heartbeat':
+            _, worker_id, conferences, clients, snapshot = msg
+            self.worker_load[worker_id] = [conferences, clients, time.monotonic()]
+            self.worker_metrics[worker_id] = snapshot
+        elif msg[0] == 'created':
+            _, worker_id, conference_id, conf_port, data_ports, trunk_port = msg
+            future = self.pending_creates.pop((conference_id, worker_id), None)
+            if future is not None and not future.done():
+                future.set_result({'conference_id': conference_id, 'worker': worker_id, 'host': self.server_ip,
+                                   'conf_port': conf_port, 'data_ports': data_ports, 'trunk_port': trunk_port})
+
+    def least_loaded_worker(self, exclude=()):
+        """:return: worker id, None if every worker is excluded"""
+        now = time.monotonic()
+        candidates = [w for w in self.worker_load if w not in exclude]
+        alive = [w for w in candidates if now - self.worker_load[w][2] < 3 * HEARTBEAT_INTERVAL]
+        return min(alive or candidates, key=lambda w: (self.worker_load[w][1], self.worker_load[w][0]), default=None)
+
+    async def start_node(self, conference_id, worker_id):
+        """
+        start a ConferenceServer of the conference on a worker
+        :return: dict, its endpoint info; raises asyncio.TimeoutError if the worker does not answer
+        """
+        # 在下一次心跳之前先把这个会议算到该 worker 上，避免连续创建都落在同一个进程
+        self.worker_load[worker_id][0] += 1
+        future = self.loop.create_future()
+        self.pending_creates[(conference_id, worker_id)] = future
+        self.workers[worker_id][1].put(('create', conference_id))
+        try:
+            return await asyncio.wait_for(future, TIMEOUT_SERVER)
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            # worker 可能超时以后才建好，它按顺序执行命令，跟一个 cancel 就不会留下没人管的 ConferenceServer
+            self.workers[worker_id][1].put(('cancel', conference_id))
+            raise
+        finally:
+            self.pending_creates.pop((conference_id, worker_id), None)
+
+    async def add_node(self, conference_id):
+        """
+        cascade the conference to one more worker, the new node opens a trunk to every existing node
+        """
+        nodes = self.nodes[conference_id]
+        worker_id = self.least_loaded_worker(exclude=nodes)
+        if worker_id is None:
+            return
+        info = await self.start_node(conference_id, worker_id)
+        if self.nodes.get(conference_id) is not nodes:
+            self.workers[worker_id][1].put(('cancel', conference_id))  # 等worker的时候会议已经结束了
+            return
+        for other in nodes.values():
+            self.workers[worker_id][1].put(('trunk', conference_id, other['host'], other['trunk_port']))
+        if self.modes[conference_id] != 'Client-Server':
+            self.workers[worker_id][1].put(('mode', conference_id, self.modes[conference_id]))
+        nodes[worker_id] = info
+        self.node_sizes[conference_id][worker_id] = 0
+        print(f'Conference {conference_id} cascaded to worker {worker_id}, {len(nodes)} nodes')
+
+    def place_member(self, conference_id, cascade=True):
+        """:return: worker id of the node a new member streams to, None if a node has to be added first"""
+        sizes = self.node_sizes[conference_id]
+        if self.node_capacity:
+            for worker_id, size in sizes.items():
+                if size < self.node_capacity:
+                    return worker_id
+            if cascade and len(sizes) < len(self.workers):
+                return None
+        return min(sizes, key=sizes.get)  # 不分节点，或者每个worker上都有了，就放到人最少的节点
+
+    async def join_new_node(self, session, conference_id):
+        task = self.pending_nodes.get(conference_id)
+        if task is None:
+            # 同时加入的人等同一个新节点
+            task = self.pending_nodes[conference_id] = asyncio.create_task(self.add_node(conference_id))
+            task.add_done_callback(lambda _: self.pending_nodes.pop(conference_id, None))
+        try:
+            await asyncio.shield(task)
+        except asyncio.TimeoutError:
+            pass  # 加不了节点就挤进已有的节点
+        if session.closed:
+            return {'status': 'error', 'message': 'disconnected'}
+        return self.handle_join_conference(session, conference_id, cascade=False)
+
+    async def handle_creat_conference(self, session):
         """
         create conference: create and start the corresponding ConferenceServer, and reply necessary info to client
+        the creator joins it right away and is its manager
         """
+        if session.conference_id is not None:
+            return {'status': 'error', 'message': f'already in conference {session.conference_id}'}
+        conference_id = self.next_conference_id
+        self.next_conference_id += 1
+        try:
+            info = await self.start_node(conference_id, self.least_loaded_worker())
+        except asyncio.TimeoutError:
+            return {'status': 'error', 'message': 'no worker available'}
+        self.conference_servers[conference_id] = info
+        self.nodes[conference_id] = {info['worker']: info}
+        self.node_sizes[conference_id] = {info['worker']: 0}
+        self.members[conference_id] = set()
+        self.modes[conference_id] = 'Client-Server'
+        self.managers[conference_id] = session
+        session.managed.add(conference_id)
+        if session.closed:
+            self.close_conference(conference_id)  # 等worker的时候创建者已经断开了
+            return {'status': 'error', 'message': 'disconnected'}
+        return self.handle_join_conference(session, conference_id)
 
-    def handle_join_conference(self, conference_id):
+    def handle_join_conference(self, session, conference_id, cascade=True):
         """
         join conference: search corresponding conference_info and ConferenceServer, and reply necessary info to client
+        the reply names the node the member streams to
+        :return: dict, the reply, or a coroutine giving it when the conference has to be cascaded to a new node
         """
+        if conference_id not in self.conference_servers:
+            return {'status': 'error', 'message': 'no such conference'}
+        if session.conference_id is not None and session.conference_id != conference_id:
+            return {'status': 'error', 'message': f'already in conference {session.conference_id}'}
+        if session.conference_id is None:
+            worker_id = self.place_member(conference_id, cascade)
+            if worker_id is None:
+                return self.join_new_node(session, conference_id)
+            session.conference_id = conference_id
+            session.node = worker_id
+            self.node_sizes[conference_id][worker_id] += 1
+            self.members[conference_id].add(session)
+            self.update_mode(conference_id, session)
+        return {'status': 'ok', **self.nodes[conference_id][session.node],
+                'manager': self.managers.get(conference_id) is session, **self.mode_info(conference_id, session)}
 
-    def handle_quit_conference(self):
+    def handle_quit_conference(self, session):
         """
         quit conference (in-meeting request & or no need to request)
+        the conference keeps running without its manager, it ends on cancel or when it is empty and the manager
+        disconnected
         """
-        pass
+        conference_id = session.conference_id
+        if conference_id is None:
+            return {'status': 'error', 'message': 'not in a conference'}
+        session.conference_id = None
+        members = self.members[conference_id]
+        members.discard(session)
+        sizes = self.node_sizes[conference_id]
+        sizes[session.node] -= 1
+        if not members and self.managers[conference_id].closed:
+            self.close_conference(conference_id)
+        else:
+            if not sizes[session.node] and session.node != self.conference_servers[conference_id]['worker']:
+                # 没人了的级联节点停掉，对端节点看到干线断开就会收掉它
+                del self.nodes[conference_id][session.node], sizes[session.node]
+                self.workers[session.node][1].put(('cancel', conference_id))
+            self.update_mode(conference_id, session)
+        session.node = None
+        return {'status': 'ok', 'conference_id': conference_id}
 
-    def handle_cancel_conference(self):
+    def handle_cancel_conference(self, session, conference_id=None):
         """
         cancel conference (in-meeting request, a ConferenceServer should be closed by the MainServer)
+        only the manager may cancel, the other members get a 'cancelled' event
+        """
+        conference_id = session.conference_id if conference_id is None else conference_id
+        if conference_id not in self.conference_servers:
+            return {'status': 'error', 'message': 'no such conference'}
+        if self.managers.get(conference_id) is not session:
+            return {'status': 'error', 'message': 'only the manager can cancel the conference'}
+        self.close_conference(conference_id, session)
+        return {'status': 'ok', 'conference_id': conference_id}
+
+    def mode_info(self, conference_id, session):
+        """:return: dict, the mode of a conference and, in P2P mode, the media endpoints of the other members"""
+        mode = self.modes[conference_id]
+        if mode != 'P2P':
+            return {'mode': mode, 'peers': []}
+        return {'mode': mode, 'peers': [m.p2p_endpoint for m in self.members[conference_id] if m is not session]}
+
+    def update_mode(self, conference_id, changed):
+        """
+        re-evaluate the mode after `changed` joined or left: small conferences whose members all accept direct
+        connections are P2P, the others are relayed by their ConferenceServer. Every other member is told about a
+        new mode or, in P2P mode, about its new set of peers; `changed` gets the mode in its reply
+        """
+        members = self.members[conference_id]
+        if len(members) <= self.p2p_max_members and all(m.p2p_endpoint for m in members):
+            mode = 'P2P'
+        else:
+            mode = 'Client-Server'
+        previous, self.modes[conference_id] = self.modes[conference_id], mode
+        if mode != previous:
+            for worker_id in self.nodes[conference_id]:
+                self.workers[worker_id][1].put(('mode', conference_id, mode))
+        elif mode == 'Client-Server':
+            return  # 一直是服务器转发，成员不需要知道谁进出了
+        for member in members:
+            if member is not changed and not member.closed:
+                member.writer.write(encode_message({'event': 'mode', 'conference_id': conference_id,
+                                                    **self.mode_info(conference_id, member)}))
+
+    def close_conference(self, conference_id, cancelled_by=None):
+        """forget a conference, tell its members (except the one who cancelled it) and stop its ConferenceServers"""
+        self.conference_servers.pop(conference_id)
+        self.managers.pop(conference_id).managed.discard(conference_id)
+        self.modes.pop(conference_id)
+        self.node_sizes.pop(conference_id)
+        event = encode_message({'event': 'cancelled', 'conference_id': conference_id})
+        for member in self.members.pop(conference_id):
+            member.conference_id = None
+            member.node = None
+            if member is not cancelled_by and not member.closed:
+                member.writer.write(event)
+        for worker_id in self.nodes.pop(conference_id):
+            self.workers[worker_id][1].put(('cancel', conference_id))
+
+    def handle_request(self, session, message):
+        """
+        :return: dict, the reply (without id) of a request that can be answered right away, or a coroutine giving
+                 it for requests that wait for a worker (create, a join that cascades the conference)
         """
-        pass
+        op = message.get('op')
+        conference_id = message.get('conference_id')
+        if conference_id is not None and not isinstance(conference_id, int):
+            return {'status': 'error', 'message': 'conference_id must be an integer'}
+        p2p_port = message.get('p2p_port')
+        if p2p_port is not None and op in ('create', 'join'):
+            if not isinstance(p2p_port, int) or not 0 < p2p_port < 65536:
+                return {'status': 'error', 'message': 'p2p_port must be a port number'}
+            # 用控制连接的对端地址，客户端自己看到的地址可能只是本机的
+            session.p2p_endpoint = (session.writer.get_extra_info('peername')[0], p2p_port)
+        if op == 'join':
+            if conference_id is None:
+                return {'status': 'error', 'message': 'join needs a conference_id'}
+            return self.handle_join_conference(session, conference_id)
+        if op == 'quit':
+            return self.handle_quit_conference(session)
+        if op == 'cancel':
+            return self.handle_cancel_conference(session, conference_id)
+        if op == 'create':
+            return self.handle_creat_conference(session)
+        return {'status': 'error', 'message': f'unrecognized request {op}'}
+
+    async def reply_later(self, session, request_id, reply):
+        try:
+            reply = await reply
+        except Exception as e:
+            reply = {'status': 'error', 'message': str(e)}
+        if not session.closed:
+            session.writer.write(encode_message({'id': request_id, **reply}))
 
     async def request_handler(self, reader, writer):
         """
         running task: handle out-meeting (or also in-meeting) requests from clients
+        length-prefixed JSON requests with ids (conf_protocol.py), answered as soon as each is done, so a client can
+        pipeline them; the requests waiting for a worker do not hold up the requests behind them
         """
-        pass
-
-    def handle_client(self, client_socket, addr):
-        print(f"[连接] {addr} 已连接。")
+        session = _Session(writer)
+        tasks = set()  # 还在等worker的请求，连接断开后也让它做完，好把建出来的会议收掉
         try:
             while True:
-                # 接收帧长度
-                raw_length = self.recvall(client_socket, 4)  # 前四个字节通常用来表示后面需要接收的字节数
-                if not raw_length:
-                    print(f"[断开] {addr} 已断开连接。")
+                message = await read_message(reader)
+                if message is None:
                     break
-                frame_length = int.from_bytes(raw_length, byteorder='big')  # 把它转换成一个整数
+                reply = self.handle_request(session, message)
+                if asyncio.iscoroutine(reply):
+                    task = asyncio.create_task(self.reply_later(session, message.get('id'), reply))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+                    continue
+                writer.write(encode_message({'id': message.get('id'), **reply}))
+                # 请求一个接一个到达时不必每个回复都等发送缓冲区，超过高水位才等
+                if writer.transport.get_write_buffer_size() > CONTROL_WRITE_LIMIT:
+                    await writer.drain()
+        except (ConnectionError, asyncio.CancelledError):  # 断开，或者服务器关闭时还连着
+            pass
+        except Exception as e:  # 不合法的消息，告诉客户端原因之后断开
+            writer.write(encode_message({'event': 'error', 'message': str(e)}))
+        finally:
+            session.closed = True
+            if session.conference_id is not None:
+                self.handle_quit_conference(session)
+            for conference_id in list(session.managed):
+                if not self.members[conference_id]:
+                    self.close_conference(conference_id)
+            writer.close()
 
-                frame_data = self.recvall(client_socket, frame_length)
-                if not frame_data:
-                    print(f"[断开] {addr} 已断开连接。")
-                    break
-                """
-                对于服务器来说，其实不需要去分辨数据对应的客户端是谁，直接发给客户端自行去判断就行了
-                客户端就要根据前16字节来判断是哪一个成员，然后找到对应的label去更新它的画面，如果没有的话还要新建一个画面，然后调整整个界面的布局
-                """
-                for c in self.clients:
-                    if c != client_socket:
-                        c.sendall(raw_length + frame_data)  # 然后把这个数据给传回去
-        except Exception as e:
-            print(f"[错误] 处理 {addr} 时出错: {e}")
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.start_workers()
+        self.main_server = await asyncio.start_server(self.request_handler, self.server_ip, self.server_port)
+        print(f'Server listening on port {self.server_port} with {self.num_workers} conference workers')
+        metrics_server = None
+        if self.metrics_port is not None:
+            metrics_server = await try_serve_metrics(self.collect_metrics, METRICS_HOST, self.metrics_port)
+        lag_task = asyncio.create_task(watch_loop_lag(self.metrics))
+        try:
+            async with self.main_server:
+                await self.main_server.serve_forever()
         finally:
-            client_socket.close()
-
-    def recvall(self, conn, n):
-        """接收n个字节的数据"""
-        data = bytearray()
-        while len(data) < n:
-            packet = conn.recv(n - len(data))  # 每次都尝试获取剩下的
-            if not packet:
-                return None
-            data.extend(packet)
-        return data
+            lag_task.cancel()
+            if metrics_server is not None:
+                metrics_server.close()
+            self.stop_workers()
 
-    def start(self):
-        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        server_socket.bind((self.server_ip, MAIN_SERVER_PORT))
-        server_socket.listen(5)
-        print('Server listening on port 8888')
+    def collect_metrics(self):
+        return merge(self.metrics.collect(), *self.worker_metrics.values())
 
+    def start(self):
         try:
-            while True:
-                client_socket, address = server_socket.accept()
-                with self.clients_lock:
-                    self.clients.append(client_socket)
-                print(f"Accept connection from {address}")
-                client_thread = threading.Thread(target=self.handle_client, args=(client_socket, address), daemon=True)
-                client_thread.start()
-        finally:
-            server_socket.close()
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            pass
 
 
 if __name__ == '__main__':
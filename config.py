@@ -6,11 +6,85 @@ HELP = 'Create         : create an conference\n' \
 SERVER_IP = '127.0.0.1'
 MAIN_SERVER_PORT = 8888
 TIMEOUT_SERVER = 5
-# DGRAM_SIZE = 1500  # UDP
+DGRAM_SIZE = 1500  # UDP, packets are split to fit into one datagram of this size
+FRAME_TIMEOUT = 0.5  # seconds before a partially received video frame is discarded
 LOG_INTERVAL = 2
+METRICS_HOST = '127.0.0.1'  # the Prometheus endpoint is only reachable locally by default
+METRICS_PORT = 9108  # MainServer
+RELAY_METRICS_PORT = 9109  # Server1.py
+UDP_METRICS_PORT = 9110  # UDP-server.py
+LOOP_LAG_INTERVAL = 0.1  # seconds between two event loop lag probes
 
 CHUNK = 1024
 CHANNELS = 1  # Channels for audio capture
 RATE = 44100  # Sampling rate for audio capture
 
 camera_width, camera_height = 480, 480  # resolution for camera capture
+
+AUDIO_QUEUE_SIZE = 8  # max pending audio chunks per receiver in the relay
+CONF_WORKERS = 0  # number of ConferenceServer worker processes, 0 means one per CPU core
+HEARTBEAT_INTERVAL = 1  # seconds between worker load reports
+CONTROL_WRITE_LIMIT = 64 << 10  # bytes of unsent control replies before a connection waits for the client
+P2P_MAX_MEMBERS = 3  # conferences up to this size stream directly between the members (P2P mode), 0 turns it off
+CASCADE_NODE_CAPACITY = 0  # members per ConferenceServer before a conference spreads to another worker, 0: one node
+TRUNK_QUEUE_SIZE = 64  # max pending audio chunks on a relay trunk, it carries the audio of all local senders
+
+JITTER_BUFFER_SIZE = 32  # frame slots in the audio jitter buffer
+JITTER_MAX_DEPTH = 8  # max playout depth in frames
+JITTER_FACTOR = 3  # target depth covers this many times the measured jitter
+JITTER_SLACK = 2  # frames above target depth before the oldest are skipped
+CONCEAL_MAX_FRAMES = 3  # missing frames concealed by repeating the last one before going silent
+CONCEAL_FADE = 0.5  # gain applied per concealed frame
+
+PARTICIPANT_TIMEOUT = 10  # seconds without packets before the UDP relay forgets a participant
+UDP_SOCKET_BUFFER = 4 << 20  # SO_RCVBUF/SO_SNDBUF of the relay sockets
+ENCODER_THREADS = 2  # JPEG encoder threads, one per shared stream (screen + camera)
+DECODER_THREADS = 2  # JPEG decoder threads of the Tk clients
+RENDER_FPS = 60  # how often the Tk clients paint the newest decoded frames
+
+SCREEN_TILE_SIZE = 64  # pixels, screen sharing sends only the tiles that changed since the last capture
+SCREEN_REFRESH_INTERVAL = 5  # seconds between full screen refreshes, so receivers recover from lost updates
+SCREEN_FULL_RATIO = 0.5  # above this fraction of dirty tiles the whole screen is sent as one image
+SCREEN_QUALITY = 70  # JPEG quality of screen updates
+SCREEN_QUEUE_SIZE = 16  # max pending screen updates per receiver in the relay, they are deltas and are never
+# skipped: a sender waits while one of its receivers has this many pending
+
+SIMULCAST_LAYERS = (1, 2, 4)  # downscale factor of each simulcast layer, layer 0 is full resolution
+
+FEEDBACK_INTERVAL = 0.5  # seconds between receiver feedback reports per publisher
+RATE_START_BITRATE = 1_500_000  # bits/s, first video bitrate estimate of a sender
+RATE_MIN_BITRATE = 100_000
+RATE_MAX_BITRATE = 8_000_000
+RATE_HOLD_TIME = 1  # seconds between two changes of the video settings
+RATE_OVERUSE_TREND = 0.01  # queueing delay growing faster than 10 ms per second means the path is overused
+RATE_MAX_QUEUE_DELAY = 0.15  # seconds of standing queueing delay that also count as overuse
+RATE_MAX_JITTER = 0.03  # seconds of interarrival jitter above which the frames already spread out, no probing up
+RATE_INCREASE = 1.08  # bitrate estimate increase per FEEDBACK_INTERVAL near the bitrate of the last congestion
+RATE_FAST_INCREASE = 1.25  # increase per FEEDBACK_INTERVAL well above it, the path has become faster
+
+RTCP_INTERVAL = 5  # seconds between RTCP reports of a participant (RFC 3550 minimum)
+
+MIXER_PREBUFFER = 2  # frames queued from a participant before the server-side audio mixer mixes it in
+MIXER_MAX_DEPTH = 4  # frames queued from a participant above which the mixer skips the oldest
+MIXER_SSRC = 0  # SSRC of the mixed audio stream the UDP relay sends in mixing mode
+MIX_AUDIO = False  # servers mix the audio of a conference and send each client one N-1 mix (MCU audio mode)
+
+VAD_THRESHOLD = 9  # dB above the background noise level that count as speech
+VAD_MIN_LEVEL = -55  # dBov, quieter frames are always silence
+VAD_NOISE_ZCR = 0.35  # zero crossings per sample above which a frame close to the threshold is taken as noise
+VAD_HANGOVER = 0.3  # seconds a speech decision is held after the last active frame
+VAD_NOISE_RISE = 1  # dB per second the background noise estimate may rise while the level stays above it
+DTX_KEEPALIVE_INTERVAL = 2  # seconds between keepalives of a participant in DTX, below PARTICIPANT_TIMEOUT
+DTX_LEVEL_CHANGE = 3  # dB the background may change during DTX before a new silence descriptor is sent
+
+FEC_VIDEO_GROUP = 8  # video packets protected by one XOR parity packet, 0 turns video FEC off
+FEC_AUDIO_GROUP = 2  # audio packets per parity packet, small because a recovered frame must beat its playout time
+FEC_HISTORY = 256  # recent media packets per stream a receiver keeps to rebuild a lost one
+FEC_PENDING = 8  # parity packets per stream kept while more than one packet of their group is missing
+
+NACK_HISTORY = 512  # sent packets per stream a sender (and the relay) keeps for retransmission
+NACK_DEADLINE = 0.3  # seconds after which a missing packet is no longer worth asking for (frame playout deadline)
+NACK_REORDER_DELAY = 0.01  # seconds a sequence gap may be reordering before it is NACKed
+NACK_RETRY_INTERVAL = 0.05  # seconds between two NACKs of the same packet, about one RTT
+NACK_MAX_RETRIES = 3
+NACK_MAX_GAP = 128  # a bigger sequence jump is a restart, not a loss
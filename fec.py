@@ -0,0 +1,176 @@
+'''
+XOR parity forward error correction for the UDP media streams, in the spirit of RFC 5109
+After every group of k consecutive packets of a stream the sender adds one parity packet: the media header of the
+protected stream (same stream type, SSRC and layer, so the relays route it like the media) with FLAG_FEC set and its
+own sequence numbers, then FEC_HEADER and the XOR of the group's payloads. A receiver that got all but one packet of
+a group rebuilds the missing one, header included, without waiting for a retransmission.
+Video groups also end with the last packet of a frame, so a lost packet never waits for the next frame to be fixed
+'''
+import struct
+from collections import OrderedDict, deque
+from functools import reduce
+from operator import xor
+
+import numpy as np
+
+from config import *
+from rtp import FLAG_DTX, FLAG_FEC, FLAG_MARKER, MEDIA_HEADER, MediaStream, routing_fields
+
+FEC_PAYLOAD_TYPE = 127
+# sequence number of the first protected packet, number of protected packets, then the XOR of their flags,
+# payload types, payload lengths and timestamps (the header fields that differ between packets of one stream)
+FEC_HEADER = struct.Struct('!HBBBxHI')
+
+
+def xor_payloads(payloads, length):
+    """:return: np.ndarray uint8, the XOR of the bytes-like payloads, each zero-padded or cut to length"""
+    rows = np.zeros((len(payloads), length), dtype=np.uint8)
+    for row, payload in zip(rows, payloads):
+        data = np.frombuffer(payload, dtype=np.uint8)[:length]
+        row[:len(data)] = data
+    return np.bitwise_xor.reduce(rows, axis=0)
+
+
+def parity_packet(stream, packets):
+    """
+    :param stream: MediaStream with payload type FEC_PAYLOAD_TYPE, its sequence numbers are the parity packets' own
+    :param packets: list[bytes], consecutive packets of the protected stream
+    :return: bytes, the parity packet of the group
+    """
+    headers = [MEDIA_HEADER.unpack_from(packet) for packet in packets]
+    lengths = [len(packet) - MEDIA_HEADER.size for packet in packets]
+    fec_header = FEC_HEADER.pack(headers[0][6], len(packets), reduce(xor, (h[1] for h in headers)),
+                                 reduce(xor, (h[2] for h in headers)), reduce(xor, lengths),
+                                 reduce(xor, (h[7] for h in headers)))
+    payloads = [memoryview(packet)[MEDIA_HEADER.size:] for packet in packets]
+    return stream.packet(fec_header + xor_payloads(payloads, max(lengths)).tobytes(), headers[0][7], FLAG_FEC)
+
+
+class FecEncoder:
+    """
+    sender side: one per outgoing stream (simulcast layer), feed every packet of it through protect()
+    """
+
+    def __init__(self, stream, group_size):
+        """
+        :param stream: rtp.MediaStream, the protected stream
+        :param group_size: int, k media packets per parity packet, 0 turns FEC off
+        """
+        self.group_size = group_size
+        self.stream = MediaStream(stream.stream_type, FEC_PAYLOAD_TYPE, stream.conference_id, stream.ssrc,
+                                  stream.layer)
+        self.group = []
+        self.next_seq = None
+
+    def protect(self, packet):
+        """
+        :param packet: bytes, a packet of the protected stream
+        :return: list[bytes], the packet itself, followed by a parity packet when it completes a group
+        """
+        if not self.group_size:
+            return [packet]
+        out = [packet]
+        sequence_number = MEDIA_HEADER.unpack_from(packet)[6]
+        if self.group and sequence_number != self.next_seq:
+            out.append(self.flush())  # 序列号不连续，之前的组先结束
+        self.group.append(packet)
+        self.next_seq = (sequence_number + 1) & 0xFFFF
+        # 一帧（或者一段话）结束时就发校验包，不让丢的包等到下一帧才能恢复；只有一个包的组等下一组
+        if len(self.group) >= self.group_size or (packet[1] & (FLAG_MARKER | FLAG_DTX) and len(self.group) > 1):
+            out.append(self.flush())
+        return out
+
+    def flush(self):
+        """:return: bytes, the parity packet of the packets collected so far, None if there are none"""
+        if not self.group:
+            return None
+        packet = parity_packet(self.stream, self.group)
+        self.group = []
+        return packet
+
+
+class FecDecoder:
+    """
+    receiver side: feed every received packet of the FEC-protected streams through push(), media and parity alike
+    """
+
+    def __init__(self, history=FEC_HISTORY, max_pending=FEC_PENDING):
+        """
+        :param history: int, recent media packets kept per stream to recover from
+        :param max_pending: int, parity packets kept per stream while more than one packet of their group is missing
+        """
+        self.history = history
+        self.max_pending = max_pending
+        self.received = {}  # self.received[(stream_type, conference_id, ssrc, layer)] = OrderedDict seq -> packet
+        self.pending = {}  # self.pending[same key] = deque of parity packets that could not recover anything yet
+        self.recovered = 0
+
+    def push(self, packet):
+        """
+        :param packet: bytes-like, one received packet
+        :return: list[bytes], media packets rebuilt with the help of this packet (the packet itself is not included)
+        """
+        key = routing_fields(packet)
+        if key is None or len(packet) < MEDIA_HEADER.size:
+            return []
+        received = self.received.get(key)
+        if received is None:
+            received = self.received[key] = OrderedDict()
+            self.pending[key] = deque(maxlen=self.max_pending)
+        if packet[1] & FLAG_FEC:
+            if len(packet) < MEDIA_HEADER.size + FEC_HEADER.size:
+                return []
+            recovered = self.recover(key, bytes(packet))
+            if recovered is False:
+                self.pending[key].append(bytes(packet))
+            return [recovered] if recovered else []
+
+        self.store(received, MEDIA_HEADER.unpack_from(packet)[6], bytes(packet))
+        pending = self.pending[key]
+        if not pending:
+            return []
+        out = []
+        for parity in list(pending):
+            recovered = self.recover(key, parity)
+            if recovered is not False:
+                pending.remove(parity)
+                if recovered:
+                    out.append(recovered)
+        return out
+
+    def store(self, received, sequence_number, packet):
+        received[sequence_number] = packet
+        received.move_to_end(sequence_number)
+        while len(received) > self.history:
+            received.popitem(last=False)
+
+    def recover(self, key, parity):
+        """
+        :return: bytes, the rebuilt packet; None if nothing of the group is missing (or it can not be rebuilt);
+                 False if more than one packet is missing, the parity packet may still be useful later
+        """
+        base, count, flags, payload_type, length, timestamp = FEC_HEADER.unpack_from(parity, MEDIA_HEADER.size)
+        received = self.received[key]
+        missing = [s for s in ((base + i) & 0xFFFF for i in range(count)) if s not in received]
+        if not missing:
+            return None
+        if len(missing) > 1:
+            return False
+        others = [received[(base + i) & 0xFFFF] for i in range(count) if (base + i) & 0xFFFF != missing[0]]
+        for packet in others:
+            _, packet_flags, packet_type, _, _, _, _, packet_timestamp = MEDIA_HEADER.unpack_from(packet)
+            flags ^= packet_flags
+            payload_type ^= packet_type
+            length ^= len(packet) - MEDIA_HEADER.size
+            timestamp ^= packet_timestamp
+        offset = MEDIA_HEADER.size + FEC_HEADER.size
+        if length > len(parity) - offset:
+            return None  # 校验包和收到的包对不上
+        payload = xor_payloads([memoryview(parity)[offset:]] + [memoryview(p)[MEDIA_HEADER.size:] for p in others],
+                               length)
+        stream_type, conference_id, ssrc, layer = key
+        packet = MEDIA_HEADER.pack(parity[0], flags, payload_type, layer, conference_id, ssrc, missing[0],
+                                   timestamp) + payload.tobytes()
+        self.store(received, missing[0], packet)
+        self.recovered += 1
+        return packet
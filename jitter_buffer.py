@@ -0,0 +1,230 @@
+'''
+Adaptive jitter buffer for RTP audio
+Frames are stored in a fixed-capacity numpy ring indexed by sequence number, the playout depth follows the
+measured interarrival jitter (RFC 3550 estimator) and missing frames are concealed by repeating the last one
+with a fade. After a silence descriptor of a DTX sender the buffer plays comfort noise until speech resumes.
+JitterMixer keeps one buffer per sender, since sequence numbers and timestamps are per SSRC, and mixes their output
+'''
+import math
+import threading
+import time
+
+import numpy as np
+from config import *
+from vad import MAX_NOISE_LEVEL, comfort_noise
+
+
+class JitterBuffer:
+    def __init__(self, frame_samples, channels=1, clock_rate=RATE, capacity=JITTER_BUFFER_SIZE,
+                 min_depth=1, max_depth=JITTER_MAX_DEPTH):
+        """
+        :param frame_samples: int, samples per channel in one packet (= samples per playback callback)
+        :param clock_rate: int, RTP timestamp units per second
+        :param capacity: int, number of frame slots in the ring
+        """
+        self.frame_len = frame_samples * channels
+        self.frame_duration = frame_samples / clock_rate
+        self.clock_rate = clock_rate
+        self.capacity = capacity
+        self.min_depth = min_depth
+        self.max_depth = min(max_depth, capacity - 1)
+        self.frames = np.zeros((capacity, self.frame_len), dtype=np.int16)
+        self.slot_seq = np.full(capacity, -1, dtype=np.int64)  # extended sequence number stored in each slot
+        self.slot_level = np.full(capacity, -1, dtype=np.int16)  # comfort noise level if the slot holds a SID
+        self.noise_level = None  # -dBov, set while the sender is in DTX
+        self.rng = np.random.default_rng()
+        self.lock = threading.Lock()
+
+        self.highest = None  # highest extended sequence number received
+        self.play_seq = None  # next extended sequence number to play
+        self.buffering = True  # wait until target_depth frames are queued before playing
+        self.target_depth = min_depth
+        self.jitter = 0.0  # seconds
+        self.last_transit = None
+        self.last_good_seq = None
+        self.concealed_run = 0
+
+        self.late = 0
+        self.lost = 0
+        self.skipped = 0
+
+    def extend(self, sequence_number):
+        """map a 16-bit sequence number to an extended one close to the highest seen so far"""
+        if self.highest is None:
+            return sequence_number
+        candidate = (self.highest & ~0xFFFF) | sequence_number
+        if candidate - self.highest > 0x8000:
+            candidate -= 0x10000
+        elif self.highest - candidate > 0x8000:
+            candidate += 0x10000
+        return candidate
+
+    def update_jitter(self, timestamp, arrival):
+        transit = arrival - timestamp / self.clock_rate
+        if self.last_transit is not None:
+            self.jitter += (abs(transit - self.last_transit) - self.jitter) / 16
+        self.last_transit = transit
+        depth = math.ceil(JITTER_FACTOR * self.jitter / self.frame_duration) + 1
+        self.target_depth = max(self.min_depth, min(self.max_depth, depth))
+
+    def push(self, sequence_number, timestamp, payload, arrival=None):
+        """
+        store one received frame
+
+        :param payload: bytes-like, 16-bit PCM of one frame
+        """
+        samples = np.frombuffer(payload, dtype=np.int16)
+        with self.lock:
+            slot = self.claim(sequence_number, timestamp, arrival)
+            if slot is None:
+                return
+            n = min(len(samples), self.frame_len)
+            self.frames[slot, :n] = samples[:n]
+            self.frames[slot, n:] = 0
+            self.slot_level[slot] = -1
+
+    def push_silence(self, sequence_number, timestamp, level, arrival=None):
+        """
+        store a silence descriptor (FLAG_DTX packet): from its playout on, comfort noise is played until speech
+
+        :param level: int, comfort noise level in -dBov
+        """
+        with self.lock:
+            slot = self.claim(sequence_number, timestamp, arrival)
+            if slot is not None:
+                self.slot_level[slot] = level
+
+    def claim(self, sequence_number, timestamp, arrival):
+        """:return: int, the slot of a received packet, None if it came too late. Call with the lock held"""
+        arrival = time.monotonic() if arrival is None else arrival
+        seq = self.extend(sequence_number)
+        self.update_jitter(timestamp, arrival)
+        if self.play_seq is None:
+            self.play_seq = seq
+        if seq < self.play_seq:
+            self.late += 1  # its playout time has already passed
+            return None
+        if seq - self.play_seq >= self.capacity:
+            # 跳得太远，说明中间丢了一大段或者对端重启了，直接重新同步
+            self.skipped += seq - self.play_seq
+            self.play_seq = seq
+            self.buffering = True
+        if self.highest is None or seq > self.highest:
+            self.highest = seq
+        slot = seq % self.capacity
+        self.slot_seq[slot] = seq
+        return slot
+
+    def depth(self):
+        if self.highest is None:
+            return 0
+        return self.highest - self.play_seq + 1
+
+    def pop_into(self, out):
+        """
+        write the next frame into the playback buffer (e.g. the outdata of a sounddevice callback)
+
+        :param out: np.ndarray of int16 with frame_samples * channels elements
+        """
+        flat = out.reshape(-1)
+        with self.lock:
+            depth = self.depth()
+            if self.buffering:
+                if depth < self.target_depth:
+                    self.silence(flat)
+                    return
+                self.buffering = False
+            if depth > self.target_depth + JITTER_SLACK:
+                # 积压太多会增加延迟，丢掉最老的帧回到目标深度
+                skip = depth - self.target_depth
+                self.skipped += skip
+                self.play_seq += skip
+
+            n = min(len(flat), self.frame_len)
+            slot = self.play_seq % self.capacity
+            if self.slot_seq[slot] == self.play_seq and self.slot_level[slot] >= 0:
+                self.noise_level = int(self.slot_level[slot])
+                self.silence(flat[:n])
+                self.concealed_run = 0
+            elif self.slot_seq[slot] == self.play_seq:
+                flat[:n] = self.frames[slot, :n]
+                self.last_good_seq = self.play_seq
+                self.concealed_run = 0
+                self.noise_level = None
+            else:
+                self.lost += 1
+                self.conceal(flat[:n])
+            flat[n:] = 0
+
+            self.play_seq += 1
+            if self.play_seq > self.highest:
+                self.buffering = True
+
+    def conceal(self, out):
+        """repeat the last good frame with a fade, then fall back to silence"""
+        self.concealed_run += 1
+        last = self.last_good_seq
+        if self.noise_level is not None or last is None or self.concealed_run > CONCEAL_MAX_FRAMES or \
+                self.slot_seq[last % self.capacity] != last:
+            self.silence(out)
+            return
+        gain = CONCEAL_FADE ** self.concealed_run
+        np.multiply(self.frames[last % self.capacity, :len(out)], gain, out=out, casting='unsafe')
+
+    def silence(self, out):
+        """comfort noise while the sender is in DTX, digital silence otherwise"""
+        comfort_noise(out, MAX_NOISE_LEVEL if self.noise_level is None else self.noise_level, self.rng)
+
+
+class JitterMixer:
+    """
+    one JitterBuffer per sender (SSRC): created on its first packet and dropped after idle_timeout without packets;
+    every playback period the next frame of each sender is mixed into the output
+    """
+
+    def __init__(self, frame_samples, channels=1, clock_rate=RATE, idle_timeout=PARTICIPANT_TIMEOUT):
+        self.frame_samples = frame_samples
+        self.channels = channels
+        self.clock_rate = clock_rate
+        self.idle_timeout = idle_timeout
+        self.buffers = {}  # self.buffers[ssrc] = JitterBuffer
+        self.last_heard = {}  # self.last_heard[ssrc] = time.monotonic() of the last packet
+        self.lock = threading.Lock()
+        self.mix = np.zeros(frame_samples * channels, dtype=np.int32)
+        self.frame = np.zeros(frame_samples * channels, dtype=np.int16)
+
+    def buffer(self, ssrc, arrival=None):
+        """:return: JitterBuffer of the sender, push its packets into it"""
+        with self.lock:
+            self.last_heard[ssrc] = time.monotonic() if arrival is None else arrival
+            buffer = self.buffers.get(ssrc)
+            if buffer is None:
+                buffer = self.buffers[ssrc] = JitterBuffer(self.frame_samples, self.channels, self.clock_rate)
+            return buffer
+
+    def drop_idle(self, now=None):
+        """forget the senders that have left"""
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            for ssrc in [ssrc for ssrc, heard in self.last_heard.items() if now - heard > self.idle_timeout]:
+                del self.last_heard[ssrc]
+                del self.buffers[ssrc]
+
+    def pop_into(self, out, now=None):
+        """
+        write the mix of the next frame of every sender into the playback buffer, silence when nobody sends
+
+        :param out: np.ndarray of int16 with frame_samples * channels elements
+        """
+        self.drop_idle(now)
+        with self.lock:
+            buffers = list(self.buffers.values())
+        if len(buffers) == 1:
+            buffers[0].pop_into(out)  # 只有一个人说话时不用混音
+            return
+        self.mix.fill(0)
+        for buffer in buffers:
+            buffer.pop_into(self.frame)
+            self.mix += self.frame
+        np.clip(self.mix, -32768, 32767, out=self.mix)
+        out.reshape(-1)[:] = self.mix
@@ -0,0 +1,450 @@
+'''
+Headless load generator: N synthetic participants against the TCP conference servers (MainServer ->
+ConferenceServer data ports, 4-byte length prefix) or the UDP relay (UDP-server.py / Server1.py, media header)
+Every participant sends one pre-encoded JPEG at the given fps and one PCM chunk (CHUNK samples at RATE) per audio
+period, and counts what the server forwards to it. Send times travel in the packets themselves (the media header
+timestamp in microseconds, or a trailer after the JPEG EOI / PCM chunk on TCP), so the forwarding latency is
+measured per delivered packet; clients and server must run on the same host.
+By default the server is started in its own process so its CPU time can be measured (Linux /proc), pass --port to
+load an already running server instead (and --server-pid to still get its CPU time).
+
+usage: python load_gen.py {tcp,udp} [--clients 16] [--conferences 1] [--processes 2] [--fps 15] [--duration 10]
+'''
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import signal
+import socket
+import struct
+import time
+
+import cv2
+import numpy as np
+
+from audio_codec import PAYLOAD_L16
+from conf_protocol import encode_message
+from config import *
+from rtp import (CONTROL_KEEPALIVE, MEDIA_HEADER, STREAM_AUDIO, STREAM_CAMERA, STREAM_CONTROL, MediaStream,
+                 packetize_jpeg)
+from util import encode_frame
+
+STREAMS = {STREAM_CAMERA: 'video', STREAM_AUDIO: 'audio'}
+TRAILER = struct.Struct('!QI')  # TCP frames: send time in microseconds, sender index
+LATENCY_BIN = 10  # microseconds per latency histogram bin
+LATENCY_BINS = 200000  # up to 2 s, later packets land in the last bin
+DRAIN_TIME = 1.0  # seconds the receivers keep listening after the senders stopped
+
+
+def synthetic_jpeg(width, height, quality):
+    """a detailed frame (smoothly upscaled noise) so the JPEG has a realistic size"""
+    noise = np.random.default_rng(0).integers(0, 255, (max(1, height // 8), max(1, width // 8), 3), dtype=np.uint8)
+    return bytes(encode_frame(cv2.resize(noise, (width, height), interpolation=cv2.INTER_CUBIC), quality))
+
+
+def free_port(kind):
+    with socket.socket(socket.AF_INET, kind) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def process_tree_cpu(pid):
+    """:return: float, user + system CPU seconds of a process and all its descendants, None if /proc is missing"""
+    try:
+        ticks = os.sysconf('SC_CLK_TCK')
+        parents, cpu = {}, {}
+        for entry in os.listdir('/proc'):
+            if not entry.isdigit():
+                continue
+            try:
+                with open(f'/proc/{entry}/stat') as f:
+                    fields = f.read().rsplit(')', 1)[1].split()
+            except OSError:
+                continue  # 进程刚好退出
+            parents.setdefault(int(fields[1]), []).append(int(entry))
+            cpu[int(entry)] = int(fields[11]) + int(fields[12])
+    except (OSError, ValueError, AttributeError):
+        return None
+    if pid not in cpu:
+        return None
+    total, stack = 0, [pid]
+    while stack:
+        p = stack.pop()
+        total += cpu.get(p, 0)
+        stack.extend(parents.get(p, ()))
+    return total / ticks
+
+
+def serve_tcp(host, port, workers):
+    from conf_server import MainServer
+    MainServer(host, port, workers).start()
+
+
+def serve_udp(host, port, echo):
+    from udp_relay import start_relay
+
+    async def main():
+        transport, relay = await start_relay(host, port, echo=echo)
+        try:
+            await asyncio.Event().wait()
+        finally:
+            transport.close()
+
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
+
+
+def stop_server(process):
+    # SIGINT让服务器走正常的退出流程（MainServer会停掉它的worker进程）
+    if os.name == 'posix':
+        os.kill(process.pid, signal.SIGINT)
+    else:
+        process.terminate()
+    process.join(TIMEOUT_SERVER)
+    if process.is_alive():
+        process.terminate()
+        process.join()
+
+
+def wait_listening(host, port, timeout=TIMEOUT_SERVER):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection((host, port), timeout=1).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise Exception(f'server {host}:{port} did not come up')
+            time.sleep(0.05)
+
+
+def create_conferences(host, port, count):
+    """
+    :return: (list of conference infos returned by MainServer for 'create', list of the managers' control sockets),
+             the conferences end when their manager disconnects, so keep the sockets open while they are used
+    """
+    infos, managers = [], []
+    for _ in range(count):
+        sock = socket.create_connection((host, port), timeout=TIMEOUT_SERVER)
+        managers.append(sock)
+        sock.sendall(encode_message({'id': 1, 'op': 'create'}))
+        reader = sock.makefile('rb')
+        reply = json.loads(reader.read(int.from_bytes(reader.read(4), byteorder='big')))
+        if reply.get('status') != 'ok':
+            raise Exception(f'create conference failed: {reply}')
+        infos.append(reply)
+    return infos, managers
+
+
+class LoadStats:
+    """counters of one client process, merged by the main process"""
+
+    def __init__(self, epoch):
+        self.epoch = epoch
+        self.sent = {}  # self.sent[(conference, stream type)] = [packets or frames, bytes]
+        self.received = {}  # same for what the clients got back
+        self.latency = {stream_type: np.zeros(LATENCY_BINS + 1, dtype=np.int64) for stream_type in STREAMS}
+        self.late_ticks = 0  # sender ticks skipped because this process could not keep up
+        self.cpu = 0.0  # CPU seconds this process spent while sending and draining
+
+    def now(self):
+        """:return: int, microseconds since the common epoch of all processes"""
+        return (time.perf_counter_ns() - self.epoch) // 1000
+
+    def on_sent(self, conference, stream_type, nbytes, units=1):
+        counter = self.sent.setdefault((conference, stream_type), [0, 0])
+        counter[0] += units
+        counter[1] += nbytes
+
+    def on_received(self, conference, stream_type, nbytes, latency):
+        counter = self.received.setdefault((conference, stream_type), [0, 0])
+        counter[0] += 1
+        counter[1] += nbytes
+        self.latency[stream_type][min(max(0, latency) // LATENCY_BIN, LATENCY_BINS)] += 1
+
+    def result(self):
+        return {'sent': self.sent, 'received': self.received, 'latency': self.latency, 'late_ticks': self.late_ticks,
+                'cpu': self.cpu}
+
+
+async def paced(period, duration, stats, send):
+    """call the coroutine function send() every period seconds, skipping ticks rather than bursting to catch up"""
+    loop = asyncio.get_running_loop()
+    start = loop.time() + random.random() * period  # 各个客户端错开发送时刻，不要所有人同时发
+    end = loop.time() + duration
+    tick = 0
+    while start + tick * period < end:
+        delay = start + tick * period - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        elif delay < -period:
+            skipped = int(-delay / period)
+            stats.late_ticks += skipped
+            tick += skipped
+        await send()
+        tick += 1
+
+
+class _UdpClient(asyncio.DatagramProtocol):
+    def __init__(self, stats, conference, ssrc, conference_id):
+        self.stats = stats
+        self.conference = conference
+        self.video = MediaStream(STREAM_CAMERA, 26, conference_id, ssrc)
+        self.audio = MediaStream(STREAM_AUDIO, PAYLOAD_L16, conference_id, ssrc)
+        self.keepalive = MediaStream(STREAM_CONTROL, CONTROL_KEEPALIVE, conference_id, ssrc)
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        if len(data) < MEDIA_HEADER.size or data[0] & 0x0F not in STREAMS:
+            return
+        timestamp = MEDIA_HEADER.unpack_from(data)[7]
+        latency = (self.stats.now() - timestamp) & 0xFFFFFFFF
+        self.stats.on_received(self.conference, data[0] & 0x0F, len(data), latency)
+
+    def error_received(self, exc):
+        pass
+
+
+async def run_udp_client(settings, stats, conference, index, address, jpeg, pcm, connected, started):
+    loop = asyncio.get_running_loop()
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, UDP_SOCKET_BUFFER)
+    sock.connect(address)
+    transport, client = await loop.create_datagram_endpoint(
+        lambda: _UdpClient(stats, conference, 1000 + index, conference + 1), sock=sock)
+    transport.sendto(client.keepalive.packet(b'', 0))  # 先让中继记住自己
+    connected.put_nowait(index)
+    await started.wait()
+
+    async def send_video():
+        packets = packetize_jpeg(jpeg, client.video, stats.now() & 0xFFFFFFFF, settings.width, settings.height)
+        for packet in packets:
+            transport.sendto(packet)
+        stats.on_sent(conference, STREAM_CAMERA, sum(map(len, packets)), len(packets))
+
+    async def send_audio():
+        packet = client.audio.packet(pcm, stats.now() & 0xFFFFFFFF)
+        transport.sendto(packet)
+        stats.on_sent(conference, STREAM_AUDIO, len(packet))
+
+    await asyncio.gather(*senders(settings, stats, send_video, send_audio))
+    await asyncio.sleep(DRAIN_TIME)
+    transport.close()
+
+
+async def run_tcp_client(settings, stats, conference, index, info, jpeg, pcm, connected, started):
+    connections = {}
+    for stream_type, data_type in ((STREAM_CAMERA, 'camera'), (STREAM_AUDIO, 'audio')):
+        connections[stream_type] = await asyncio.open_connection(info['host'], info['data_ports'][data_type])
+
+    async def receive(stream_type, reader):
+        try:
+            while True:
+                header = await reader.readexactly(8)  # 长度 + 发送者的来源号
+                length = int.from_bytes(header[:4], byteorder='big')
+                frame = await reader.readexactly(length)
+                if length >= TRAILER.size:
+                    sent_at, _ = TRAILER.unpack_from(frame, length - TRAILER.size)
+                    stats.on_received(conference, stream_type, length + 8, stats.now() - sent_at)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+
+    receivers = [asyncio.create_task(receive(stream_type, reader)) for stream_type, (reader, _) in
+                 connections.items()]
+    connected.put_nowait(index)
+    await started.wait()
+
+    def sender(stream_type, payload):
+        writer = connections[stream_type][1]
+
+        async def send():
+            trailer = TRAILER.pack(stats.now(), index)
+            writer.write((len(payload) + len(trailer)).to_bytes(4, byteorder='big'))
+            writer.write(payload)
+            writer.write(trailer)
+            await writer.drain()
+            stats.on_sent(conference, stream_type, 4 + len(payload) + len(trailer))
+        return send
+
+    await asyncio.gather(*senders(settings, stats, sender(STREAM_CAMERA, jpeg), sender(STREAM_AUDIO, pcm)))
+    await asyncio.sleep(DRAIN_TIME)
+    for task in receivers:
+        task.cancel()
+    for _, writer in connections.values():
+        writer.close()
+
+
+def senders(settings, stats, send_video, send_audio):
+    coroutines = []
+    if settings.fps > 0:
+        coroutines.append(paced(1 / settings.fps, settings.duration, stats, send_video))
+    if not settings.no_audio:
+        coroutines.append(paced(CHUNK / RATE, settings.duration, stats, send_audio))
+    return coroutines
+
+
+def client_process(settings, clients, epoch, ready, go, result_queue):
+    """
+    worker process: run some of the synthetic participants on one event loop
+    :param clients: list of (participant index, conference index, conference info or relay address)
+    """
+    result_queue.put(asyncio.run(_client_process(settings, clients, epoch, ready, go)))
+
+
+async def _client_process(settings, clients, epoch, ready, go):
+    loop = asyncio.get_running_loop()
+    stats = LoadStats(epoch)
+    jpeg = synthetic_jpeg(settings.width, settings.height, settings.quality)
+    pcm = (np.random.default_rng(1).standard_normal(CHUNK * CHANNELS) * 1000).astype(np.int16).tobytes()
+    connected, started = asyncio.Queue(), asyncio.Event()
+    run = run_tcp_client if settings.target == 'tcp' else run_udp_client
+    tasks = [asyncio.create_task(run(settings, stats, conference, index, info, jpeg, pcm, connected, started))
+             for index, conference, info in clients]
+    for _ in tasks:
+        await connected.get()  # 所有连接都建立好再一起开始发
+    await loop.run_in_executor(None, ready.wait)
+    await loop.run_in_executor(None, go.wait)
+    started.set()
+    cpu = time.process_time()
+    await asyncio.gather(*tasks)
+    stats.cpu = time.process_time() - cpu
+    return stats.result()
+
+
+def percentile(histogram, q):
+    """:return: float, milliseconds"""
+    total = histogram.sum()
+    if not total:
+        return float('nan')
+    return float(np.searchsorted(np.cumsum(histogram), q * total)) * LATENCY_BIN / 1000
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='headless load generator for the conference servers')
+    parser.add_argument('target', choices=['tcp', 'udp'], help='MainServer/ConferenceServer or the UDP relay')
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--conferences', type=int, default=1, help='participants are spread round-robin')
+    parser.add_argument('--processes', type=int, default=1, help='client processes')
+    parser.add_argument('--duration', type=float, default=10, help='seconds of sending')
+    parser.add_argument('--fps', type=float, default=15, help='video frames per second per client, 0 = no video')
+    parser.add_argument('--width', type=int, default=640)
+    parser.add_argument('--height', type=int, default=480)
+    parser.add_argument('--quality', type=int, default=75)
+    parser.add_argument('--no-audio', action='store_true')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=0, help='load a running server instead of starting one')
+    parser.add_argument('--server-pid', type=int, default=0, help='pid of that server, for its CPU time')
+    parser.add_argument('--workers', type=int, default=1, help='MainServer conference workers of a started server')
+    parser.add_argument('--echo', action='store_true', help='the UDP relay also sends packets back to the sender')
+    parser.add_argument('--json', action='store_true', help='print the results as one JSON object')
+    return parser.parse_args()
+
+
+def main():
+    settings = parse_args()
+    server = None
+    port = settings.port
+    if not port:
+        if settings.target == 'tcp':
+            port = free_port(socket.SOCK_STREAM)
+            server = multiprocessing.Process(target=serve_tcp, args=(settings.host, port, settings.workers))
+        else:
+            port = free_port(socket.SOCK_DGRAM)
+            server = multiprocessing.Process(target=serve_udp, args=(settings.host, port, settings.echo))
+        server.start()
+        time.sleep(0.5)
+    server_pid = server.pid if server is not None else settings.server_pid
+    managers = []
+
+    try:
+        if settings.target == 'tcp':
+            wait_listening(settings.host, port)
+            endpoints, managers = create_conferences(settings.host, port, settings.conferences)
+        else:
+            endpoints = [(settings.host, port)] * settings.conferences
+        clients = [(i, i % settings.conferences, endpoints[i % settings.conferences]) for i in range(settings.clients)]
+        members = [sum(1 for c in clients if c[1] == conf) for conf in range(settings.conferences)]
+
+        epoch = time.perf_counter_ns()
+        ready = multiprocessing.Barrier(settings.processes + 1)
+        go = multiprocessing.Event()
+        result_queue = multiprocessing.Queue()
+        processes = [multiprocessing.Process(target=client_process, daemon=True,
+                                             args=(settings, clients[p::settings.processes], epoch, ready, go,
+                                                   result_queue))
+                     for p in range(settings.processes)]
+        for process in processes:
+            process.start()
+        ready.wait()
+        cpu_start = process_tree_cpu(server_pid) if server_pid else None
+        go.set()
+        time.sleep(settings.duration)
+        cpu_end = process_tree_cpu(server_pid) if server_pid else None
+        results = [result_queue.get() for _ in processes]
+        for process in processes:
+            process.join()
+    finally:
+        for sock in managers:
+            sock.close()
+        if server is not None:
+            stop_server(server)
+
+    report = {'target': settings.target, 'clients': settings.clients, 'conferences': settings.conferences,
+              'duration': settings.duration, 'fps': settings.fps, 'streams': {},
+              'late_ticks': sum(r['late_ticks'] for r in results),
+              'client_cpu': sum(r['cpu'] for r in results) / (settings.duration + DRAIN_TIME)}
+    fan_out = [m - 1 + (settings.echo and settings.target == 'udp') for m in members]
+    for stream_type, name in STREAMS.items():
+        sent = sum(r['sent'].get((conf, stream_type), [0, 0])[0] * fan_out[conf]
+                   for r in results for conf in range(settings.conferences))
+        received = [r['received'].get((conf, stream_type), [0, 0]) for r in results
+                    for conf in range(settings.conferences)]
+        delivered, delivered_bytes = sum(c[0] for c in received), sum(c[1] for c in received)
+        ingress = sum(r['sent'].get((conf, stream_type), [0, 0])[1] for r in results
+                      for conf in range(settings.conferences))
+        if not sent and not delivered:
+            continue
+        histogram = sum(r['latency'][stream_type] for r in results)
+        report['streams'][name] = {
+            'expected': sent, 'delivered': delivered,
+            'drop_rate': max(0.0, 1 - delivered / sent) if sent else 0.0,
+            'in_mbps': 8 * ingress / settings.duration / 1e6,
+            'out_mbps': 8 * delivered_bytes / settings.duration / 1e6,
+            'out_per_second': delivered / settings.duration,
+            'p50_ms': percentile(histogram, 0.5), 'p99_ms': percentile(histogram, 0.99)}
+    if cpu_start is not None and cpu_end is not None:
+        cpu = (cpu_end - cpu_start) / settings.duration
+        report['server_cpu'] = cpu
+        report['server_cpu_per_client'] = cpu / settings.clients
+
+    if settings.json:
+        print(json.dumps(report))
+        return
+    unit = 'packets' if settings.target == 'udp' else 'frames'
+    print(f'{settings.target}: {settings.clients} clients in {settings.conferences} conference(s), '
+          f'{settings.fps:g} fps {settings.width}x{settings.height} video, '
+          f'{"no" if settings.no_audio else f"{RATE / CHUNK:.1f}/s"} audio, {settings.duration:g}s')
+    for name, s in report['streams'].items():
+        print(f'  {name}: {s["out_per_second"]:9.0f} {unit}/s out, {s["in_mbps"]:7.1f} Mbit/s in, '
+              f'{s["out_mbps"]:7.1f} Mbit/s out, drop {100 * s["drop_rate"]:5.2f}%, '
+              f'latency p50 {s["p50_ms"]:.2f} ms p99 {s["p99_ms"]:.2f} ms')
+    if 'server_cpu' in report:
+        print(f'  server CPU {100 * report["server_cpu"]:.1f}% of a core, '
+              f'{100 * report["server_cpu_per_client"]:.2f}% per client')
+    print(f'  client processes CPU {100 * report["client_cpu"]:.1f}% of a core')
+    if report['late_ticks']:
+        print(f'  warning: the client processes skipped {report["late_ticks"]} send ticks, add --processes')
+    if report['client_cpu'] + report.get('server_cpu', 0) > 0.75 * (os.cpu_count() or 1):
+        print('  warning: clients and server use most of the CPU of this host, drops and latency are not the server\'s '
+              'alone')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,230 @@
+'''
+Low-overhead server metrics in the Prometheus text format
+Hot paths only bump plain attributes or cached counter objects; everything that can be read off existing state
+(queue depths, per-subscriber counters) is collected by callbacks when the endpoint is scraped.
+MainServer merges the snapshots its conference workers send with their heartbeats, the UDP servers serve their own
+registry. Also a rate-limited print for messages that could otherwise be printed once per packet
+'''
+import asyncio
+import math
+import time
+from bisect import bisect_left
+
+from config import *
+
+# seconds, for fan-out latency and event loop lag
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+
+class Counter:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def set(self, value):
+        self.value = value
+
+    def samples(self, name):
+        return [(name, (), self.value)]
+
+
+class Histogram:
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self, name):
+        samples, cumulative = [], 0
+        for bound, count in zip(self.bounds, self.counts):
+            cumulative += count
+            samples.append((name + '_bucket', (('le', repr(float(bound))),), cumulative))
+        samples.append((name + '_bucket', (('le', '+Inf'),), self.count))
+        samples.append((name + '_sum', (), self.sum))
+        samples.append((name + '_count', (), self.count))
+        return samples
+
+    def quantile(self, q):
+        """:return: float, upper bound of the bucket holding the q-quantile, nan without observations"""
+        if not self.count:
+            return math.nan
+        rank, cumulative = q * self.count, 0
+        for bound, count in zip(self.bounds, self.counts):
+            cumulative += count
+            if cumulative >= rank:
+                return bound
+        return math.inf
+
+
+class MetricFamily:
+    def __init__(self, name, kind, help_text, labelnames=(), factory=Counter):
+        self.name = name
+        self.kind = kind  # 'counter', 'gauge' or 'histogram'
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self.factory = factory
+        self.children = {}  # self.children[label values] = Counter / Histogram
+        self.callbacks = []  # functions returning [(label values, value)] at collection time
+
+    def labels(self, *values):
+        """:return: the child for these label values, keep it around on hot paths"""
+        child = self.children.get(values)
+        if child is None:
+            child = self.children[values] = self.factory()
+        return child
+
+    def remove(self, *values):
+        self.children.pop(values, None)
+
+    def collect(self, const_labels=()):
+        samples = []
+        for values, child in self.children.items():
+            labels = const_labels + tuple(zip(self.labelnames, map(str, values)))
+            samples.extend((name, labels + extra, value) for name, extra, value in child.samples(self.name))
+        for callback in self.callbacks:
+            for values, value in callback():
+                samples.append((self.name, const_labels + tuple(zip(self.labelnames, map(str, values))), value))
+        return samples
+
+
+class MetricsRegistry:
+    def __init__(self, const_labels=None):
+        """
+        :param const_labels: dict, labels added to every sample (e.g. the worker id)
+        """
+        self.const_labels = tuple((key, str(value)) for key, value in (const_labels or {}).items())
+        self.families = {}
+
+    def family(self, name, kind, help_text, labelnames=(), factory=Counter):
+        """:return: MetricFamily, the existing one if the name is registered already"""
+        family = self.families.get(name)
+        if family is None:
+            family = self.families[name] = MetricFamily(name, kind, help_text, labelnames, factory)
+        return family
+
+    def counter(self, name, help_text, labelnames=()):
+        return self.family(name, 'counter', help_text, labelnames)
+
+    def gauge(self, name, help_text, labelnames=()):
+        return self.family(name, 'gauge', help_text, labelnames)
+
+    def histogram(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self.family(name, 'histogram', help_text, labelnames, lambda: Histogram(buckets))
+
+    def callback(self, name, kind, help_text, labelnames, function):
+        """
+        :param function: callable returning [(label values, value)], called at every collection
+        """
+        self.family(name, kind, help_text, labelnames).callbacks.append(function)
+
+    def remove_callbacks(self, functions):
+        for family in self.families.values():
+            family.callbacks = [f for f in family.callbacks if f not in functions]
+
+    def collect(self):
+        """:return: list of (name, kind, help, samples), plain tuples that can be pickled to another process"""
+        return [(family.name, family.kind, family.help, family.collect(self.const_labels))
+                for family in self.families.values()]
+
+
+def merge(*snapshots):
+    """merge several collect() results, samples of families with the same name are concatenated"""
+    families = {}
+    for snapshot in snapshots:
+        for name, kind, help_text, samples in snapshot:
+            if name in families:
+                families[name][3].extend(samples)
+            else:
+                families[name] = (name, kind, help_text, list(samples))
+    return list(families.values())
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def render(snapshot):
+    """:return: str, the Prometheus text exposition format (version 0.0.4)"""
+    lines = []
+    for name, kind, help_text, samples in snapshot:
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {kind}')
+        for sample_name, labels, value in samples:
+            label_text = ','.join(f'{key}="{_escape(label)}"' for key, label in labels)
+            lines.append(f'{sample_name}{{{label_text}}} {value}' if labels else f'{sample_name} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+async def serve_metrics(collect, host=METRICS_HOST, port=METRICS_PORT):
+    """
+    minimal HTTP endpoint answering every GET with the current metrics
+    :param collect: callable returning a collect()/merge() snapshot
+    :return: asyncio.Server
+    """
+    async def handle(reader, writer):
+        try:
+            await reader.readuntil(b'\r\n\r\n')
+            body = render(collect()).encode()
+            writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                         b'Content-Length: %d\r\nConnection: close\r\n\r\n' % len(body) + body)
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port)
+
+
+async def try_serve_metrics(collect, host=METRICS_HOST, port=METRICS_PORT):
+    """
+    serve_metrics, but a port that is taken (e.g. by another server on this host) only costs the metrics
+    :return: asyncio.Server, None if the endpoint could not be opened
+    """
+    try:
+        return await serve_metrics(collect, host, port)
+    except OSError as e:
+        print(f'Metrics endpoint {host}:{port} not available: {e}')
+        return None
+
+
+async def watch_loop_lag(registry, interval=LOOP_LAG_INTERVAL):
+    """
+    running task: how much later than asked a sleep wakes up, i.e. how long callbacks block the event loop
+    """
+    histogram = registry.histogram('event_loop_lag_seconds', 'delay of timer callbacks in the event loop').labels()
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        histogram.observe(max(0.0, loop.time() - start - interval))
+
+
+class RateLimitedLog:
+    """print at most one message per key and interval, and how many were left out in between"""
+
+    def __init__(self, interval=LOG_INTERVAL):
+        self.interval = interval
+        self.last = {}
+        self.suppressed = {}
+
+    def __call__(self, key, message):
+        now = time.monotonic()
+        if now - self.last.get(key, -math.inf) < self.interval:
+            self.suppressed[key] = self.suppressed.get(key, 0) + 1
+            return
+        self.last[key] = now
+        suppressed = self.suppressed.pop(key, 0)
+        print(message + (f' ({suppressed} more like this)' if suppressed else ''))
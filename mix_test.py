@@ -1,7 +1,6 @@
 import socket
 import threading
 import time
-import zlib
 from io import BytesIO
 
 import cv2
@@ -9,14 +8,29 @@ import numpy as np
 import pyaudio
 from PIL import Image
 
+import audio_codec
+from audio_codec import PAYLOAD_IMA_ADPCM
+from config import FEC_AUDIO_GROUP, FEC_VIDEO_GROUP, PARTICIPANT_TIMEOUT
+from fec import FecDecoder, FecEncoder
+from jitter_buffer import JitterMixer
+from nack import NackGenerator, PacketHistory
+from rtp import (CONTROL_NACK, FLAG_DTX, FLAG_FEC, MEDIA_HEADER, STREAM_AUDIO, STREAM_CAMERA, STREAM_CONTROL,
+                 FrameAssembler, MediaStream, parse_header)
+from simulcast import SimulcastEncoder, choose_layer, control_stream, layer_request
+from vad import DtxSender
+
+VIDEO_PAYLOAD_TYPE = 26  # JPEG
+AUDIO_PAYLOAD_TYPE = PAYLOAD_IMA_ADPCM  # zlib压缩PCM几乎没有效果，换成ADPCM
+
 """
 这个实现的是从客户端接收数据然后传给服务器，服务器再回传给客户端，客户端把接收到的数据展示出来
-但是这个版本现在只支持1对1，因为没有给udp传输包里面加上tag，无法区分是哪一个客户端发过来
+每个udp包都带上统一的媒体包头部（会议号、参与者SSRC、流类型、序列号、时间戳），所以服务器可以按会议转发，客户端可以区分多个发送者
 """
 class VideoAudioClient:
-    def __init__(self, server_ip, server_port):
+    def __init__(self, server_ip, server_port, conference_id=0):
         self.server_ip = server_ip
         self.server_port = server_port
+        self.conference_id = conference_id
         self.cap = None
         self.is_camera_on = False
         self.is_audio_on = False
@@ -24,6 +38,25 @@ class VideoAudioClient:
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.sock.connect((self.server_ip, self.server_port))  # 可以不用connect，不过每次发送都要附带地址比较麻烦
         self.is_running = True
+        # 同一个参与者的音视频共用一个SSRC，用流类型区分；视频同时发全尺寸、1/2和1/4三层
+        self.video_encoder = SimulcastEncoder(VIDEO_PAYLOAD_TYPE, conference_id, quality=75,
+                                              fec_group=FEC_VIDEO_GROUP)
+        self.audio_stream_out = MediaStream(STREAM_AUDIO, AUDIO_PAYLOAD_TYPE, conference_id, self.video_encoder.ssrc)
+        self.dtx = DtxSender(self.audio_stream_out, 16000)  # 静音时不发音频，只发静音描述和保活包
+        self.audio_fec = FecEncoder(self.audio_stream_out, FEC_AUDIO_GROUP)
+        self.fec_decoder = FecDecoder()  # 用校验包恢复丢掉的音视频包
+        self.video_history = PacketHistory()  # 各层最近发出的视频包，收到NACK时重传
+        self.nack = NackGenerator(conference_id, self.video_encoder.ssrc)
+        # 每个发送者一个抖动缓冲区，由播放回调按固定节奏取帧，对方静音期间一直放舒适噪声
+        self.audio_mixer = JitterMixer(2048, 1, 16000)
+        self.playback = np.zeros(2048, dtype=np.int16)
+        self.control_stream = control_stream(conference_id, self.video_encoder.ssrc)
+        self.gallery_width = 1280  # 所有远端画面横排在这个宽度里
+        self.audio_timestamp = 0
+        self.assembler = FrameAssembler()
+        self.remote_videos = {}  # self.remote_videos[ssrc] = 最新的一帧
+        self.video_heard = {}  # self.video_heard[ssrc] = time.monotonic() of its last frame
+        self.full_size = None  # (width, height) of the full resolution layer, known after the first layer 0 frame
 
         self.receive_thread = threading.Thread(target=self.receive_and_display, daemon=True)
         self.receive_thread.start()
@@ -52,7 +85,8 @@ class VideoAudioClient:
                                                         channels=1,
                                                         rate=16000,
                                                         output=True,
-                                                        frames_per_buffer=2048)
+                                                        frames_per_buffer=2048,
+                                                        stream_callback=self.play_audio)
             self.is_audio_on = True
         else:
             self.is_audio_on = False
@@ -70,13 +104,10 @@ class VideoAudioClient:
         if self.is_camera_on and self.cap:
             ret, frame = self.cap.read()
             if ret:
-                # 转换为RGB格式并显示
-                frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-                buffer = BytesIO()
-                image = Image.fromarray(frame_rgb).convert('RGB')
-                image.save(buffer, format="JPEG")
-                jpeg_data = buffer.getvalue()
-                self.send_data(0, jpeg_data)  # 0代表视频数据
+                # 直接把BGR帧压缩为JPEG格式，不再转RGB和PIL
+                for packet in self.video_encoder.packets(frame):
+                    self.send_data(packet)
+                    self.video_history.put_packet(packet)
                 self.local_video = frame
             cv2.waitKey(1)
 
@@ -84,47 +115,73 @@ class VideoAudioClient:
         if self.is_audio_on and self.audio_stream:
             audio_data = self.audio_stream.read(2048)
 
-            compressed_audio = zlib.compress(audio_data)
-            self.send_data(1, compressed_audio)  # 1代表音频数据
+            self.audio_timestamp += 2048
+            packet = self.dtx.packet(audio_data, self.audio_timestamp)
+            if packet is None:
+                return
+            for out in self.audio_fec.protect(packet) if packet[0] & 0x0F == STREAM_AUDIO else [packet]:
+                self.send_data(out)
+
+    def request_layers(self):
+        """远端人数变化时，按每个画面在窗口里的宽度向服务器请求合适的simulcast层"""
+        if self.full_size is None:
+            return
+        frame_width, frame_height = self.full_size
+        tile_width = self.gallery_width // max(1, len(self.remote_videos))
+        tile_height = tile_width * frame_height // frame_width
+        for ssrc in self.remote_videos:
+            layer = choose_layer(tile_width, tile_height, frame_width, frame_height)
+            self.send_data(layer_request(self.control_stream, ssrc, layer))
 
-    def send_data(self, data_type, data):
+    def send_data(self, packet):
         try:
-            packet = data_type.to_bytes(1, byteorder='big') + data
             self.sock.sendto(packet, (self.server_ip, self.server_port))
         except Exception as e:
             print(f"[错误] 发送数据失败: {e}")
             self.is_running = False
 
+    def drop_idle_videos(self):
+        """离开或者关掉摄像头的参与者不再占着画面，剩下的人按变宽的格子重新请求层"""
+        now = time.monotonic()
+        idle = [ssrc for ssrc, heard in self.video_heard.items() if now - heard > PARTICIPANT_TIMEOUT]
+        for ssrc in idle:
+            del self.video_heard[ssrc]
+            del self.remote_videos[ssrc]
+        if idle:
+            self.request_layers()
+            self.show_videos()
+
     def receive_and_display(self):
+        self.sock.settimeout(1)  # 没有人发包的时候也要定期清理离开的参与者
         try:
             while self.is_running:
-                raw_data, _ = self.sock.recvfrom(65535)
+                try:
+                    raw_data, _ = self.sock.recvfrom(65535)
+                except socket.timeout:
+                    self.drop_idle_videos()
+                    continue
                 if not raw_data:
                     print("[断开] 服务器已断开连接。")
                     self.is_running = False
                     break
 
-                data_type = int.from_bytes(raw_data[0:1], byteorder='big')
-                frame_data = raw_data[1:]
-
-                if data_type == 0:
-                    try:
-                        buffer = BytesIO(frame_data)
-                        img = Image.open(buffer)
-                        img = np.array(img)
-                        img_bgr = cv2.cvtColor(img, cv2.COLOR_RGB2BGR)
-                        self.remote_video = img_bgr
-                        if hasattr(self, 'local_video') and hasattr(self, 'remote_video'):
-                            combined_frame = np.hstack((self.local_video, self.remote_video))
-                            cv2.imshow("Local and Remote Video", combined_frame)
-                    except Exception as e:
-                        print(f"[错误] 处理视频数据失败: {e}")
-                elif data_type == 1:
-                    try:
-                        decompressed_audio = zlib.decompress(frame_data)
-                        self.play_audio(decompressed_audio)
-                    except Exception as e:
-                        print(f"[错误] 处理音频数据失败: {e}")
+                header = parse_header(raw_data)
+                if header is None:
+                    continue
+
+                if header.stream_type == STREAM_CONTROL:
+                    if header.payload_type == CONTROL_NACK:
+                        for packet in self.video_history.answer(raw_data):
+                            self.send_data(packet)
+                    continue
+                # 先用校验包恢复丢掉的包，校验包本身不是媒体数据
+                for packet in self.fec_decoder.push(raw_data):
+                    self.handle_packet(packet, parse_header(packet))
+                if not header.flags & FLAG_FEC:
+                    self.handle_packet(raw_data, header)
+                for packet in self.nack.poll():
+                    self.send_data(packet)
+                self.drop_idle_videos()
                 if cv2.waitKey(1) & 0xFF == ord('q'):  # 按'q'键退出
                     break
 
@@ -132,10 +189,55 @@ class VideoAudioClient:
             print(f"[错误] 接收和显示线程出错: {e}")
             self.is_running = False
 
+    def handle_packet(self, raw_data, header):
+        """处理一个媒体包（收到的或者用校验包恢复出来的）"""
+        if header.stream_type == STREAM_CAMERA:
+            self.nack.on_packet(header)
+            completed = self.assembler.push(raw_data)
+            if completed is None:
+                return  # 帧还没收齐
+            ssrc, timestamp, frame_data = completed
+            try:
+                buffer = BytesIO(frame_data)
+                img = Image.open(buffer)
+                img = np.array(img)
+                img_bgr = cv2.cvtColor(img, cv2.COLOR_RGB2BGR)
+                new_participant = ssrc not in self.remote_videos
+                self.remote_videos[ssrc] = img_bgr
+                self.video_heard[ssrc] = time.monotonic()
+                if header.layer == 0:
+                    self.full_size = (img_bgr.shape[1], img_bgr.shape[0])
+                if new_participant:
+                    self.request_layers()
+                self.show_videos()
+            except Exception as e:
+                print(f"[错误] 处理视频数据失败: {e}")
+        elif header.stream_type == STREAM_AUDIO and header.flags & FLAG_DTX and \
+                len(raw_data) > MEDIA_HEADER.size:
+            # 对方进入静音，抖动缓冲区从这一帧开始按描述的大小放舒适噪声，直到收到新的语音包
+            self.audio_mixer.buffer(header.ssrc).push_silence(header.sequence_number, header.timestamp,
+                                                              raw_data[MEDIA_HEADER.size])
+        elif header.stream_type == STREAM_AUDIO:
+            try:
+                samples = audio_codec.decode(memoryview(raw_data)[MEDIA_HEADER.size:], header.payload_type)
+                self.audio_mixer.buffer(header.ssrc).push(header.sequence_number, header.timestamp, samples)
+            except Exception as e:
+                print(f"[错误] 处理音频数据失败: {e}")
 
+    def show_videos(self):
+        if hasattr(self, 'local_video'):
+            # 不同层的分辨率不同，统一缩放到本地画面的高度再拼接
+            height = self.local_video.shape[0]
+            tiles = [v if v.shape[0] == height else
+                     cv2.resize(v, (v.shape[1] * height // v.shape[0], height))
+                     for v in self.remote_videos.values()]
+            combined_frame = np.hstack((self.local_video, *tiles))
+            cv2.imshow("Local and Remote Video", combined_frame)
 
-    def play_audio(self, audio_data):
-        self.stream_output.write(audio_data)
+    def play_audio(self, in_data, frame_count, time_info, status):
+        """pyaudio 播放回调，每个周期取一帧"""
+        self.audio_mixer.pop_into(self.playback)
+        return self.playback.tobytes(), pyaudio.paContinue
 
     def on_closing(self):
         """关闭客户端时释放资源"""
@@ -0,0 +1,200 @@
+'''
+NACK-driven selective retransmission for the video streams
+Receivers detect sequence gaps per (publisher, stream type, layer) and send CONTROL_NACK messages with RFC 4585
+style (sequence number, bitmask) items, repeated a few times while the packet can still make its frame.
+Senders keep the packets they sent in a PacketHistory ring indexed by sequence number and resend the missing ones
+unchanged except for FLAG_RTX. The relay keeps the same ring for every stream it forwards and answers NACKs from it,
+only what it never received itself is asked from the publisher
+'''
+import threading
+import time
+
+from config import *
+from rtp import (CONTROL_NACK, FLAG_FEC, FLAG_RTX, MEDIA_HEADER, NACK_HEADER, NACK_ITEM, STREAM_CONTROL,
+                 MediaStream)
+
+
+def nack_items(sequence_numbers):
+    """:return: list[(sequence number, bitmask)] covering the given sequence numbers, in order across the wrap"""
+    numbers = sorted(set(sequence_numbers))
+    if numbers and numbers[-1] - numbers[0] >= 0x8000:
+        numbers.sort(key=lambda seq: (seq - 0x8000) & 0xFFFF)  # 跨过了 65535 -> 0，小的那一段排在后面
+    items = []
+    for seq in numbers:
+        if items:
+            base, mask = items[-1]
+            distance = (seq - base) & 0xFFFF
+            if 1 <= distance <= 16:
+                items[-1] = (base, mask | 1 << (distance - 1))
+                continue
+        items.append((seq, 0))
+    return items
+
+
+def nack_packet(stream, publisher_ssrc, stream_type, layer, sequence_numbers):
+    """
+    :param stream: MediaStream of type STREAM_CONTROL and payload type CONTROL_NACK, carrying the sender's SSRC
+    :return: bytes, one NACK message
+    """
+    items = nack_items(sequence_numbers)
+    return stream.packet(b''.join([NACK_HEADER.pack(publisher_ssrc, stream_type, layer, len(items))] +
+                                  [NACK_ITEM.pack(seq, mask) for seq, mask in items]), 0)
+
+
+def parse_nack(data):
+    """
+    :param data: bytes-like, a whole CONTROL_NACK message
+    :return: (publisher ssrc, stream type, layer, list of sequence numbers), or None if malformed
+    """
+    offset = MEDIA_HEADER.size
+    if len(data) < offset + NACK_HEADER.size:
+        return None
+    publisher, stream_type, layer, count = NACK_HEADER.unpack_from(data, offset)
+    offset += NACK_HEADER.size
+    if len(data) < offset + count * NACK_ITEM.size:
+        return None
+    sequence_numbers = []
+    for i in range(count):
+        seq, mask = NACK_ITEM.unpack_from(data, offset + i * NACK_ITEM.size)
+        sequence_numbers.append(seq)
+        sequence_numbers.extend((seq + bit + 1) & 0xFFFF for bit in range(16) if mask >> bit & 1)
+    return publisher, stream_type, layer, sequence_numbers
+
+
+def retransmission(packet):
+    """:return: bytes, the packet with FLAG_RTX set"""
+    copy = bytearray(packet)
+    copy[1] |= FLAG_RTX
+    return bytes(copy)
+
+
+class PacketHistory:
+    """
+    bounded ring of recently sent (or forwarded) packets per stream, indexed by sequence number
+    """
+
+    def __init__(self, capacity=NACK_HISTORY, max_age=NACK_DEADLINE):
+        """
+        :param max_age: float, seconds after sending a packet is still worth retransmitting
+        """
+        self.capacity = capacity
+        self.max_age = max_age
+        self.rings = {}  # self.rings[stream key] = list of (sequence number, time sent, packet) slots
+        self.retransmitted = 0
+        self.lock = threading.Lock()
+
+    def put(self, key, sequence_number, packet, now):
+        ring = self.rings.get(key)
+        if ring is None:
+            ring = self.rings[key] = [None] * self.capacity
+        ring[sequence_number % self.capacity] = (sequence_number, now, packet)
+
+    def put_packet(self, packet, now=None):
+        """sender side: remember one of our own packets, keyed by its stream type and layer"""
+        if packet[1] & FLAG_FEC:
+            return
+        now = time.monotonic() if now is None else now
+        _, _, _, layer, _, _, sequence_number, _ = MEDIA_HEADER.unpack_from(packet)
+        with self.lock:
+            self.put((packet[0] & 0x0F, layer), sequence_number, packet, now)
+
+    def lookup(self, key, sequence_numbers, now):
+        """
+        :return: (list of packets still in the ring and young enough, list of sequence numbers that are not)
+        """
+        ring = self.rings.get(key)
+        found, missing = [], []
+        for seq in sequence_numbers:
+            slot = ring[seq % self.capacity] if ring is not None else None
+            if slot is not None and slot[0] == seq and now - slot[1] <= self.max_age:
+                found.append(slot[2])
+            else:
+                missing.append(seq)
+        self.retransmitted += len(found)
+        return found, missing
+
+    def answer(self, data, now=None):
+        """
+        sender side: handle a CONTROL_NACK message about our own streams
+        :return: list[bytes], the retransmissions to send
+        """
+        nack = parse_nack(data)
+        if nack is None:
+            return []
+        now = time.monotonic() if now is None else now
+        _, stream_type, layer, sequence_numbers = nack
+        with self.lock:
+            found, _ = self.lookup((stream_type, layer), sequence_numbers, now)
+        return [retransmission(packet) for packet in found]
+
+
+class _MissingPacket:
+    def __init__(self, now):
+        self.detected = now
+        self.last_nack = None
+        self.retries = 0
+
+
+class NackGenerator:
+    """
+    receiver side: feed every received video packet in (also retransmissions and packets rebuilt by FEC),
+    poll() returns the NACK messages that are due
+    """
+
+    def __init__(self, conference_id, ssrc, deadline=NACK_DEADLINE, reorder_delay=NACK_REORDER_DELAY,
+                 retry_interval=NACK_RETRY_INTERVAL, max_retries=NACK_MAX_RETRIES):
+        """
+        :param ssrc: int, this receiver's own SSRC
+        """
+        self.stream = MediaStream(STREAM_CONTROL, CONTROL_NACK, conference_id, ssrc)
+        self.deadline = deadline
+        self.reorder_delay = reorder_delay
+        self.retry_interval = retry_interval
+        self.max_retries = max_retries
+        self.highest = {}  # self.highest[(publisher ssrc, stream type, layer)] = highest sequence number received
+        self.missing = {}  # self.missing[same key] = {sequence number: _MissingPacket}
+        self.requested = 0
+        self.abandoned = 0
+
+    def on_packet(self, header, now=None):
+        """:param header: rtp.MediaHeader of a received media packet"""
+        now = time.monotonic() if now is None else now
+        key = (header.ssrc, header.stream_type, header.layer)
+        seq = header.sequence_number
+        highest = self.highest.get(key)
+        missing = self.missing.setdefault(key, {})
+        if highest is None:
+            self.highest[key] = seq
+            return
+        distance = (seq - highest) & 0xFFFF
+        if distance == 0 or distance >= 0x8000:
+            missing.pop(seq, None)  # 重传、FEC恢复或者乱序到达的旧包
+            return
+        self.highest[key] = seq
+        if distance > NACK_MAX_GAP:
+            missing.clear()  # 对方重启或者断了很久，不再补
+            return
+        for lost in range(highest + 1, highest + distance):
+            missing[lost & 0xFFFF] = _MissingPacket(now)
+
+    def poll(self, now=None):
+        """:return: list[bytes], NACK messages to send now"""
+        now = time.monotonic() if now is None else now
+        packets = []
+        for (publisher, stream_type, layer), missing in self.missing.items():
+            if not missing:
+                continue
+            due = []
+            for seq, entry in list(missing.items()):
+                if now - entry.detected > self.deadline or entry.retries >= self.max_retries:
+                    del missing[seq]  # 赶不上这一帧了
+                    self.abandoned += 1
+                elif now - entry.detected >= self.reorder_delay and \
+                        (entry.last_nack is None or now - entry.last_nack >= self.retry_interval):
+                    entry.last_nack = now
+                    entry.retries += 1
+                    due.append(seq)
+            if due:
+                self.requested += len(due)
+                packets.append(nack_packet(self.stream, publisher, stream_type, layer, due))
+        return packets
@@ -6,6 +6,8 @@ from io import BytesIO
 import numpy as np
 from PIL import Image
 
+from util import encode_frame
+
 
 class VideoConferenceClient:
     def __init__(self, server_ip, server_port):
@@ -20,6 +22,7 @@ class VideoConferenceClient:
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.sock.connect((self.server_ip, self.server_port))
         self.is_running = True
+        self.recv_buffer = bytearray(1 << 20)  # 接收缓冲区，帧更大时才重新分配
 
         # 启动接收视频的线程
         self.receive_thread = threading.Thread(target=self.receive_and_display, daemon=True)
@@ -46,14 +49,8 @@ class VideoConferenceClient:
         if self.is_camera_on and self.cap:
             ret, frame = self.cap.read()
             if ret:
-                # 转换为RGB格式并显示
-                frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-
-                # 压缩图像为JPEG格式
-                buffer = BytesIO()
-                image = Image.fromarray(frame_rgb).convert('RGB')
-                image.save(buffer, format="JPEG")
-                jpeg_data = buffer.getvalue()
+                # 直接把BGR帧压缩为JPEG格式，不再转RGB和PIL
+                jpeg_data = encode_frame(frame, 75)  # 和之前PIL默认的质量一样
 
                 # 发送视频帧到服务器
                 self.send_video(jpeg_data)
@@ -115,14 +112,17 @@ class VideoConferenceClient:
             self.is_running = False
 
     def recvall(self, n):
-        """接收n个字节的数据"""
-        data = bytearray()
-        while len(data) < n:
-            packet = self.sock.recv(n - len(data))
-            if not packet:
+        """接收n个字节的数据，直接 recv_into 到复用的缓冲区，返回的 memoryview 在下一次调用前有效"""
+        if len(self.recv_buffer) < n:
+            self.recv_buffer = bytearray(n)
+        view = memoryview(self.recv_buffer)[:n]
+        received = 0
+        while received < n:
+            count = self.sock.recv_into(view[received:])
+            if not count:
                 return None
-            data.extend(packet)
-        return data
+            received += count
+        return view
 
     def on_closing(self):
         """关闭客户端时释放资源"""
@@ -0,0 +1,218 @@
+'''
+Closed-loop video rate control
+Receivers measure loss fraction, interarrival jitter and the trend of the one-way delay per publisher and send a
+CONTROL_FEEDBACK message every FEEDBACK_INTERVAL; the relay forwards it to the publisher. The sender keeps a bitrate
+estimate (cut on loss or a growing delay, held while the jitter is high, probed up slowly near the bitrate of the last
+congestion and faster above it) and walks a ladder of JPEG quality / fps / resolution settings to stay under it,
+dropping frames at capture time instead of queueing them
+'''
+import time
+
+import cv2
+
+from config import *
+from rtcp import ReceptionStats
+from rtp import CONTROL_FEEDBACK, FEEDBACK, STREAM_CONTROL, VIDEO_CLOCK_RATE, MediaStream
+
+# (JPEG quality, fps, downscale factor), from the best to the cheapest setting
+LADDER = [(75, 30, 1), (60, 30, 1), (45, 30, 1), (45, 20, 1), (35, 15, 1), (60, 15, 2), (45, 15, 2), (35, 10, 2),
+          (50, 10, 4), (35, 5, 4)]
+LADDER_STEP_COST = 1.3  # assumed bitrate ratio between two neighbouring settings until one was measured
+MEASUREMENT_LIFETIME = 10  # seconds a measured bitrate of a setting is trusted (the scene changes)
+
+
+class _SourceStats(ReceptionStats):
+    """reception statistics of one publisher, plus the delay samples and byte count of the current interval"""
+
+    def __init__(self, sequence_number, now, clock_rate):
+        super().__init__(sequence_number, clock_rate)
+        self.bytes = 0
+        self.delays = []  # (arrival, transit) of the first packet of each frame in this interval
+        self.last_timestamp = None
+        self.base_delay = None  # smallest one-way delay seen (includes the clock offset), seconds
+        self.last_report = now
+
+    def on_packet(self, header, size, now):
+        self.update(header.sequence_number, header.timestamp, now)
+        self.bytes += size
+        if header.timestamp != self.last_timestamp:
+            # 只看每帧的第一个包，后面的包还带着本帧的发送时间，大帧会被误判成排队
+            self.last_timestamp = header.timestamp
+            delay = self.transit / self.clock_rate
+            self.delays.append((now, delay))
+            if self.base_delay is None or delay < self.base_delay:
+                self.base_delay = delay
+
+    def delay_trend(self):
+        """least-squares slope of the one-way delay over arrival time, seconds of delay gained per second"""
+        n = len(self.delays)
+        if n < 3:
+            return 0.0
+        mean_t = sum(t for t, _ in self.delays) / n
+        mean_d = sum(d for _, d in self.delays) / n
+        var = sum((t - mean_t) ** 2 for t, _ in self.delays)
+        if var == 0:
+            return 0.0
+        return sum((t - mean_t) * (d - mean_d) for t, d in self.delays) / var
+
+    def report(self, now):
+        """
+        :return: (loss fraction 0-255, jitter ms, delay trend us/s, receive rate bytes/s, queueing delay ms),
+                 resets the interval
+        """
+        fraction = self.interval_loss()
+        jitter_ms = min(0xFFFF, int(self.jitter * 1000 / self.clock_rate))
+        trend = max(-0x80000000, min(0x7FFFFFFF, int(self.delay_trend() * 1e6)))
+        rate = int(self.bytes / max(now - self.last_report, 1e-3))
+        queue_delay = 0
+        if self.delays:
+            queue_delay = min(0xFFFF, int((self.delays[-1][1] - self.base_delay) * 1000))
+        self.bytes = 0
+        self.delays.clear()
+        self.last_report = now
+        return fraction, jitter_ms, trend, rate, queue_delay
+
+
+class ReceiverFeedback:
+    """
+    receiver side: feed every received video packet in, send the returned feedback packets to the relay
+    """
+
+    def __init__(self, conference_id, ssrc, interval=FEEDBACK_INTERVAL, clock_rate=VIDEO_CLOCK_RATE):
+        """
+        :param ssrc: int, this receiver's own SSRC
+        """
+        self.stream = MediaStream(STREAM_CONTROL, CONTROL_FEEDBACK, conference_id, ssrc)
+        self.interval = interval
+        self.clock_rate = clock_rate
+        self.sources = {}  # self.sources[publisher ssrc] = _SourceStats
+        self.next_report = None
+
+    def on_packet(self, header, size, now=None):
+        """
+        :param header: rtp.MediaHeader of a received video packet
+        :return: list[bytes], feedback packets when the interval is over, otherwise empty
+        """
+        now = time.monotonic() if now is None else now
+        stats = self.sources.get(header.ssrc)
+        if stats is None:
+            stats = self.sources[header.ssrc] = _SourceStats(header.sequence_number, now, self.clock_rate)
+        stats.on_packet(header, size, now)
+        if self.next_report is None:
+            self.next_report = now + self.interval
+        if now < self.next_report:
+            return []
+        self.next_report = now + self.interval
+        return [self.stream.packet(FEEDBACK.pack(ssrc, *stats.report(now)), 0)
+                for ssrc, stats in self.sources.items()]
+
+
+class RateController:
+    """
+    sender side: bitrate estimate from the feedback of all receivers and the current video settings
+    """
+
+    def __init__(self, start_bitrate=RATE_START_BITRATE, min_bitrate=RATE_MIN_BITRATE,
+                 max_bitrate=RATE_MAX_BITRATE, hold_time=RATE_HOLD_TIME, ladder=LADDER):
+        self.target = start_bitrate  # bits/s
+        self.min_bitrate = min_bitrate
+        self.max_bitrate = max_bitrate
+        self.hold_time = hold_time
+        self.ladder = ladder
+        self.level = 0
+        self.last_change = 0.0
+        self.last_increase = 0.0
+        self.congested_bitrate = None  # estimate after the last cut, None until the first congestion
+        self.frame_bytes = None  # EWMA of the encoded size of a sent frame at the current level
+        self.measured = {}  # self.measured[level] = (bitrate, time) measured when the level was last left
+        self.next_frame = 0.0
+
+    @property
+    def quality(self):
+        return self.ladder[self.level][0]
+
+    @property
+    def fps(self):
+        return self.ladder[self.level][1]
+
+    @property
+    def scale(self):
+        return self.ladder[self.level][2]
+
+    def on_feedback(self, payload, now=None):
+        """
+        :param payload: bytes-like, the FEEDBACK payload of a CONTROL_FEEDBACK message
+        """
+        now = time.monotonic() if now is None else now
+        _, fraction, jitter_ms, trend, rate, queue_delay = FEEDBACK.unpack_from(payload)
+        loss = fraction / 256
+        overuse = trend / 1e6 > RATE_OVERUSE_TREND or queue_delay / 1000 > RATE_MAX_QUEUE_DELAY
+        if loss > 0.1:
+            self.target *= 1 - 0.5 * loss
+            self.congested_bitrate = self.target
+        elif overuse:
+            # 队列在变长或者已经排了很久：降到对方实际收到的速率以下，让队列排空
+            self.target = min(self.target, 0.85 * rate * 8)
+            self.congested_bitrate = self.target
+        elif loss < 0.02 and jitter_ms / 1000 <= RATE_MAX_JITTER and now - self.last_increase >= FEEDBACK_INTERVAL \
+                and self.target < 3 * rate * 8:
+            # 一个间隔只涨一次，多个接收者的反馈不会叠加；发不满的时候也不会一直涨上去。
+            # 抖动大说明一帧的包在路上已经被拉开了，链路接近饱和，先保持不涨
+            fast = self.congested_bitrate is None or self.target > 1.5 * self.congested_bitrate
+            self.target *= RATE_FAST_INCREASE if fast else RATE_INCREASE
+            self.last_increase = now
+        self.target = max(self.min_bitrate, min(self.max_bitrate, self.target))
+        if loss > 0.3:
+            self.step(2, now)  # 严重拥塞时不等保持时间，直接降两档
+        elif (overuse or loss > 0.1) and self.frame_bytes is not None and \
+                self.frame_bytes * 8 * self.fps > self.target:
+            self.step(1, now)
+
+    def step(self, levels, now):
+        level = max(0, min(len(self.ladder) - 1, self.level + levels))
+        if level != self.level:
+            if self.frame_bytes is not None:
+                self.measured[self.level] = (self.frame_bytes * 8 * self.fps, now)
+            self.frame_bytes = None  # 换档后重新测量
+            self.level = level
+            self.last_change = now
+
+    def estimate(self, level, bitrate, now):
+        """bitrate of another level: measured recently, or extrapolated from the current one"""
+        measured = self.measured.get(level)
+        if measured is not None and now - measured[1] < MEASUREMENT_LIFETIME:
+            return measured[0]
+        return bitrate * LADDER_STEP_COST ** (self.level - level)
+
+    def on_frame_sent(self, size, now=None):
+        """
+        :param size: int, encoded bytes of the frame just sent
+        """
+        now = time.monotonic() if now is None else now
+        self.frame_bytes = size if self.frame_bytes is None else 0.9 * self.frame_bytes + 0.1 * size
+        if now - self.last_change < self.hold_time:
+            return
+        bitrate = self.frame_bytes * 8 * self.fps
+        if bitrate > 1.1 * self.target:
+            self.step(1, now)
+        elif self.level > 0 and self.estimate(self.level - 1, bitrate, now) < 0.9 * self.target:
+            self.step(-1, now)
+
+    def should_send(self, now=None):
+        """
+        :return: bool, whether a frame captured now should be encoded and sent at the current fps;
+                 frames in between are dropped instead of queued
+        """
+        now = time.monotonic() if now is None else now
+        if now < self.next_frame - 0.2 / self.fps:  # a little early is fine, the camera clock jitters
+            return False
+        # 不累积欠下的帧，慢了就从现在重新计时
+        self.next_frame = max(self.next_frame + 1 / self.fps, now)
+        return True
+
+    def prepare(self, frame):
+        """:return: the frame downscaled to the current setting"""
+        if self.scale == 1:
+            return frame
+        height, width = frame.shape[:2]
+        return cv2.resize(frame, (width // self.scale, height // self.scale), interpolation=cv2.INTER_AREA)
@@ -0,0 +1,64 @@
+'''
+Tk side of the receive pipeline: network thread -> FrameDecoderPool -> LatestFrameMailbox -> VideoRenderer
+Tk is not thread safe, so only the render loop (running in the Tk main loop through after()) touches widgets.
+It paints each participant's newest decoded frame once per display tick and pastes into the PhotoImage it already
+has instead of creating a new one for every frame
+'''
+import time
+
+from PIL import ImageTk
+
+from config import *
+
+
+class VideoRenderer:
+    def __init__(self, root, frames, label_for, fps=RENDER_FPS):
+        """
+        :param root: tk.Tk
+        :param frames: util.LatestFrameMailbox of decoded PIL images
+        :param label_for: callable key -> tk.Label showing that participant, or None to skip the frame
+        """
+        self.root = root
+        self.frames = frames
+        self.label_for = label_for
+        self.interval = max(1, int(1000 / fps))
+        self.photos = {}  # self.photos[label] = ImageTk.PhotoImage currently shown by the label
+        self.job = None
+        self.painted = 0
+        self.paint_time = 0.0
+
+    def start(self):
+        if self.job is None:
+            self.job = self.root.after(self.interval, self.tick)
+
+    def stop(self):
+        if self.job is not None:
+            self.root.after_cancel(self.job)
+            self.job = None
+
+    def tick(self):
+        start = time.perf_counter()
+        for key, image in self.frames.take_all().items():
+            label = self.label_for(key)
+            if label is not None:
+                self.show(label, image)
+        self.paint_time += time.perf_counter() - start
+        # 绘制本身占用的时间也算进间隔里，保持稳定的刷新节奏
+        delay = self.interval - int(1000 * (time.perf_counter() - start))
+        self.job = self.root.after(max(1, delay), self.tick)
+
+    def show(self, label, image):
+        """paint a PIL image into a label, must be called from the Tk thread"""
+        photo = self.photos.get(label)
+        if photo is not None and photo.width() == image.width and photo.height() == image.height:
+            photo.paste(image)  # 尺寸不变就直接覆盖原来的图，不用重新创建
+        else:
+            photo = self.photos[label] = ImageTk.PhotoImage(image)
+            label.config(image=photo)
+            label.image = photo
+        self.painted += 1
+
+    def clear(self, label):
+        self.photos.pop(label, None)
+        label.config(image='')
+        label.image = None
@@ -0,0 +1,272 @@
+'''
+RTCP-style sender and receiver reports (RFC 3550 section 6.4) for the UDP media streams
+Streams are identified by (SSRC, stream type, layer): a participant's audio and video share one SSRC here, so every
+sender info and report block carries the stream type and simulcast layer next to the SSRC.
+One report packet = media header (STREAM_RTCP, payload type RTCP_SR or RTCP_RR) + REPORT_HEADER
++ SENDER_INFO for each stream we send + REPORT_BLOCK for each stream we receive
+'''
+import struct
+import threading
+import time
+
+from config import *
+from rtp import MEDIA_HEADER, STREAM_AUDIO, STREAM_RTCP, VIDEO_CLOCK_RATE, MediaStream
+
+RTCP_SR = 200
+RTCP_RR = 201
+
+REPORT_HEADER = struct.Struct('!BB2x')  # sender info count, report block count
+# stream type, layer, NTP timestamp, RTP timestamp, sender's packet count, sender's octet count
+SENDER_INFO = struct.Struct('!BB2xQIII')
+# SSRC, stream type, layer, fraction lost (8 bits) | cumulative lost (24 bits), extended highest sequence number,
+# interarrival jitter, last SR (LSR), delay since last SR (DLSR)
+REPORT_BLOCK = struct.Struct('!IBB2xIIIII')
+
+NTP_EPOCH_OFFSET = 2208988800  # seconds from 1900-01-01 to 1970-01-01
+
+CLOCK_RATES = {STREAM_AUDIO: RATE}  # every other stream type uses VIDEO_CLOCK_RATE
+
+
+def ntp_timestamp(now=None):
+    """:return: int, 64-bit NTP timestamp (32.32 fixed point seconds since 1900)"""
+    now = time.time() if now is None else now
+    return int((now + NTP_EPOCH_OFFSET) * (1 << 32)) & 0xFFFFFFFFFFFFFFFF
+
+
+def ntp_middle(ntp):
+    """the middle 32 bits of an NTP timestamp (16.16 fixed point), the unit of LSR/DLSR"""
+    return (ntp >> 16) & 0xFFFFFFFF
+
+
+class ReceptionStats:
+    """
+    RFC 3550 reception statistics of one received stream (appendix A.1, A.3 and A.8)
+    """
+
+    def __init__(self, sequence_number, clock_rate):
+        self.clock_rate = clock_rate
+        self.base_seq = sequence_number
+        self.max_seq = sequence_number  # extended with the wrap-around cycles
+        self.received = 0
+        self.expected_prior = 0
+        self.received_prior = 0
+        self.fraction_lost = 0  # of the last report interval, 1/256
+        self.transit = None
+        self.jitter = 0.0  # in timestamp units
+        self.last_sr = 0  # middle 32 bits of the NTP timestamp of the last SR of this stream
+        self.last_sr_arrival = None  # time.time() when it arrived
+        self.sr_ntp = None  # NTP <-> RTP timestamp pair of the last SR
+        self.sr_rtp = None
+
+    def update(self, sequence_number, timestamp, arrival):
+        """
+        :param arrival: float, arrival time in seconds (any clock, only differences matter)
+        """
+        delta = (sequence_number - self.max_seq) & 0xFFFF
+        if delta < 0x8000:
+            self.max_seq += delta
+        self.received += 1
+        transit = arrival * self.clock_rate - timestamp
+        if self.transit is not None:
+            d = transit - self.transit
+            if abs(d) < 0x80000000:  # ignore timestamp wrap-around
+                self.jitter += (abs(d) - self.jitter) / 16
+        self.transit = transit
+
+    @property
+    def expected(self):
+        return self.max_seq - self.base_seq + 1
+
+    @property
+    def lost(self):
+        return self.expected - self.received
+
+    def interval_loss(self):
+        """
+        :return: int, fraction lost since the last call, 1/256 (also kept in self.fraction_lost)
+        """
+        expected = self.expected
+        expected_interval = expected - self.expected_prior
+        received_interval = self.received - self.received_prior
+        self.expected_prior, self.received_prior = expected, self.received
+        lost = expected_interval - received_interval
+        self.fraction_lost = 0 if expected_interval <= 0 or lost <= 0 else min(255, (lost << 8) // expected_interval)
+        return self.fraction_lost
+
+    def on_sender_report(self, ntp, rtp_timestamp, now):
+        self.last_sr = ntp_middle(ntp)
+        self.last_sr_arrival = now
+        self.sr_ntp, self.sr_rtp = ntp, rtp_timestamp
+
+    def wallclock(self, timestamp):
+        """
+        :return: float, sender's wall-clock time (time.time() scale) of an RTP timestamp of this stream,
+                 None until a sender report arrived
+        """
+        if self.sr_ntp is None:
+            return None
+        delta = (timestamp - self.sr_rtp) & 0xFFFFFFFF
+        if delta >= 0x80000000:
+            delta -= 0x100000000
+        return self.sr_ntp / (1 << 32) - NTP_EPOCH_OFFSET + delta / self.clock_rate
+
+    def report_block(self, ssrc, stream_type, layer, now):
+        dlsr = 0
+        if self.last_sr_arrival is not None:
+            dlsr = int((now - self.last_sr_arrival) * 65536) & 0xFFFFFFFF
+        cumulative = max(-0x800000, min(0x7FFFFF, self.lost)) & 0xFFFFFF
+        return REPORT_BLOCK.pack(ssrc, stream_type, layer, (self.interval_loss() << 24) | cumulative,
+                                 self.max_seq & 0xFFFFFFFF, int(self.jitter) & 0xFFFFFFFF, self.last_sr, dlsr)
+
+    def as_dict(self):
+        return {'expected': self.expected, 'received': self.received, 'lost': self.lost,
+                'fraction_lost': self.fraction_lost / 256, 'jitter': self.jitter / self.clock_rate}
+
+
+class SenderStats:
+    """packet/octet counters of one outgoing stream and what the receivers report about it"""
+
+    def __init__(self, clock_rate):
+        self.clock_rate = clock_rate
+        self.packets = 0
+        self.octets = 0  # payload bytes, without the media header
+        self.timestamp = None  # RTP timestamp of the last packet
+        self.sent_at = None  # time.time() when it was sent
+        self.receivers = {}  # self.receivers[reporter ssrc] = dict of its last report block
+
+    def on_sent(self, packet_size, timestamp, now=None):
+        self.packets += 1
+        self.octets += packet_size - MEDIA_HEADER.size
+        self.timestamp = timestamp
+        self.sent_at = time.time() if now is None else now
+
+    def sender_info(self, stream_type, layer, now):
+        # 当前时刻对应的RTP时间戳，由最后一个包的时间戳外推
+        timestamp = 0
+        if self.timestamp is not None:
+            timestamp = int(self.timestamp + (now - self.sent_at) * self.clock_rate) & 0xFFFFFFFF
+        return SENDER_INFO.pack(stream_type, layer, ntp_timestamp(now), timestamp, self.packets & 0xFFFFFFFF,
+                                self.octets & 0xFFFFFFFF)
+
+
+def parse_report(data):
+    """
+    :param data: bytes-like, a whole STREAM_RTCP packet
+    :return: (sender infos, report blocks) as lists of tuples, or None if malformed
+    """
+    offset = MEDIA_HEADER.size
+    if len(data) < offset + REPORT_HEADER.size:
+        return None
+    senders, blocks = REPORT_HEADER.unpack_from(data, offset)
+    offset += REPORT_HEADER.size
+    if len(data) < offset + senders * SENDER_INFO.size + blocks * REPORT_BLOCK.size:
+        return None
+    infos = [SENDER_INFO.unpack_from(data, offset + i * SENDER_INFO.size) for i in range(senders)]
+    offset += senders * SENDER_INFO.size
+    return infos, [REPORT_BLOCK.unpack_from(data, offset + i * REPORT_BLOCK.size) for i in range(blocks)]
+
+
+def block_dict(block, rtt=None):
+    _, _, _, loss_word, highest, jitter, _, _ = block
+    cumulative = loss_word & 0xFFFFFF
+    if cumulative & 0x800000:
+        cumulative -= 0x1000000
+    return {'fraction_lost': (loss_word >> 24) / 256, 'cumulative_lost': cumulative, 'highest_seq': highest,
+            'jitter': jitter, 'rtt': rtt}
+
+
+class RtcpSession:
+    """
+    one participant's RTCP state: counters of the streams it sends, reception statistics of the streams it receives,
+    and the reports it exchanges about them. Thread-safe, the send and receive threads of a client share it
+    """
+
+    def __init__(self, conference_id, ssrc, interval=RTCP_INTERVAL, clock_rates=None):
+        self.stream = MediaStream(STREAM_RTCP, RTCP_RR, conference_id, ssrc)
+        self.ssrc = ssrc
+        self.interval = interval
+        self.clock_rates = dict(CLOCK_RATES, **(clock_rates or {}))
+        self.senders = {}  # self.senders[(stream_type, layer)] = SenderStats
+        self.sources = {}  # self.sources[(ssrc, stream_type, layer)] = ReceptionStats
+        self.next_report = None
+        self.lock = threading.Lock()
+
+    def clock_rate(self, stream_type):
+        return self.clock_rates.get(stream_type, VIDEO_CLOCK_RATE)
+
+    def on_sent(self, stream, timestamp, packet_size, now=None):
+        """count one packet sent on one of our streams (a rtp.MediaStream)"""
+        key = (stream.stream_type, stream.layer)
+        with self.lock:
+            stats = self.senders.get(key)
+            if stats is None:
+                stats = self.senders[key] = SenderStats(self.clock_rate(stream.stream_type))
+            stats.on_sent(packet_size, timestamp, now)
+
+    def on_media(self, header, now=None):
+        """account one received media packet"""
+        now = time.time() if now is None else now
+        key = (header.ssrc, header.stream_type, header.layer)
+        with self.lock:
+            stats = self.sources.get(key)
+            if stats is None:
+                stats = self.sources[key] = ReceptionStats(header.sequence_number,
+                                                           self.clock_rate(header.stream_type))
+            stats.update(header.sequence_number, header.timestamp, now)
+
+    def on_report(self, data, now=None):
+        """handle a received STREAM_RTCP packet"""
+        now = time.time() if now is None else now
+        report = parse_report(data)
+        if report is None:
+            return
+        infos, blocks = report
+        reporter = MEDIA_HEADER.unpack_from(data)[5]
+        with self.lock:
+            for stream_type, layer, ntp, rtp_timestamp, _, _ in infos:
+                stats = self.sources.get((reporter, stream_type, layer))
+                if stats is not None:
+                    stats.on_sender_report(ntp, rtp_timestamp, now)
+            for block in blocks:
+                ssrc, stream_type, layer, _, _, _, lsr, dlsr = block
+                stats = self.senders.get((stream_type, layer))
+                if ssrc != self.ssrc or stats is None:
+                    continue  # 别人的流的报告
+                rtt = None
+                if lsr:
+                    # RFC 3550 6.4.1: RTT = A - LSR - DLSR，单位1/65536秒
+                    rtt = ((ntp_middle(ntp_timestamp(now)) - lsr - dlsr) & 0xFFFFFFFF) / 65536
+                    if rtt > 60:
+                        rtt = None  # wrapped: clock step or a bogus report
+                stats.receivers[reporter] = block_dict(block, rtt)
+
+    def report(self, now=None):
+        """
+        :return: bytes, the SR/RR packet to send when the report interval is over, otherwise None
+        """
+        now = time.time() if now is None else now
+        with self.lock:
+            if self.next_report is None:
+                self.next_report = now + self.interval
+            if now < self.next_report or not (self.senders or self.sources):
+                return None
+            self.next_report = now + self.interval
+            infos = [stats.sender_info(stream_type, layer, now)
+                     for (stream_type, layer), stats in self.senders.items()]
+            blocks = [stats.report_block(ssrc, stream_type, layer, now)
+                      for (ssrc, stream_type, layer), stats in list(self.sources.items())[:255]]
+            self.stream.payload_type = RTCP_SR if infos else RTCP_RR
+            payload = b''.join([REPORT_HEADER.pack(len(infos), len(blocks))] + infos + blocks)
+            return self.stream.packet(payload, ntp_middle(ntp_timestamp(now)))
+
+    def stats(self):
+        """
+        :return: dict, {'sent': {(stream_type, layer): {...}}, 'received': {(ssrc, stream_type, layer): {...}}},
+                 jitter in seconds as measured here, in timestamp units as reported by receivers, rtt in seconds
+        """
+        with self.lock:
+            return {
+                'sent': {key: {'packets': s.packets, 'octets': s.octets, 'receivers': dict(s.receivers)}
+                         for key, s in self.senders.items()},
+                'received': {key: s.as_dict() for key, s in self.sources.items()},
+            }
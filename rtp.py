@@ -0,0 +1,206 @@
+'''
+Media packet header and RTP-style packetization for the UDP media paths
+Every UDP packet starts with one versioned binary header (stream type, conference ID, participant SSRC, sequence
+number, media timestamp, flags), so the relays can route N-party conferences from fixed offsets without looking at
+the payload.
+A JPEG frame is split into MTU-sized packets in the style of RFC 2435 (fragment offset + marker flag on the last
+packet), so a frame never relies on IP fragmentation and is no longer limited to one datagram
+'''
+import random
+import struct
+import time
+from collections import namedtuple
+from config import *
+
+# version(4 bits) | stream type(4 bits), flags, payload type, simulcast layer, conference ID, SSRC, sequence number,
+# timestamp
+MEDIA_HEADER = struct.Struct('!BBBBIIHI')
+ROUTING_FIELDS = struct.Struct('!B2xBII')  # version | stream type, layer, conference ID, SSRC: all a relay needs
+MEDIA_VERSION = 1
+
+STREAM_CAMERA = 0
+STREAM_AUDIO = 1
+STREAM_SCREEN = 2
+STREAM_CONTROL = 3  # subscriber -> relay messages, never forwarded
+STREAM_RTCP = 4  # sender/receiver reports (rtcp.py), forwarded to the whole conference
+
+FLAG_MARKER = 0x01  # last packet of a video frame
+FLAG_DTX = 0x02  # audio silence descriptor: the payload is one comfort noise level byte (vad.py), not a frame
+FLAG_FEC = 0x04  # XOR parity packet of the stream (fec.py), own sequence numbers, not a media packet
+FLAG_RTX = 0x08  # retransmission of an earlier packet after a NACK (nack.py), otherwise unchanged
+
+MediaHeader = namedtuple('MediaHeader', ['stream_type', 'flags', 'payload_type', 'conference_id', 'ssrc',
+                                         'sequence_number', 'timestamp', 'layer'])
+
+# control messages, the message type is carried in the payload type field
+CONTROL_LAYER = 1  # LAYER_REQUEST: which simulcast layer of a publisher this subscriber wants
+LAYER_REQUEST = struct.Struct('!IB3x')  # publisher SSRC, layer (0 = full resolution)
+CONTROL_FEEDBACK = 2  # FEEDBACK: receiver report for one publisher, forwarded by the relay to that publisher
+# publisher SSRC, loss fraction (1/256), jitter (ms), delay trend (us of queueing delay gained per s), receive rate
+# (bytes/s), queueing delay (ms above the smallest one-way delay seen)
+FEEDBACK = struct.Struct('!IBxHiIH2x')
+CONTROL_KEEPALIVE = 3  # no payload: keeps a participant in DTX known to the relay without sending it any audio
+CONTROL_NACK = 4  # NACK_HEADER + NACK_ITEMs: packets of one publisher's stream the subscriber is missing
+# publisher SSRC, stream type, layer, number of items
+NACK_HEADER = struct.Struct('!IBBH')
+NACK_ITEM = struct.Struct('!HH')  # sequence number, bitmask of the 16 following ones (RFC 4585 generic NACK)
+
+JPEG_HEADER = struct.Struct('!IBBBB')  # type-specific(8 bits) + fragment offset(24 bits), type, Q, width/8, height/8
+VIDEO_CLOCK_RATE = 90000  # RFC 2435 uses a 90 kHz clock for JPEG
+
+# 20 bytes IP + 8 bytes UDP
+MAX_JPEG_PAYLOAD = DGRAM_SIZE - 28 - MEDIA_HEADER.size - JPEG_HEADER.size
+
+
+def parse_header(data):
+    """
+    :return: MediaHeader, or None if data does not start with a header of this version
+    """
+    if len(data) < MEDIA_HEADER.size or data[0] >> 4 != MEDIA_VERSION:
+        return None
+    version_type, flags, payload_type, layer, conference_id, ssrc, sequence_number, timestamp = \
+        MEDIA_HEADER.unpack_from(data)
+    return MediaHeader(version_type & 0x0F, flags, payload_type, conference_id, ssrc, sequence_number, timestamp,
+                       layer)
+
+
+def routing_fields(data):
+    """
+    :return: (stream_type, conference_id, ssrc, layer), or None if data does not start with a header of this version
+    """
+    if len(data) < MEDIA_HEADER.size or data[0] >> 4 != MEDIA_VERSION:
+        return None
+    version_type, layer, conference_id, ssrc = ROUTING_FIELDS.unpack_from(data)
+    return version_type & 0x0F, conference_id, ssrc, layer
+
+
+class MediaStream:
+    """
+    sender side of one outgoing stream: the constant header fields are fixed once, the sequence number advances
+    with every packet; each simulcast layer is its own MediaStream (same SSRC, own sequence numbers)
+    """
+
+    def __init__(self, stream_type, payload_type, conference_id=0, ssrc=None, layer=0):
+        self.version_type = (MEDIA_VERSION << 4) | stream_type
+        self.stream_type = stream_type
+        self.payload_type = payload_type
+        self.conference_id = conference_id
+        self.layer = layer
+        self.ssrc = random.getrandbits(32) if ssrc is None else ssrc
+        self.sequence_number = random.getrandbits(16)
+
+    def header(self, timestamp, flags=0):
+        header = MEDIA_HEADER.pack(self.version_type, flags, self.payload_type, self.layer, self.conference_id,
+                                   self.ssrc, self.sequence_number, timestamp & 0xFFFFFFFF)
+        self.sequence_number = (self.sequence_number + 1) & 0xFFFF
+        return header
+
+    def packet(self, payload, timestamp, flags=0):
+        return b''.join((self.header(timestamp, flags), payload))
+
+
+def video_timestamp():
+    return int(time.monotonic() * VIDEO_CLOCK_RATE) & 0xFFFFFFFF
+
+
+def is_newer(timestamp, other):
+    """compare two 32-bit media timestamps with wrap-around"""
+    return timestamp != other and ((timestamp - other) & 0xFFFFFFFF) < 0x80000000
+
+
+def packetize_jpeg(jpeg_bytes, stream, timestamp, width=0, height=0, quality=0, max_payload=MAX_JPEG_PAYLOAD):
+    """
+    split one JPEG frame into packets, the marker flag is set on the last one
+
+    :param jpeg_bytes: bytes-like, the whole encoded frame
+    :param stream: MediaStream, the video stream the packets belong to
+    :return: list[bytes] packets
+    """
+    view = memoryview(jpeg_bytes)
+    total = len(view)
+    # width/height are stored in units of 8 pixels, 0 if they do not fit into one byte
+    width_8 = width // 8 if width < 2048 else 0
+    height_8 = height // 8 if height < 2048 else 0
+    packets = []
+    offset = 0
+    while True:
+        chunk = view[offset:offset + max_payload]
+        last = offset + len(chunk) >= total
+        header = stream.header(timestamp, FLAG_MARKER if last else 0)
+        jpeg_header = JPEG_HEADER.pack(offset & 0xFFFFFF, 1, quality, width_8, height_8)
+        packets.append(b''.join((header, jpeg_header, chunk)))
+        offset += len(chunk)
+        if last:
+            return packets
+
+
+class _PartialFrame:
+    def __init__(self, now):
+        self.fragments = {}  # fragment offset -> payload
+        self.received = 0
+        self.total = None  # known once the marker packet arrived
+        self.first_seen = now
+
+    def add(self, offset, payload, marker):
+        if offset not in self.fragments:
+            self.fragments[offset] = payload
+            self.received += len(payload)
+        if marker:
+            self.total = offset + len(payload)
+        return self.total is not None and self.received == self.total
+
+    def assemble(self):
+        return b''.join(self.fragments[offset] for offset in sorted(self.fragments))
+
+
+class FrameAssembler:
+    """
+    reassemble JPEG frames from media packets, keyed by (SSRC, layer, timestamp)
+    a frame is complete once the marker packet arrived and the fragments cover the whole frame;
+    partial frames are discarded after a timeout or as soon as a newer frame of the same sender is complete
+    """
+
+    def __init__(self, timeout=FRAME_TIMEOUT):
+        self.timeout = timeout
+        self.frames = {}  # self.frames[(ssrc, layer, timestamp)] = _PartialFrame
+        self.last_complete = {}  # self.last_complete[ssrc] = timestamp of the last delivered frame
+        self.discarded = 0
+
+    def push(self, packet, now=None):
+        """
+        :param packet: bytes, one JPEG media packet
+        :return: (ssrc, timestamp, jpeg bytes) when this packet completes a frame, otherwise None
+        """
+        header = parse_header(packet)
+        if header is None or header.flags & FLAG_FEC or len(packet) < MEDIA_HEADER.size + JPEG_HEADER.size:
+            return None
+        now = time.monotonic() if now is None else now
+        ssrc, timestamp = header.ssrc, header.timestamp
+        offset = JPEG_HEADER.unpack_from(packet, MEDIA_HEADER.size)[0] & 0xFFFFFF
+        payload = packet[MEDIA_HEADER.size + JPEG_HEADER.size:]
+
+        last = self.last_complete.get(ssrc)
+        if last is not None and not is_newer(timestamp, last):
+            return None  # late packet of a frame that was already delivered or dropped
+
+        # 切换simulcast层时两层的同一帧可能都在路上，不能混在一起
+        key = (ssrc, header.layer, timestamp)
+        frame = self.frames.get(key)
+        if frame is None:
+            self.expire(now)
+            frame = self.frames[key] = _PartialFrame(now)
+        if not frame.add(offset, payload, header.flags & FLAG_MARKER):
+            return None
+
+        del self.frames[key]
+        self.last_complete[ssrc] = timestamp
+        # 更早的残缺帧已经没有意义了，直接丢掉
+        for other in [k for k in self.frames if k[0] == ssrc and not is_newer(k[2], timestamp)]:
+            del self.frames[other]
+            self.discarded += 1
+        return ssrc, timestamp, frame.assemble()
+
+    def expire(self, now):
+        for key in [k for k, frame in self.frames.items() if now - frame.first_seen > self.timeout]:
+            del self.frames[key]
+            self.discarded += 1
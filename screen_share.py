@@ -0,0 +1,182 @@
+'''
+Dirty-tile screen sharing
+Each capture is split into fixed tiles and compared with the previous capture in one vectorized numpy pass; only the
+changed tiles are JPEG-encoded (neighbouring dirty tiles of a row merged into one rect) and sent, with a periodic full
+refresh. The receiver patches the rects into a persistent canvas.
+One update = UPDATE_HEADER + rects (RECT_HEADER + JPEG), packetized like a JPEG frame with rtp.packetize_jpeg
+'''
+import struct
+import time
+
+import cv2
+import numpy as np
+
+from config import *
+from rtp import FrameAssembler, packetize_jpeg, video_timestamp
+from util import encode_frame
+
+TILE_PAYLOAD_TYPE = 100  # dynamic payload type of a screen update
+
+UPDATE_HEADER = struct.Struct('!HHHBx')  # screen width, screen height, rect count, flags
+RECT_HEADER = struct.Struct('!HHHHI')  # x, y, w, h, JPEG length
+UPDATE_FULL = 0x01  # the update covers the whole screen, a receiver may (re)start from it
+
+
+class ScreenEncoder:
+    """
+    sender side: turn BGR screen captures into screen updates containing only the dirty tiles
+    """
+
+    def __init__(self, tile_size=SCREEN_TILE_SIZE, refresh_interval=SCREEN_REFRESH_INTERVAL,
+                 full_ratio=SCREEN_FULL_RATIO, quality=SCREEN_QUALITY):
+        self.tile_size = tile_size
+        self.refresh_interval = refresh_interval
+        self.full_ratio = full_ratio
+        self.quality = quality
+        self.shape = None  # (height, width) of the screen
+        self.grid = None  # (tile rows, tile cols)
+        self.current = None  # padded to whole tiles, the padding stays zero
+        self.previous = None
+        self.last_refresh = None
+        self.tiles_sent = 0
+        self.bytes_sent = 0
+
+    def reset(self, shape):
+        height, width = shape
+        t = self.tile_size
+        self.shape = shape
+        self.grid = (-(-height // t), -(-width // t))
+        padded = (self.grid[0] * t, self.grid[1] * t, 3)
+        self.current = np.zeros(padded, dtype=np.uint8)
+        self.previous = np.zeros(padded, dtype=np.uint8)
+        self.last_refresh = None
+
+    def dirty_tiles(self):
+        """
+        :return: np.ndarray[bool] of shape (tile rows, tile cols), True where the tile differs from the last capture
+        """
+        rows, cols = self.grid
+        t = self.tile_size
+        current = self.current.reshape(rows, t, cols, t * 3)
+        previous = self.previous.reshape(rows, t, cols, t * 3)
+        if t * 3 % 8 == 0:
+            # compare 8 bytes at a time
+            current, previous = current.view(np.uint64), previous.view(np.uint64)
+        return np.not_equal(current, previous).any(axis=(1, 3))
+
+    def rects(self, dirty):
+        """merge horizontal runs of dirty tiles into (x, y, w, h) rects, clipped to the screen"""
+        height, width = self.shape
+        t = self.tile_size
+        rects = []
+        for row in np.flatnonzero(dirty.any(axis=1)):
+            line = np.concatenate(([False], dirty[row], [False]))
+            edges = np.flatnonzero(line[1:] != line[:-1])
+            y = row * t
+            h = min(t, height - y)
+            for start, end in zip(edges[::2], edges[1::2]):
+                x = start * t
+                rects.append((x, y, min(end * t, width) - x, h))
+        return rects
+
+    def encode(self, frame, now=None):
+        """
+        :param frame: np.ndarray, HxWx3 BGR screen capture
+        :return: bytes screen update, or None if nothing changed
+        """
+        now = time.monotonic() if now is None else now
+        height, width = frame.shape[:2]
+        if self.shape != (height, width):
+            self.reset((height, width))
+        self.current, self.previous = self.previous, self.current
+        self.current[:height, :width] = frame
+
+        full = self.last_refresh is None or now - self.last_refresh >= self.refresh_interval
+        if not full:
+            dirty = self.dirty_tiles()
+            count = np.count_nonzero(dirty)
+            if count == 0:
+                return None
+            full = count > self.full_ratio * dirty.size
+        if full:
+            # 整屏作为一张图编码，比逐块编码更省
+            self.last_refresh = now
+            rects = [(0, 0, width, height)]
+            self.tiles_sent += self.grid[0] * self.grid[1]
+        else:
+            rects = self.rects(dirty)
+            self.tiles_sent += count
+
+        parts = [UPDATE_HEADER.pack(width, height, len(rects), UPDATE_FULL if full else 0)]
+        for x, y, w, h in rects:
+            jpeg = encode_frame(frame[y:y + h, x:x + w], self.quality)
+            parts.append(RECT_HEADER.pack(x, y, w, h, len(jpeg)))
+            parts.append(jpeg)
+        update = b''.join(parts)
+        self.bytes_sent += len(update)
+        return update
+
+    def packets(self, frame, stream, timestamp=None):
+        """
+        :param stream: rtp.MediaStream of type STREAM_SCREEN and payload type TILE_PAYLOAD_TYPE
+        :return: list[bytes] media packets of the update, empty if the screen did not change
+        """
+        update = self.encode(frame)
+        if update is None:
+            return []
+        timestamp = video_timestamp() if timestamp is None else timestamp
+        return packetize_jpeg(update, stream, timestamp, self.shape[1], self.shape[0], self.quality)
+
+
+class ScreenCanvas:
+    """
+    receiver side: a persistent canvas per sender, patched by screen updates
+    """
+
+    def __init__(self):
+        self.canvas = None  # np.ndarray HxWx3 BGR, None until the first full update arrived
+        self.updates = 0
+        self.skipped = 0  # partial updates received before a full one
+
+    def apply(self, update):
+        """
+        :param update: bytes-like, one reassembled screen update
+        :return: np.ndarray, the patched canvas (reused by later updates), or None if there is nothing to show yet
+        """
+        view = memoryview(update)
+        width, height, count, flags = UPDATE_HEADER.unpack_from(view)
+        if self.canvas is None or self.canvas.shape[:2] != (height, width):
+            if not flags & UPDATE_FULL:
+                self.skipped += 1
+                return None
+            self.canvas = np.zeros((height, width, 3), dtype=np.uint8)
+        offset = UPDATE_HEADER.size
+        for _ in range(count):
+            x, y, w, h, length = RECT_HEADER.unpack_from(view, offset)
+            offset += RECT_HEADER.size
+            jpeg = np.frombuffer(view[offset:offset + length], dtype=np.uint8)
+            offset += length
+            tile = cv2.imdecode(jpeg, cv2.IMREAD_COLOR)
+            if tile is not None and tile.shape[:2] == (h, w):
+                self.canvas[y:y + h, x:x + w] = tile
+        self.updates += 1
+        return self.canvas
+
+
+class ScreenReceiver:
+    """reassemble screen update packets of all senders and keep one ScreenCanvas per SSRC"""
+
+    def __init__(self):
+        self.assembler = FrameAssembler()
+        self.canvases = {}  # self.canvases[ssrc] = ScreenCanvas
+
+    def push(self, packet):
+        """
+        :return: (ssrc, canvas) when the packet completed an update that could be applied, otherwise None
+        """
+        result = self.assembler.push(packet)
+        if result is None:
+            return None
+        ssrc, _, update = result
+        canvas = self.canvases.setdefault(ssrc, ScreenCanvas()).apply(update)
+        return None if canvas is None else (ssrc, canvas)
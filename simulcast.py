@@ -0,0 +1,77 @@
+'''
+Simulcast camera layers
+A sender publishes the same frame at full, 1/2 and 1/4 resolution, every layer is a MediaStream with the same SSRC
+and its own layer ID in the media header. A subscriber tells the relay which layer it wants per publisher with a
+CONTROL_LAYER message, and the relay forwards only that layer to it (see udp_relay.MediaRelay)
+'''
+import cv2
+
+from config import *
+from fec import FecEncoder
+from rtp import (CONTROL_LAYER, LAYER_REQUEST, STREAM_CAMERA, STREAM_CONTROL, MediaStream, packetize_jpeg,
+                 video_timestamp)
+from util import encode_frame
+
+
+class SimulcastEncoder:
+    """
+    encode one camera frame into all simulcast layers
+    """
+
+    def __init__(self, payload_type, conference_id=0, ssrc=None, layers=SIMULCAST_LAYERS, quality=50,
+                 stream_type=STREAM_CAMERA, fec_group=0):
+        """
+        :param layers: tuple[int], downscale factor of each layer; (1,) publishes a single full-resolution stream
+        :param fec_group: int, packets per XOR parity packet on every layer (fec.py), 0 for no FEC
+        """
+        self.layers = layers
+        self.quality = quality
+        first = MediaStream(stream_type, payload_type, conference_id, ssrc)
+        self.ssrc = first.ssrc
+        self.streams = [first] + [MediaStream(stream_type, payload_type, conference_id, self.ssrc, layer)
+                                  for layer in range(1, len(layers))]
+        self.fec = [FecEncoder(stream, fec_group) for stream in self.streams]
+
+    def packets(self, frame, timestamp=None):
+        """
+        :param frame: np.ndarray, HxWx3 BGR frame
+        :return: list[bytes] packets of all layers (with their parity packets), all layers of a frame share its
+                 timestamp
+        """
+        timestamp = video_timestamp() if timestamp is None else timestamp
+        height, width = frame.shape[:2]
+        packets = []
+        for factor, stream, fec in zip(self.layers, self.streams, self.fec):
+            if factor == 1:
+                scaled = frame
+            else:
+                # 每层从原图缩小，INTER_AREA不会有锯齿
+                scaled = cv2.resize(frame, (width // factor, height // factor), interpolation=cv2.INTER_AREA)
+            jpeg_data = encode_frame(scaled, self.quality)
+            for packet in packetize_jpeg(jpeg_data, stream, timestamp, scaled.shape[1], scaled.shape[0],
+                                         self.quality):
+                packets.extend(fec.protect(packet))
+        return packets
+
+
+def choose_layer(tile_width, tile_height, frame_width, frame_height, layers=SIMULCAST_LAYERS):
+    """
+    :return: int, the smallest layer that still covers a tile of tile_width x tile_height
+    """
+    chosen = 0
+    for layer, factor in enumerate(layers):
+        if frame_width // factor >= tile_width and frame_height // factor >= tile_height:
+            chosen = layer
+    return chosen
+
+
+def layer_request(stream, publisher_ssrc, layer):
+    """
+    :param stream: MediaStream of type STREAM_CONTROL and payload type CONTROL_LAYER, carrying the subscriber's SSRC
+    :return: bytes, the message to send to the relay
+    """
+    return stream.packet(LAYER_REQUEST.pack(publisher_ssrc, layer), 0)
+
+
+def control_stream(conference_id, ssrc):
+    return MediaStream(STREAM_CONTROL, CONTROL_LAYER, conference_id, ssrc)
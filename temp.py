@@ -7,6 +7,9 @@ import tkinter as tk
 from io import BytesIO
 import numpy as np
 
+from render import VideoRenderer
+from util import FrameDecoderPool, encode_frame
+
 
 class VideoConferenceClient:
     def __init__(self, server_ip, server_port, root):
@@ -55,6 +58,12 @@ class VideoConferenceClient:
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.sock.connect((self.server_ip, self.server_port))
         self.is_running = True
+        self.recv_buffer = bytearray(1 << 20)  # 接收缓冲区，帧更大时才重新分配
+
+        # 网络线程只收数据，解码放到线程池，界面只在Tk主线程里用after()定时刷新最新的一帧
+        self.decoder = FrameDecoderPool()
+        self.renderer = VideoRenderer(self.root, self.decoder.frames, lambda key: self.remote_video_label)
+        self.renderer.start()
 
         # 启动接收视频的线程
         self.receive_thread = threading.Thread(target=self.receive_and_display, daemon=True)
@@ -78,24 +87,19 @@ class VideoConferenceClient:
             if self.cap:
                 self.cap.release()
                 self.cap = None
-            self.local_video_label.config(image='')  # 清空显示的画面
+            self.renderer.clear(self.local_video_label)  # 清空显示的画面
 
     def update_video(self):
         """不断从摄像头捕获视频帧并更新到 UI 界面"""
         if self.is_camera_on and self.cap:
             ret, frame = self.cap.read()
             if ret:
-                # 转换为RGB格式并显示在UI
+                # 转换为RGB格式并显示在UI，复用同一个PhotoImage
                 frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-                image = Image.fromarray(frame_rgb).convert('RGB')
-                image_tk = ImageTk.PhotoImage(image)
-                self.local_video_label.config(image=image_tk)
-                self.local_video_label.image = image_tk  # 保持对图片的引用
+                self.renderer.show(self.local_video_label, Image.fromarray(frame_rgb))
 
-                # 压缩图像为JPEG格式
-                buffer = BytesIO()
-                image.save(buffer, format="JPEG")
-                jpeg_data = buffer.getvalue()
+                # 直接把BGR帧压缩为JPEG格式，不经过PIL
+                jpeg_data = encode_frame(frame, 75)  # 和之前PIL默认的质量一样
 
                 # 发送视频帧到服务器
                 self.send_video(jpeg_data)
@@ -130,32 +134,31 @@ class VideoConferenceClient:
                     self.is_running = False
                     break
 
-                # 解压JPEG数据
-                buffer = BytesIO(frame_data)
-                img = Image.open(buffer)
-                imgtk = ImageTk.PhotoImage(image=img)
-
-                # 更新远程视频显示
-                self.remote_video_label.config(image=imgtk)
-                self.remote_video_label.image = imgtk  # 保持对图片的引用
+                # 交给解码线程，recvall的缓冲区会被复用所以要复制一份；来不及显示的旧帧会被直接丢掉
+                self.decoder.submit('remote', bytes(frame_data))
         except Exception as e:
             print(f"[错误] 接收和显示线程出错: {e}")
             self.is_running = False
 
     def recvall(self, n):
-        """接收n个字节的数据"""
-        data = bytearray()
-        while len(data) < n:
-            packet = self.sock.recv(n - len(data))
-            if not packet:
+        """接收n个字节的数据，直接 recv_into 到复用的缓冲区，返回的 memoryview 在下一次调用前有效"""
+        if len(self.recv_buffer) < n:
+            self.recv_buffer = bytearray(n)
+        view = memoryview(self.recv_buffer)[:n]
+        received = 0
+        while received < n:
+            count = self.sock.recv_into(view[received:])
+            if not count:
                 return None
-            data.extend(packet)
-        return data
+            received += count
+        return view
 
     def on_closing(self):
         """关闭客户端时释放资源"""
         print("[关闭] 关闭客户端。")
         self.is_running = False
+        self.renderer.stop()
+        self.decoder.shutdown()
         if self.cap:
             self.cap.release()
         self.sock.shutdown(socket.SHUT_RDWR)
@@ -0,0 +1,25 @@
+import warnings
+
+import numpy as np
+import pytest
+
+from audio_codec import PAYLOAD_PCMA, PAYLOAD_PCMU, decode, encode
+
+with warnings.catch_warnings():
+    warnings.simplefilter('ignore', DeprecationWarning)
+    audioop = pytest.importorskip('audioop')  # reference G.711 implementation, gone from the stdlib since 3.13
+
+ALL_SAMPLES = np.arange(-32768, 32768, dtype=np.int16)
+ALL_CODES = bytes(range(256))
+G711 = [(PAYLOAD_PCMU, 'lin2ulaw', 'ulaw2lin'), (PAYLOAD_PCMA, 'lin2alaw', 'alaw2lin')]
+
+
+@pytest.mark.parametrize('payload_type, lin2law, law2lin', G711)
+def test_g711_encodes_every_sample_like_audioop(payload_type, lin2law, law2lin):
+    assert encode(ALL_SAMPLES, payload_type) == getattr(audioop, lin2law)(ALL_SAMPLES.tobytes(), 2)
+
+
+@pytest.mark.parametrize('payload_type, lin2law, law2lin', G711)
+def test_g711_decodes_every_code_like_audioop(payload_type, lin2law, law2lin):
+    assert decode(ALL_CODES, payload_type).tobytes() == getattr(audioop, law2lin)(ALL_CODES, 2)
+
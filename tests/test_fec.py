@@ -0,0 +1,58 @@
+import pytest
+
+from fec import FecDecoder, FecEncoder
+from rtp import FLAG_DTX, FLAG_FEC, STREAM_AUDIO, MediaStream
+
+GROUP = 4
+PAYLOADS = [b'a' * 10, b'bb' * 12, b'c', b'd' * 17]  # different lengths, the parity covers the longest
+
+
+def protected_group(first_seq=1000):
+    stream = MediaStream(STREAM_AUDIO, 0, conference_id=7, ssrc=42)
+    stream.sequence_number = first_seq
+    encoder = FecEncoder(stream, GROUP)
+    packets = []
+    for i, payload in enumerate(PAYLOADS):
+        # 最后一个包是静音描述，标志位和时间戳也要能恢复
+        packets += encoder.protect(stream.packet(payload, 160 * i, FLAG_DTX if i == GROUP - 1 else 0))
+    *media, parity = packets
+    assert len(media) == GROUP and parity[1] & FLAG_FEC
+    return media, parity
+
+
+@pytest.mark.parametrize('first_seq', [1000, 65534])
+@pytest.mark.parametrize('lost', range(GROUP))
+def test_every_single_loss_of_a_group_is_recovered(first_seq, lost):
+    media, parity = protected_group(first_seq)
+    decoder = FecDecoder()
+    for i, packet in enumerate(media):
+        if i != lost:
+            assert decoder.push(packet) == []
+    assert decoder.push(parity) == [media[lost]]
+    assert decoder.recovered == 1
+
+
+@pytest.mark.parametrize('lost', range(GROUP))
+def test_parity_before_the_media_is_kept_until_it_can_recover(lost):
+    media, parity = protected_group()
+    decoder = FecDecoder()
+    assert decoder.push(parity) == []
+    recovered = []
+    for i, packet in enumerate(media):
+        if i != lost:
+            recovered += decoder.push(packet)
+    assert recovered == [media[lost]]
+
+
+def test_nothing_is_recovered_without_a_loss_or_with_two():
+    media, parity = protected_group()
+    decoder = FecDecoder()
+    for packet in media:
+        decoder.push(packet)
+    assert decoder.push(parity) == []
+
+    decoder = FecDecoder()
+    for packet in media[2:]:
+        decoder.push(packet)
+    assert decoder.push(parity) == []
+    assert decoder.recovered == 0
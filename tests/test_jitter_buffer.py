@@ -0,0 +1,85 @@
+import numpy as np
+
+from config import CONCEAL_FADE
+from jitter_buffer import JitterBuffer, JitterMixer
+
+FRAME = 4  # samples per frame
+RATE = 8000
+
+
+def frame(value):
+    return np.full(FRAME, value, dtype=np.int16).tobytes()
+
+
+def push(buffer, seq, value, timestamp=None):
+    timestamp = seq * FRAME if timestamp is None else timestamp
+    buffer.push(seq & 0xFFFF, timestamp & 0xFFFFFFFF, frame(value), arrival=timestamp / RATE)
+
+
+def pop(buffer):
+    out = np.zeros(FRAME, dtype=np.int16)
+    buffer.pop_into(out)
+    return int(out[0])
+
+
+def test_reordered_frames_play_in_sequence_order():
+    buffer = JitterBuffer(FRAME, clock_rate=RATE)
+    for seq in (0, 2, 1):
+        push(buffer, seq, 100 + seq)
+    assert [pop(buffer) for _ in range(3)] == [100, 101, 102]
+    assert buffer.lost == 0 and buffer.late == 0
+
+
+def test_lost_frame_is_concealed_with_the_last_one_faded():
+    buffer = JitterBuffer(FRAME, clock_rate=RATE)
+    played = []
+    for seq, value in ((0, 1000), (1, 2000), (3, 4000)):
+        push(buffer, seq, value)
+        played.append(pop(buffer))
+    played.append(pop(buffer))
+    assert played == [1000, 2000, int(2000 * CONCEAL_FADE), 4000]
+    assert buffer.lost == 1
+
+
+def test_frame_after_its_playout_time_counts_as_late():
+    buffer = JitterBuffer(FRAME, clock_rate=RATE)
+    push(buffer, 0, 1)
+    push(buffer, 2, 3)
+    assert pop(buffer) == 1
+    assert pop(buffer) != 2  # 1 is concealed
+    push(buffer, 1, 2)
+    assert buffer.late == 1
+    assert pop(buffer) == 3
+
+
+def test_sequence_numbers_wrap_around():
+    buffer = JitterBuffer(FRAME, clock_rate=RATE)
+    played = []
+    for seq in range(65533, 65540):
+        push(buffer, seq, seq - 65500)
+        played.append(pop(buffer))
+    assert played == list(range(33, 40))
+    assert buffer.lost == 0 and buffer.late == 0 and buffer.skipped == 0
+
+
+def test_mixer_sums_senders_and_clips():
+    mixer = JitterMixer(FRAME, clock_rate=RATE)
+    push(mixer.buffer(1, arrival=0.0), 0, 30000)
+    push(mixer.buffer(2, arrival=0.0), 0, 1000)
+    push(mixer.buffer(3, arrival=0.0), 0, 5000)
+    out = np.zeros((FRAME, 1), dtype=np.int16)
+    mixer.pop_into(out, now=0.0)
+    assert (out == 32767).all()
+
+
+def test_mixer_keeps_senders_apart_and_drops_idle_ones():
+    mixer = JitterMixer(FRAME, clock_rate=RATE, idle_timeout=5)
+    # 两个发送者的序列号完全不同，共用一个缓冲区的话会互相当成迟到或跳跃
+    push(mixer.buffer(1, arrival=0.0), 10, 100)
+    push(mixer.buffer(2, arrival=0.0), 40000, 10)
+    out = np.zeros(FRAME, dtype=np.int16)
+    mixer.pop_into(out, now=0.0)
+    assert out[0] == 110
+    mixer.buffer(1, arrival=4.0)
+    mixer.pop_into(out, now=6.0)
+    assert list(mixer.buffers) == [1]
@@ -0,0 +1,49 @@
+from nack import NackGenerator, PacketHistory, nack_items, parse_nack
+from rtp import FLAG_RTX, STREAM_CAMERA, MediaStream, parse_header
+
+REORDER = 0.01
+JPEG_PAYLOAD_TYPE = 26
+
+
+def sent_packets(first_seq, count):
+    stream = MediaStream(STREAM_CAMERA, JPEG_PAYLOAD_TYPE, conference_id=7, ssrc=42)
+    stream.sequence_number = first_seq
+    return [stream.packet(bytes(10), 0) for _ in range(count)]
+
+
+def test_gap_across_the_sequence_number_wrap_is_nacked():
+    packets = sent_packets(65533, 5)  # 65533, 65534, 65535, 0, 1
+    generator = NackGenerator(7, 1, reorder_delay=REORDER)
+    for packet in packets[:2] + packets[4:]:
+        generator.on_packet(parse_header(packet), now=0.0)
+    assert generator.poll(now=0.0) == []  # 可能只是乱序，先等一下
+    nacks = generator.poll(now=REORDER)
+    assert len(nacks) == 1
+    publisher, stream_type, layer, sequence_numbers = parse_nack(nacks[0])
+    assert (publisher, stream_type, layer) == (42, STREAM_CAMERA, 0)
+    assert sorted(sequence_numbers) == [0, 65535]
+
+
+def test_old_packet_after_the_wrap_fills_the_gap_instead_of_opening_one():
+    packets = sent_packets(65534, 4)  # 65534, 65535, 0, 1
+    generator = NackGenerator(7, 1, reorder_delay=REORDER)
+    for packet in (packets[0], packets[2], packets[3], packets[1]):
+        generator.on_packet(parse_header(packet), now=0.0)
+    assert generator.poll(now=REORDER) == []
+
+
+def test_nack_items_pack_the_wrap_into_one_bitmask():
+    assert nack_items([65534, 65535, 0, 3]) == [(65534, 0b10011)]
+
+
+def test_history_answers_a_nack_across_the_wrap():
+    packets = sent_packets(65534, 4)
+    history = PacketHistory()
+    for packet in packets:
+        history.put_packet(packet, now=0.0)
+    generator = NackGenerator(7, 1, reorder_delay=REORDER)
+    for packet in (packets[0], packets[3]):
+        generator.on_packet(parse_header(packet), now=0.0)
+    resent = history.answer(generator.poll(now=REORDER)[0], now=REORDER)
+    assert [parse_header(packet).sequence_number for packet in resent] == [65535, 0]
+    assert all(packet[1] & FLAG_RTX for packet in resent)
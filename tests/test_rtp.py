@@ -0,0 +1,51 @@
+from rtp import STREAM_CAMERA, FrameAssembler, MediaStream, packetize_jpeg
+
+TIMEOUT = 0.5
+JPEG_PAYLOAD_TYPE = 26
+SSRC = 1
+JPEG = bytes(range(256)) * 10
+
+
+def frame_packets(timestamp):
+    return packetize_jpeg(JPEG, MediaStream(STREAM_CAMERA, JPEG_PAYLOAD_TYPE, ssrc=SSRC), timestamp, max_payload=1000)
+
+
+def test_frame_completes_from_reordered_packets():
+    assembler = FrameAssembler(TIMEOUT)
+    packets = frame_packets(100)
+    results = [assembler.push(packet, now=0.0) for packet in reversed(packets)]
+    assert results[:-1] == [None] * (len(packets) - 1)
+    assert results[-1] == (SSRC, 100, JPEG)
+
+
+def test_partial_frame_is_discarded_after_the_timeout():
+    assembler = FrameAssembler(TIMEOUT)
+    old, new = frame_packets(100), frame_packets(200)
+    for packet in old[:-1]:
+        assert assembler.push(packet, now=0.0) is None
+    # 新的一帧到来时检查超时，超时的残缺帧被丢掉
+    assert assembler.push(new[0], now=TIMEOUT + 0.1) is None
+    assert assembler.discarded == 1
+    # 迟到的最后一个包凑不出已经丢掉的帧
+    assert assembler.push(old[-1], now=TIMEOUT + 0.2) is None
+
+
+def test_partial_frame_is_kept_within_the_timeout():
+    assembler = FrameAssembler(TIMEOUT)
+    old, new = frame_packets(100), frame_packets(200)
+    for packet in old[:-1]:
+        assembler.push(packet, now=0.0)
+    assembler.push(new[0], now=TIMEOUT - 0.1)
+    assert assembler.discarded == 0
+    assert assembler.push(old[-1], now=TIMEOUT - 0.1) == (SSRC, 100, JPEG)
+
+
+def test_newer_complete_frame_drops_older_partial_frames():
+    assembler = FrameAssembler(TIMEOUT)
+    old, new = frame_packets(100), frame_packets(200)
+    assembler.push(old[0], now=0.0)
+    for packet in new:
+        result = assembler.push(packet, now=0.1)
+    assert result == (SSRC, 200, JPEG)
+    assert assembler.discarded == 1
+    assert all(assembler.push(packet, now=0.1) is None for packet in old[1:])
@@ -0,0 +1,460 @@
+'''
+asyncio UDP relay (SFU) for the media paths
+Packets are routed by the conference ID and participant SSRC in the media header instead of a global set of
+addresses, and all sends produced in one event-loop iteration are flushed together.
+For simulcast publishers every subscriber only gets the layer it asked for (layer 0 until it asks), receiver
+feedback is forwarded only to the publisher it is about.
+The relay keeps RFC 3550 reception statistics of every stream it receives and the last RTCP report of every
+participant, see MediaRelay.stats()
+In audio mixing mode (MCU audio) the relay decodes the audio of a conference instead of forwarding it and sends
+every participant one N-1 mix per tick on its own stream (SSRC MIXER_SSRC), encoded like that participant's uplink.
+Video packets are kept in a PacketHistory ring so the relay answers NACKs (nack.py) itself, only packets it never
+received are asked from the publisher, once per retry interval however many subscribers miss them.
+Audio senders in DTX (vad.py) send CONTROL_KEEPALIVE messages instead of silence, they only keep the participant
+from expiring, so silent participants cost no fan-out at all.
+Traffic per participant, fan-out latency and send errors are exported to a metrics.MetricsRegistry
+'''
+import asyncio
+import socket
+import time
+
+import audio_codec
+from audio_mixer import AudioMixer
+from config import *
+from fec import FecDecoder
+from metrics import MetricsRegistry, RateLimitedLog
+from nack import PacketHistory, nack_packet, parse_nack, retransmission
+from rtcp import ReceptionStats, block_dict, parse_report
+from rtp import (CONTROL_FEEDBACK, CONTROL_LAYER, CONTROL_NACK, FLAG_DTX, FLAG_FEC, FLAG_RTX, JPEG_HEADER,
+                 LAYER_REQUEST, MEDIA_HEADER, STREAM_AUDIO, STREAM_CAMERA, STREAM_CONTROL, STREAM_RTCP, STREAM_SCREEN,
+                 VIDEO_CLOCK_RATE, MediaStream, routing_fields)
+from vad import MAX_NOISE_LEVEL
+
+
+class _ConferenceMix:
+    """audio mixing state of one conference: the mixer, its tick timer and one outgoing stream per participant"""
+
+    def __init__(self, conference_id, frame_len, audio_rate, now):
+        self.conference_id = conference_id
+        self.mixer = AudioMixer(frame_len)
+        self.period = frame_len / audio_rate
+        self.next_tick = now
+        self.handle = None
+        self.timestamp = 0
+        self.payload_types = {}  # self.payload_types[participant_id] = payload type of its uplink
+        self.payload_type = None  # of the latest audio packet, for participants that send no audio
+        self.noise_levels = {}  # self.noise_levels[participant_id] = comfort noise level of its last SID
+        self.talking = False  # whether the last tick produced a mix
+        self.streams = {}  # self.streams[participant_id] = MediaStream of its mix
+
+    def stream(self, participant_id):
+        payload_type = self.payload_types.get(participant_id, self.payload_type)
+        stream = self.streams.get(participant_id)
+        if stream is None:
+            stream = self.streams[participant_id] = MediaStream(STREAM_AUDIO, payload_type, self.conference_id,
+                                                                MIXER_SSRC)
+        stream.payload_type = payload_type
+        return stream
+
+    def noise_level(self, participant_id):
+        """comfort noise level of a participant's mix: the loudest background of the others"""
+        return min((level for other, level in self.noise_levels.items() if other != participant_id),
+                   default=MAX_NOISE_LEVEL)
+
+    def remove(self, participant_id):
+        self.mixer.remove(participant_id)
+        self.payload_types.pop(participant_id, None)
+        self.noise_levels.pop(participant_id, None)
+        self.streams.pop(participant_id, None)
+
+
+class MediaRelay(asyncio.DatagramProtocol):
+    def __init__(self, recv_port=None, echo=False, timeout=PARTICIPANT_TIMEOUT, collect_stats=True, mix_audio=False,
+                 audio_rate=RATE, nack_cache=True, metrics=None, name='relay'):
+        """
+        :param recv_port: int, send to this port of the sender's host instead of back to its source port
+                          (Client1 receives on a separate socket)
+        :param echo: bool, also send a packet back to its own sender (handy for 1-client loopback tests)
+        :param timeout: float, seconds of silence before a participant is forgotten
+        :param collect_stats: bool, keep per-stream reception statistics (a few microseconds per packet)
+        :param mix_audio: bool, mix the (mono) audio streams of a conference and send every participant one N-1 mix
+                          instead of forwarding all of them; with echo the mix includes the participant itself
+        :param audio_rate: int, sample rate of the audio streams, one mixing tick lasts one frame of it
+        :param nack_cache: bool, keep recent video packets to answer NACKs (about a microsecond per packet),
+                           otherwise NACKs are forwarded to the publisher
+        :param metrics: metrics.MetricsRegistry to export the counters to, relays sharing one need different names
+        """
+        self.recv_port = recv_port
+        self.echo = echo
+        self.timeout = timeout
+        self.transport = None
+        self.loop = None
+        self.conferences = {}  # self.conferences[conference_id][participant_id] = return address
+        self.last_seen = {}  # self.last_seen[(conference_id, participant_id)] = loop time
+        self.targets = {}  # self.targets[conference_id] = distinct return addresses, rebuilt on membership changes
+        self.layers = {}  # self.layers[(conference_id, publisher)] = set of simulcast layers the publisher sends
+        self.requested = {}  # self.requested[(conference_id, publisher)][address] = layer asked for by the subscriber
+        self.routes = {}  # self.routes[(conference_id, publisher)][address] = layer forwarded now, simulcast only
+        self.switches = {}  # self.switches[(conference_id, publisher)][address] = layer to switch to at next frame
+        self.collect_stats = collect_stats
+        self.stream_stats = {}  # self.stream_stats[(conference_id, ssrc, stream_type, layer)] = ReceptionStats
+        self.reports = {}  # self.reports[(conference_id, reporter ssrc)] = (time.time(), sender infos, report blocks)
+        self.mix_audio = mix_audio
+        self.audio_rate = audio_rate
+        self.mixes = {}  # self.mixes[conference_id] = _ConferenceMix
+        self.fec = FecDecoder() if mix_audio else None  # the mixer consumes the audio, so FEC ends here
+        self.history = PacketHistory() if nack_cache else None
+        self.nack_stream = MediaStream(STREAM_CONTROL, CONTROL_NACK, 0, MIXER_SSRC)  # NACKs the relay sends itself
+        self.nack_requests = {}  # self.nack_requests[(conference_id, publisher, stream_type, layer, seq)] = loop time
+        self.pending = []  # (data, address) to send at the end of this loop iteration
+        self.flush_handle = None
+        self.expire_task = None
+        self.packets_in = 0
+        self.packets_out = 0
+        # self.traffic[(conference_id, participant_id)] = [packets in, bytes in, packets forwarded, bytes forwarded]
+        self.traffic = {}
+        self.send_errors = 0
+        self.batch_start = 0.0  # loop time of the oldest packet waiting in self.pending
+        self.log_limited = RateLimitedLog()
+        self.name = name
+        self.metrics = metrics or MetricsRegistry()
+        self.fanout_latency = self.metrics.histogram('relay_fanout_latency_seconds',
+                                                     'time from receiving a packet until its batch is sent',
+                                                     ('relay',)).labels(name)
+        self.metric_callbacks = []
+        for index, (metric, help_text) in enumerate([
+                ('relay_packets_received_total', 'packets received from a participant'),
+                ('relay_bytes_received_total', 'bytes received from a participant'),
+                ('relay_packets_forwarded_total', 'packets of a participant sent to the others'),
+                ('relay_bytes_forwarded_total', 'bytes of a participant sent to the others')]):
+            self.add_metric(metric, 'counter', help_text, ('relay', 'conference', 'participant'),
+                            lambda index=index: [((self.name, conference_id, participant_id), counters[index])
+                                                 for (conference_id, participant_id), counters in self.traffic.items()])
+        self.add_metric('relay_participants', 'gauge', 'participants per conference', ('relay', 'conference'),
+                        lambda: [((self.name, conference_id), len(members))
+                                 for conference_id, members in self.conferences.items()])
+        self.add_metric('relay_send_errors_total', 'counter', 'ICMP errors reported for sent packets', ('relay',),
+                        lambda: [((self.name,), self.send_errors)])
+
+    def add_metric(self, metric, kind, help_text, labelnames, collect):
+        self.metrics.callback(metric, kind, help_text, labelnames, collect)
+        self.metric_callbacks.append(collect)
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.loop = asyncio.get_running_loop()
+        self.expire_task = self.loop.create_task(self.expire())
+
+    def connection_lost(self, exc):
+        if self.expire_task is not None:
+            self.expire_task.cancel()
+        for mix in self.mixes.values():
+            if mix.handle is not None:
+                mix.handle.cancel()
+        self.mixes.clear()
+        self.metrics.remove_callbacks(self.metric_callbacks)
+
+    def error_received(self, exc):
+        # ICMP port unreachable etc., the participant will expire on its own
+        self.send_errors += 1
+        self.log_limited('error', f'[{self.name}] send error: {exc}')
+
+    def route_key(self, data, addr):
+        """
+        :return: (conference_id, participant_id) read from the fixed-offset media header,
+                 packets without a header share one conference and are identified by their source address
+        """
+        fields = routing_fields(data)
+        if fields is None:
+            return None, addr
+        return fields[1], fields[2]
+
+    def return_address(self, addr):
+        return (addr[0], self.recv_port) if self.recv_port else addr
+
+    def join(self, conference_id, participant_id, address):
+        members = self.conferences.setdefault(conference_id, {})
+        members[participant_id] = address
+        self.targets[conference_id] = tuple(set(members.values()))
+
+    def leave(self, conference_id, participant_id):
+        self.last_seen.pop((conference_id, participant_id), None)
+        self.traffic.pop((conference_id, participant_id), None)
+        for table in (self.layers, self.requested, self.routes, self.switches, self.reports):
+            table.pop((conference_id, participant_id), None)
+        for key in [k for k in self.stream_stats if k[:2] == (conference_id, participant_id)]:
+            del self.stream_stats[key]
+        if self.history is not None:
+            for key in [k for k in self.history.rings if k[:2] == (conference_id, participant_id)]:
+                del self.history.rings[key]
+        mix = self.mixes.get(conference_id)
+        if mix is not None:
+            mix.remove(participant_id)
+        members = self.conferences.get(conference_id)
+        if members is None:
+            return
+        members.pop(participant_id, None)
+        if members:
+            self.targets[conference_id] = tuple(set(members.values()))
+        else:
+            del self.conferences[conference_id]
+            del self.targets[conference_id]
+            if mix is not None:
+                mix.handle.cancel()
+                del self.mixes[conference_id]
+
+    def effective_layer(self, key, target):
+        """the requested layer if the publisher sends it, otherwise the closest higher-resolution one"""
+        layers = self.layers[key]
+        wanted = self.requested.get(key, {}).get(target, 0)
+        return max((layer for layer in layers if layer <= wanted), default=min(layers))
+
+    def update_routes(self, key):
+        """schedule layer switches, they take effect on the first packet of the next frame of the new layer"""
+        routes = self.routes.setdefault(key, {})
+        switches = self.switches.setdefault(key, {})
+        for target in self.targets.get(key[0], ()):
+            layer = self.effective_layer(key, target)
+            if target not in routes:
+                routes[target] = layer
+            if routes[target] != layer:
+                switches[target] = layer
+            else:
+                switches.pop(target, None)
+
+    def handle_control(self, data, conference_id, participant_id, source):
+        if data[2] == CONTROL_LAYER and len(data) >= MEDIA_HEADER.size + LAYER_REQUEST.size:
+            publisher, layer = LAYER_REQUEST.unpack_from(data, MEDIA_HEADER.size)
+            key = (conference_id, publisher)
+            self.requested.setdefault(key, {})[source] = layer
+            if key in self.layers:
+                self.update_routes(key)
+        elif data[2] == CONTROL_NACK and self.history is not None:
+            self.answer_nack(data, conference_id, source)
+        elif data[2] in (CONTROL_FEEDBACK, CONTROL_NACK) and len(data) >= MEDIA_HEADER.size + 4:
+            # 接收端的反馈只转给被反馈的那个发送者
+            publisher = int.from_bytes(data[MEDIA_HEADER.size:MEDIA_HEADER.size + 4], 'big')
+            target = self.conferences[conference_id].get(publisher)
+            if target is not None:
+                self.pending.append((data, target))
+
+    def answer_nack(self, data, conference_id, source):
+        nack = parse_nack(data)
+        if nack is None:
+            return
+        publisher, stream_type, layer, sequence_numbers = nack
+        now = self.loop.time()
+        key = (conference_id, publisher, stream_type, layer)
+        found, missing = self.history.lookup(key, sequence_numbers, now)
+        for packet in found:
+            self.pending.append((retransmission(packet), source))
+        # 缓存里没有的是上行就丢了，找发送者要；很多订阅者同时要同一个包时只要一次
+        requests = self.nack_requests
+        missing = [seq for seq in missing if key + (seq,) not in requests or
+                   now - requests[key + (seq,)] >= NACK_RETRY_INTERVAL]
+        target = self.conferences[conference_id].get(publisher)
+        if missing and target is not None:
+            for seq in missing:
+                requests[key + (seq,)] = now
+            self.nack_stream.conference_id = conference_id
+            self.pending.append((nack_packet(self.nack_stream, publisher, stream_type, layer, missing), target))
+
+    def forward_layer(self, data, key, layer, source):
+        """
+        :return: the targets of one packet of a simulcast publisher
+        """
+        layers = self.layers.get(key)
+        if layers is None or layer not in layers:
+            self.layers[key] = {0, layer} if layers is None else layers | {layer}
+            self.update_routes(key)
+        routes = self.routes[key]
+        switches = self.switches[key]
+        if switches and layer in switches.values() and not data[1] & (FLAG_FEC | FLAG_RTX) and \
+                len(data) >= MEDIA_HEADER.size + JPEG_HEADER.size and \
+                JPEG_HEADER.unpack_from(data, MEDIA_HEADER.size)[0] & 0xFFFFFF == 0:
+            # 新一帧的第一个包，在这里切换不会让订阅者收到半帧
+            for target in [t for t, new_layer in switches.items() if new_layer == layer]:
+                routes[target] = layer
+                del switches[target]
+        targets = []
+        for target in self.targets[key[0]]:
+            if (target != source or self.echo) and routes.get(target) == layer:
+                targets.append(target)
+            elif target not in routes:
+                routes[target] = self.effective_layer(key, target)  # joined after the last update
+        return targets
+
+    def datagram_received(self, data, addr):
+        self.packets_in += 1
+        conference_id, participant_id = self.route_key(data, addr)
+        source = self.return_address(addr)
+        members = self.conferences.get(conference_id)
+        if members is None or members.get(participant_id) != source:
+            self.join(conference_id, participant_id, source)
+        now = self.last_seen[(conference_id, participant_id)] = self.loop.time()
+        traffic = self.traffic.get((conference_id, participant_id))
+        if traffic is None:
+            traffic = self.traffic[(conference_id, participant_id)] = [0, 0, 0, 0]
+        traffic[0] += 1
+        traffic[1] += len(data)
+
+        if self.collect_stats and conference_id is not None:
+            self.account(data, conference_id, participant_id)
+        if self.history is not None and conference_id is not None and \
+                data[0] & 0x0F in (STREAM_CAMERA, STREAM_SCREEN) and not data[1] & FLAG_FEC:
+            self.history.put((conference_id, participant_id, data[0] & 0x0F, data[3]),
+                             int.from_bytes(data[12:14], 'big'), data, now)
+        pending = self.pending
+        if not pending:
+            self.batch_start = now
+        queued = len(pending)
+        key = (conference_id, participant_id)
+        if conference_id is not None and data[0] & 0x0F == STREAM_CONTROL:
+            self.handle_control(data, conference_id, participant_id, source)
+        elif conference_id is not None and data[0] & 0x0F == STREAM_CAMERA and (data[3] or key in self.layers):
+            for target in self.forward_layer(data, key, data[3], source):
+                pending.append((data, target))
+        elif self.mix_audio and conference_id is not None and data[0] & 0x0F == STREAM_AUDIO:
+            for packet in self.fec.push(data):
+                self.mix_in(packet, conference_id, participant_id)  # 用校验包恢复出来的帧
+            if not data[1] & FLAG_FEC:
+                self.mix_in(data, conference_id, participant_id)
+        else:
+            for target in self.targets[conference_id]:
+                if target != source or self.echo:
+                    pending.append((data, target))
+        forwarded = len(pending) - queued
+        if forwarded:
+            traffic[2] += forwarded
+            traffic[3] += forwarded * len(data)
+        if self.flush_handle is None and pending:
+            self.flush_handle = self.loop.call_soon(self.flush)
+
+    def mix_in(self, data, conference_id, participant_id):
+        """decode one audio packet into the mixer of its conference"""
+        if data[1] & FLAG_DTX:
+            mix = self.mixes.get(conference_id)
+            if mix is not None and len(data) > MEDIA_HEADER.size:
+                mix.noise_levels[participant_id] = data[MEDIA_HEADER.size]
+            return  # 静音描述不进混音，这个人的队列空了自然就不再被混进去
+        payload_type = data[2]
+        try:
+            pcm = audio_codec.decode(memoryview(data)[MEDIA_HEADER.size:], payload_type)
+        except Exception:
+            return  # 解不了的包不混，也不转发
+        mix = self.mixes.get(conference_id)
+        if mix is None:
+            if not len(pcm):
+                return
+            mix = self.mixes[conference_id] = _ConferenceMix(conference_id, len(pcm), self.audio_rate,
+                                                             self.loop.time())
+            mix.handle = self.loop.call_at(mix.next_tick, self.mix_tick, conference_id)
+        mix.payload_types[participant_id] = mix.payload_type = payload_type
+        mix.mixer.push(participant_id, pcm)
+
+    def mix_tick(self, conference_id):
+        """timer: mix one frame of every participant of a conference and queue one packet per participant"""
+        mix = self.mixes[conference_id]
+        mix.next_tick += mix.period
+        now = self.loop.time()
+        if mix.next_tick < now - mix.period:
+            mix.next_tick = now  # 事件循环被卡住太久，不补落下的拍子
+        if not self.pending:
+            self.batch_start = now
+        mix.handle = self.loop.call_at(mix.next_tick, self.mix_tick, conference_id)
+        mix.timestamp = (mix.timestamp + mix.mixer.frame_len) & 0xFFFFFFFF
+        members = self.conferences[conference_id]
+        mixes = mix.mixer.mix(members, include_own=self.echo)
+        if not mixes:
+            if mix.talking:
+                # 所有人都不说话了：每人一个静音描述，客户端开始放舒适噪声
+                mix.talking = False
+                for participant_id, target in members.items():
+                    stream = mix.stream(participant_id)
+                    level = mix.noise_level(participant_id)
+                    self.pending.append((stream.packet(bytes([level]), mix.timestamp, FLAG_DTX), target))
+                if self.flush_handle is None:
+                    self.flush_handle = self.loop.call_soon(self.flush)
+            return
+        mix.talking = True
+        encoded = {}  # 没说话的人拿到的是同一个混音，同一种编码只编一次
+        for participant_id, pcm in mixes.items():
+            stream = mix.stream(participant_id)
+            payload = encoded.get((id(pcm), stream.payload_type))
+            if payload is None:
+                payload = encoded[(id(pcm), stream.payload_type)] = audio_codec.encode(pcm, stream.payload_type)
+            self.pending.append((stream.packet(payload, mix.timestamp), members[participant_id]))
+        if self.flush_handle is None:
+            self.flush_handle = self.loop.call_soon(self.flush)
+
+    def account(self, data, conference_id, participant_id):
+        stream_type = data[0] & 0x0F
+        if stream_type == STREAM_RTCP:
+            report = parse_report(data)
+            if report is not None:
+                self.reports[(conference_id, participant_id)] = (time.time(),) + report
+            return
+        if stream_type == STREAM_CONTROL or data[1] & FLAG_FEC:
+            return  # 校验包有自己的序列号，不算进媒体流的统计
+        _, _, _, layer, _, _, sequence_number, timestamp = MEDIA_HEADER.unpack_from(data)
+        key = (conference_id, participant_id, stream_type, layer)
+        stats = self.stream_stats.get(key)
+        if stats is None:
+            # 音频时间戳按发送端的采样率走，和混音用同一个 audio_rate，不用全局的 44.1kHz 表
+            clock_rate = self.audio_rate if stream_type == STREAM_AUDIO else VIDEO_CLOCK_RATE
+            stats = self.stream_stats[key] = ReceptionStats(sequence_number, clock_rate)
+        stats.update(sequence_number, timestamp, self.loop.time())
+
+    def stats(self):
+        """
+        :return: dict, stats[conference_id] = {'streams': {(ssrc, stream_type, layer): reception statistics at the
+                 relay (the uplink of that sender), fraction_lost since the last call},
+                 'reports': {reporter ssrc: {'time': ..., 'senders': [...],
+                 'blocks': {(ssrc, stream_type, layer): report block of that receiver (its downlink)}}}}
+        """
+        result = {}
+        for (conference_id, ssrc, stream_type, layer), stats in self.stream_stats.items():
+            conference = result.setdefault(conference_id, {'streams': {}, 'reports': {}})
+            stats.interval_loss()
+            conference['streams'][(ssrc, stream_type, layer)] = stats.as_dict()
+        for (conference_id, reporter), (received_at, infos, blocks) in self.reports.items():
+            conference = result.setdefault(conference_id, {'streams': {}, 'reports': {}})
+            conference['reports'][reporter] = {
+                'time': received_at,
+                'senders': [{'stream_type': info[0], 'layer': info[1], 'packets': info[4], 'octets': info[5]}
+                            for info in infos],
+                'blocks': {tuple(block[:3]): block_dict(block) for block in blocks},
+            }
+        return result
+
+    def flush(self):
+        self.flush_handle = None
+        sendto = self.transport.sendto
+        for data, target in self.pending:
+            sendto(data, target)
+        self.packets_out += len(self.pending)
+        self.pending.clear()
+        self.fanout_latency.observe(self.loop.time() - self.batch_start)
+
+    async def expire(self):
+        while True:
+            await asyncio.sleep(self.timeout / 2)
+            deadline = self.loop.time() - self.timeout
+            for conference_id, participant_id in [k for k, seen in self.last_seen.items() if seen < deadline]:
+                self.leave(conference_id, participant_id)
+            stale = self.loop.time() - NACK_DEADLINE
+            for key in [k for k, asked in self.nack_requests.items() if asked < stale]:
+                del self.nack_requests[key]
+
+
+async def start_relay(server_ip, server_port, **kwargs):
+    """
+    :return: (transport, MediaRelay)
+    """
+    loop = asyncio.get_running_loop()
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    # 大一点的内核缓冲区，避免突发流量在事件循环来不及读时被丢掉
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, UDP_SOCKET_BUFFER)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, UDP_SOCKET_BUFFER)
+    sock.bind((server_ip, server_port))
+    return await loop.create_datagram_endpoint(lambda: MediaRelay(**kwargs), sock=sock)
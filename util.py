@@ -2,31 +2,114 @@
 Simple util implementation for video conference
 Including data capture, image compression and image overlap
 Note that you can use your own implementation as well :)
+Capture devices are opened lazily by `devices`, importing this module never touches audio/video hardware
 '''
+import threading
 from io import BytesIO
-import pyaudio
+from concurrent.futures import ThreadPoolExecutor
 import cv2
-import pyautogui
 import numpy as np
-from PIL import Image, ImageGrab
+from PIL import Image
 from config import *
 
-# audio setting
-FORMAT = pyaudio.paInt16
-audio = pyaudio.PyAudio()
-streamin = audio.open(format=FORMAT, channels=CHANNELS, rate=RATE, input=True, frames_per_buffer=CHUNK)
-streamout = audio.open(format=FORMAT, channels=CHANNELS, rate=RATE, output=True, frames_per_buffer=CHUNK)
+# optional: libjpeg-turbo bindings are faster than cv2.imencode if installed
+try:
+    from turbojpeg import TJPF_RGB, TurboJPEG
+    turbo_jpeg = TurboJPEG()
+except (ImportError, OSError, RuntimeError):
+    turbo_jpeg = None
+
+class DeviceManager:
+    """
+    open capture/playback devices on first use and release them when the stream is switched off,
+    pyaudio and pyautogui are only imported when a device is actually needed
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.audio = None  # pyaudio.PyAudio
+        self.format = None
+        self.streamin = None
+        self.streamout = None
+        self.cap = None
+        self.can_capture_camera = None  # unknown until the camera is opened once
+        self.my_screen_size = None
+
+    def _audio(self):
+        if self.audio is None:
+            import pyaudio
+            self.audio = pyaudio.PyAudio()
+            self.format = pyaudio.paInt16
+        return self.audio
+
+    def input_stream(self):
+        with self.lock:
+            if self.streamin is None:
+                self.streamin = self._audio().open(format=self.format, channels=CHANNELS, rate=RATE, input=True,
+                                                   frames_per_buffer=CHUNK)
+            return self.streamin
+
+    def output_stream(self):
+        with self.lock:
+            if self.streamout is None:
+                self.streamout = self._audio().open(format=self.format, channels=CHANNELS, rate=RATE, output=True,
+                                                    frames_per_buffer=CHUNK)
+            return self.streamout
+
+    def camera(self):
+        with self.lock:
+            if self.cap is None:
+                cap = cv2.VideoCapture(0)
+                self.can_capture_camera = cap.isOpened()
+                if not self.can_capture_camera:
+                    cap.release()
+                    raise Exception('Fail to open camera')
+                cap.set(cv2.CAP_PROP_FRAME_WIDTH, camera_width)
+                cap.set(cv2.CAP_PROP_FRAME_HEIGHT, camera_height)
+                self.cap = cap
+            return self.cap
+
+    def screen_size(self):
+        if self.my_screen_size is None:
+            import pyautogui
+            self.my_screen_size = pyautogui.size()
+        return self.my_screen_size
+
+    def release(self, device):
+        """
+        :param device: str, 'camera', 'audio_in', 'audio_out' or 'all'
+        """
+        with self.lock:
+            if device in ('camera', 'all') and self.cap is not None:
+                self.cap.release()
+                self.cap = None
+            if device in ('audio_in', 'all') and self.streamin is not None:
+                self.streamin.stop_stream()
+                self.streamin.close()
+                self.streamin = None
+            if device in ('audio_out', 'all') and self.streamout is not None:
+                self.streamout.stop_stream()
+                self.streamout.close()
+                self.streamout = None
+            if device == 'all' and self.audio is not None:
+                self.audio.terminate()
+                self.audio = None
 
-# print warning if no available camera
-cap = cv2.VideoCapture(0)
-if cap.isOpened():
-    can_capture_camera = True
-    cap.set(cv2.CAP_PROP_FRAME_WIDTH, camera_width)
-    cap.set(cv2.CAP_PROP_FRAME_HEIGHT, camera_height)
-else:
-    can_capture_camera = False
 
-my_screen_size = pyautogui.size()
+devices = DeviceManager()
+
+
+def __getattr__(name):
+    # old module-level names, resolved (and the device opened) only when someone asks for them
+    if name == 'my_screen_size':
+        return devices.screen_size()
+    if name == 'can_capture_camera':
+        try:
+            devices.camera()
+        except Exception:
+            pass
+        return devices.can_capture_camera
+    raise AttributeError(f"module 'util' has no attribute '{name}'")
 
 
 def resize_image_to_fit_screen(image, my_screen_size):
@@ -51,83 +134,172 @@ def resize_image_to_fit_screen(image, my_screen_size):
     return resized_image
 
 
+class GalleryCompositor:
+    """
+    compose the shared screen and the camera tiles into one preallocated numpy canvas:
+    the layout is cached per (participant count, screen size), tiles are resized with cv2.INTER_AREA straight into
+    their slice of the canvas, and a tile is only redrawn when its source frame changed (a new array object)
+    """
+
+    def __init__(self, screen_size=None):
+        self.screen_size = screen_size  # (width, height), the display size when None
+        self.canvas = None
+        self.layouts = {}  # self.layouts[key] = (screen rect, [camera rects]), rect = (x, y, w, h)
+        self.layout_key = None
+        self.drawn = {}  # self.drawn[tile] = source frame currently drawn in that tile ('screen' or camera index)
+
+    def get_layout(self, key):
+        layout = self.layouts.get(key)
+        if layout is None:
+            layout = self.layouts[key] = self.compute_layout(*key)
+        return layout
+
+    @staticmethod
+    def fit(x, y, w, h, src_w, src_h):
+        """largest rect with the aspect ratio of src_w x src_h inside (x, y, w, h), centered"""
+        scale = min(w / src_w, h / src_h)
+        fit_w, fit_h = max(1, int(src_w * scale)), max(1, int(src_h * scale))
+        return x + (w - fit_w) // 2, y + (h - fit_h) // 2, fit_w, fit_h
+
+    def compute_layout(self, count, width, height, screen_shape, camera_shape):
+        screen_rect = None
+        if screen_shape is not None:
+            screen_rect = self.fit(0, 0, width, height, screen_shape[1], screen_shape[0])
+        if count == 0:
+            return screen_rect, []
+        cam_h, cam_w = camera_shape[:2]
+        if screen_rect is not None:
+            # 有共享屏幕时摄像头画面排成一行放在上面
+            tile_w = min(cam_w, width // count)
+            tile_h = max(1, tile_w * cam_h // cam_w)
+            return screen_rect, [(i * tile_w, 0, tile_w, tile_h) for i in range(count)]
+        # 没有共享屏幕时铺满整个画布的网格
+        cols = int(np.ceil(np.sqrt(count)))
+        rows = (count + cols - 1) // cols
+        cell_w, cell_h = width // cols, height // rows
+        return None, [self.fit((i % cols) * cell_w, (i // cols) * cell_h, cell_w, cell_h, cam_w, cam_h)
+                      for i in range(count)]
+
+    def draw(self, tile, frame, rect):
+        x, y, w, h = rect
+        target = self.canvas[y:y + h, x:x + w]
+        if frame.shape[0] == h and frame.shape[1] == w:
+            target[...] = frame
+        else:
+            # INTER_AREA for strong downscaling (no aliasing), INTER_LINEAR is ~8x cheaper and looks the same above 1/2
+            interpolation = cv2.INTER_AREA if w * 2 <= frame.shape[1] else cv2.INTER_LINEAR
+            cv2.resize(frame, (w, h), dst=target, interpolation=interpolation)
+        self.drawn[tile] = frame
+
+    def compose(self, screen_frame=None, camera_frames=()):
+        """
+        :param screen_frame: np.ndarray HxWx3 or None
+        :param camera_frames: list[np.ndarray], HxWx3 frames; passing the same object again means unchanged
+        :return: np.ndarray, the canvas (reused by the next call, copy it if you need to keep it)
+        """
+        width, height = self.screen_size or devices.screen_size()
+        key = (len(camera_frames), width, height,
+               None if screen_frame is None else screen_frame.shape[:2],
+               camera_frames[0].shape[:2] if camera_frames else None)
+        screen_rect, camera_rects = self.get_layout(key)
+        if key != self.layout_key:
+            if self.canvas is None or self.canvas.shape[:2] != (height, width):
+                self.canvas = np.zeros((height, width, 3), dtype=np.uint8)
+            else:
+                self.canvas.fill(0)
+            self.layout_key = key
+            self.drawn.clear()
+
+        redraw_all = False
+        if screen_frame is not None and self.drawn.get('screen') is not screen_frame:
+            self.draw('screen', screen_frame, screen_rect)
+            redraw_all = camera_rects != []  # the screen was painted over the camera strip
+        for i, (frame, rect) in enumerate(zip(camera_frames, camera_rects)):
+            if redraw_all or self.drawn.get(i) is not frame:
+                self.draw(i, frame, rect)
+        return self.canvas
+
+
+compositor = GalleryCompositor()
+converted = {}  # converted[tile] = (PIL.Image, np.ndarray) from the last call, so an unchanged image keeps its array
+
+
+def image_to_frame(tile, image):
+    """
+    :return: np.ndarray, the RGB array of image, the same object as last time if image is the same object
+    """
+    cached = converted.get(tile)
+    if cached is not None and cached[0] is image:
+        return cached[1]
+    frame = np.asarray(image.convert('RGB'))
+    converted[tile] = (image, frame)
+    return frame
+
+
 def overlay_camera_images(screen_image, camera_images):  # 把多个摄像头获取的画面放到屏幕上面去
     """
     screen_image: PIL.Image
-    camera_images: list[PIL.Image]
+    camera_images: list[PIL.Image], passing the same image object again lets the compositor skip its tile
     """
     if screen_image is None and camera_images is None:
         print('[Warn]: cannot display when screen and camera are both None')
         return None
-    if screen_image is not None:
-        screen_image = resize_image_to_fit_screen(screen_image, my_screen_size)
-
-    if camera_images is not None:
-        # make sure same camera images
-        if not all(img.size == camera_images[0].size for img in camera_images):
-            raise ValueError("All camera images must have the same size")
-
-        screen_width, screen_height = my_screen_size if screen_image is None else screen_image.size
-        camera_width, camera_height = camera_images[0].size
-
-        # calculate num_cameras_per_row
-        num_cameras_per_row = screen_width // camera_width
-
-        # adjust camera_imgs
-        if len(camera_images) > num_cameras_per_row:
-            adjusted_camera_width = screen_width // len(camera_images)
-            adjusted_camera_height = (adjusted_camera_width * camera_height) // camera_width
-            camera_images = [img.resize((adjusted_camera_width, adjusted_camera_height), Image.LANCZOS) for img in
-                             camera_images]
-            camera_width, camera_height = adjusted_camera_width, adjusted_camera_height
-            num_cameras_per_row = len(camera_images)
-
-        # if no screen_img, create a container
-        if screen_image is None:
-            display_image = Image.fromarray(np.zeros((camera_width, my_screen_size[1], 3), dtype=np.uint8))
-        else:
-            display_image = screen_image
-        # cover screen_img using camera_images
-        for i, camera_image in enumerate(camera_images):
-            row = i // num_cameras_per_row
-            col = i % num_cameras_per_row
-            x = col * camera_width
-            y = row * camera_height
-            display_image.paste(camera_image, (x, y))
-
-        return display_image
-    else:
-        return screen_image
+    screen_frame = None if screen_image is None else image_to_frame('screen', screen_image)
+    camera_images = camera_images or ()
+    camera_frames = [image_to_frame(i, img) for i, img in enumerate(camera_images)]
+    for tile in [tile for tile in converted if tile != 'screen' and tile >= len(camera_images)]:
+        del converted[tile]  # 离开的摄像头不再占用内存
+    return Image.fromarray(compositor.compose(screen_frame, camera_frames))
 
 
 def capture_screen():
     # capture screen with the resolution of display
     # img = pyautogui.screenshot()
+    from PIL import ImageGrab
     img = ImageGrab.grab()
     return img
 
 
+def capture_screen_frame():
+    """
+    :return: np.ndarray, HxWx3 BGR frame of the screen, ready for encode_frame
+    """
+    return cv2.cvtColor(np.asarray(capture_screen().convert('RGB')), cv2.COLOR_RGB2BGR)
+
+
 def capture_camera():
     # capture frame of camera
-    ret, frame = cap.read()
+    ret, frame = devices.camera().read()
     if not ret:
         raise Exception('Fail to capture frame from camera')
     return Image.fromarray(frame)
 
 
+def capture_camera_frame():
+    """
+    :return: np.ndarray, HxWx3 BGR frame of the camera, ready for encode_frame
+    """
+    ret, frame = devices.camera().read()
+    if not ret:
+        raise Exception('Fail to capture frame from camera')
+    return frame
+
+
 def capture_voice():
-    return streamin.read(CHUNK)
+    return devices.input_stream().read(CHUNK)
 
 
 def compress_image(image, format='JPEG', quality=85):
     """
     compress image and output Bytes
 
-    :param image: PIL.Image, input image
+    :param image: PIL.Image or np.ndarray (BGR frame from cv2), input image
     :param format: str, output format ('JPEG', 'PNG', 'WEBP', ...)
     :param quality: int, compress quality (0-100), 85 default
     :return: bytes, compressed image data
     """
+    if isinstance(image, np.ndarray) and format == 'JPEG':
+        return encode_frame(image, quality).tobytes()
     img_byte_arr = BytesIO()
     image.save(img_byte_arr, format=format, quality=quality)
     img_byte_arr = img_byte_arr.getvalue()
@@ -135,6 +307,137 @@ def compress_image(image, format='JPEG', quality=85):
     return img_byte_arr
 
 
+def encode_frame(frame, quality=85):
+    """
+    encode a numpy BGR frame straight to JPEG, without the BGR->RGB, PIL.Image and BytesIO copies
+
+    :param frame: np.ndarray, HxWx3 BGR frame as returned by cv2
+    :param quality: int, compress quality (0-100)
+    :return: memoryview, encoded JPEG (backed by the encoder's own output buffer, no extra copy)
+    """
+    if turbo_jpeg is not None:
+        return memoryview(turbo_jpeg.encode(frame, quality=quality))
+    ok, encoded = cv2.imencode('.jpg', frame, [int(cv2.IMWRITE_JPEG_QUALITY), quality])
+    if not ok:
+        raise Exception('Fail to encode frame')
+    return memoryview(encoded.reshape(-1))
+
+
+class FrameEncoderPool:
+    """
+    encode frames of several streams (e.g. screen and camera) in parallel,
+    cv2.imencode and TurboJPEG release the GIL so threads are enough
+    """
+
+    def __init__(self, workers=ENCODER_THREADS):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='jpeg-encoder')
+
+    def submit(self, frame, quality=85):
+        """
+        :return: concurrent.futures.Future of the encode_frame result
+        """
+        return self.executor.submit(encode_frame, frame, quality)
+
+    def encode_all(self, frames, quality=85):
+        """
+        :return: list[memoryview], encoded frames in the same order
+        """
+        return list(self.executor.map(encode_frame, frames, [quality] * len(frames)))
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+
+def decode_frame(jpeg_data):
+    """
+    decode JPEG straight to an RGB PIL.Image ready for ImageTk, the decoders release the GIL
+
+    :param jpeg_data: bytes-like, encoded JPEG
+    :return: PIL.Image, or None if the data can not be decoded
+    """
+    if turbo_jpeg is not None:
+        try:
+            return Image.fromarray(turbo_jpeg.decode(bytes(jpeg_data), pixel_format=TJPF_RGB))
+        except (OSError, ValueError):
+            return None
+    frame = cv2.imdecode(np.frombuffer(jpeg_data, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if frame is None:
+        return None
+    return Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+
+
+class LatestFrameMailbox:
+    """
+    one slot per participant holding only its newest item, a new item replaces one that was not taken yet,
+    so a slow consumer skips stale frames instead of queueing them
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.slots = {}
+        self.dropped = 0
+
+    def put(self, key, item):
+        with self.lock:
+            if key in self.slots:
+                self.dropped += 1
+            self.slots[key] = item
+
+    def take(self, key):
+        """:return: the newest item of key, None if there is nothing new"""
+        with self.lock:
+            return self.slots.pop(key, None)
+
+    def take_all(self):
+        """:return: dict key -> newest item, for every key that has something new"""
+        with self.lock:
+            slots, self.slots = self.slots, {}
+        return slots
+
+
+class FrameDecoderPool:
+    """
+    decode received JPEG frames off the network thread, at most one decode per participant at a time;
+    a frame that arrives while the previous one of the same participant is still waiting is decoded instead of it.
+    decoded PIL images end up in `frames` (a LatestFrameMailbox) for the render loop
+    """
+
+    def __init__(self, workers=DECODER_THREADS):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='jpeg-decoder')
+        self.pending = LatestFrameMailbox()  # encoded frames not picked up by a worker yet
+        self.frames = LatestFrameMailbox()
+        self.busy = set()  # participants with a decode task scheduled
+        self.lock = threading.Lock()
+        self.failed = 0
+
+    def submit(self, key, jpeg_data):
+        """
+        :param jpeg_data: bytes, must not be reused by the caller afterwards
+        """
+        self.pending.put(key, jpeg_data)
+        with self.lock:
+            if key in self.busy:
+                return
+            self.busy.add(key)
+        self.executor.submit(self._decode, key)
+
+    def _decode(self, key):
+        while True:
+            with self.lock:
+                jpeg_data = self.pending.take(key)
+                if jpeg_data is None:
+                    self.busy.discard(key)
+                    return
+            image = decode_frame(jpeg_data)
+            if image is None:
+                self.failed += 1
+            else:
+                self.frames.put(key, image)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+
 def decompress_image(image_bytes):
     """
     decompress bytes to PIL.Image
@@ -0,0 +1,140 @@
+'''
+Voice activity detection and discontinuous transmission (DTX) for the audio send path
+The detector compares the frame energy with a tracked background level and uses the zero-crossing rate to tell
+weak noise-like frames from speech, with a hangover so word endings and short pauses are not cut.
+During silence DtxSender sends one silence descriptor (FLAG_DTX, payload = comfort noise level in -dBov like
+RFC 3389) and then only CONTROL_KEEPALIVE messages, which the relay never fans out; a new descriptor goes out only
+when the background level changes. Receivers play comfort noise at the described level until speech resumes
+'''
+import math
+import time
+
+import numpy as np
+
+import audio_codec
+from audio_codec import as_pcm
+from config import *
+from rtp import CONTROL_KEEPALIVE, FLAG_DTX, STREAM_CONTROL, MediaStream
+
+MAX_NOISE_LEVEL = 127  # -dBov, "no noise"
+
+
+def comfort_noise(out, level, rng):
+    """
+    fill an int16 array with white noise at an RFC 3389 level
+
+    :param level: int, noise level in -dBov (0 = full scale, 127 = silence)
+    :param rng: np.random.Generator
+    """
+    if level >= MAX_NOISE_LEVEL:
+        out.fill(0)
+        return
+    rms = 32768 * 10 ** (-level / 20)
+    np.clip(rng.standard_normal(len(out), dtype=np.float32) * rms, -32768, 32767, out=out, casting='unsafe')
+
+
+class VoiceActivityDetector:
+    def __init__(self, sample_rate, channels=1, threshold=VAD_THRESHOLD, min_level=VAD_MIN_LEVEL,
+                 noise_zcr=VAD_NOISE_ZCR, hangover=VAD_HANGOVER, noise_rise=VAD_NOISE_RISE):
+        """
+        :param threshold: float, dB above the background level that count as speech
+        :param min_level: float, dBov below which a frame is always silence
+        :param hangover: float, seconds a speech decision is held
+        """
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.threshold = threshold
+        self.min_level = min_level
+        self.noise_zcr = noise_zcr
+        self.hangover = hangover
+        self.noise_rise = noise_rise
+        self.noise = None  # background level estimate, dBov
+        self.level = None  # level of the last frame, dBov
+        self.hold = 0.0  # seconds of hangover left
+        self.speech = False
+
+    def is_speech(self, pcm):
+        """
+        :param pcm: bytes-like or np.ndarray, one frame of interleaved 16-bit PCM
+        :return: bool, whether the frame should be sent as speech
+        """
+        samples = as_pcm(pcm)
+        if not len(samples):
+            return self.speech
+        x = samples.astype(np.float32)
+        energy = float(np.dot(x, x)) / len(x)
+        self.level = level = 10 * math.log10(energy / (32768.0 * 32768.0) + 1e-12)
+        # 过零率只看第一个声道，相邻样本符号变化的比例
+        mono = samples[::self.channels]
+        zcr = np.count_nonzero(np.signbit(mono[1:]) != np.signbit(mono[:-1])) / max(1, len(mono) - 1)
+        duration = len(samples) / self.channels / self.sample_rate
+
+        if self.noise is None:
+            self.noise = min(level, self.min_level + self.threshold)
+        active = level > self.min_level and level > self.noise + self.threshold
+        if active and zcr > self.noise_zcr and level < self.noise + 2 * self.threshold:
+            active = False  # 刚过阈值又像白噪声一样频繁过零，多半是背景噪声变大了
+        if level < self.noise:
+            self.noise += 0.5 * (level - self.noise)  # 背景噪声估计往下跟得快
+        else:
+            self.noise += min(level - self.noise, self.noise_rise * duration)  # 往上跟得慢，不会把说话当成噪声
+
+        if active:
+            self.hold = self.hangover
+        elif self.hold > 0:
+            self.hold -= duration
+            active = True
+        self.speech = active
+        return active
+
+    def noise_level(self):
+        """:return: int, the background level as an RFC 3389 comfort noise level (-dBov, 0-127)"""
+        if self.noise is None:
+            return MAX_NOISE_LEVEL
+        return max(0, min(MAX_NOISE_LEVEL, int(round(-self.noise))))
+
+
+class DtxSender:
+    """
+    what one captured audio frame turns into on the wire: an encoded frame during speech, a silence descriptor when
+    silence starts or its level changes, a keepalive every DTX_KEEPALIVE_INTERVAL, nothing otherwise
+    """
+
+    def __init__(self, stream, sample_rate, channels=1, vad=None, keepalive_interval=DTX_KEEPALIVE_INTERVAL,
+                 level_change=DTX_LEVEL_CHANGE):
+        """
+        :param stream: rtp.MediaStream, the audio stream (its payload type selects the codec)
+        """
+        self.stream = stream
+        self.channels = channels
+        self.vad = vad or VoiceActivityDetector(sample_rate, channels)
+        self.keepalive = MediaStream(STREAM_CONTROL, CONTROL_KEEPALIVE, stream.conference_id, stream.ssrc)
+        self.keepalive_interval = keepalive_interval
+        self.level_change = level_change
+        self.sid_level = None  # level of the last silence descriptor, None while talking
+        self.last_sent = 0.0
+        self.frames = 0
+        self.silent_frames = 0
+
+    def packet(self, pcm, timestamp, now=None):
+        """
+        :param pcm: bytes-like or np.ndarray, one captured frame
+        :param timestamp: int, its media timestamp (advances for silent frames too)
+        :return: bytes, the packet to send, or None
+        """
+        now = time.monotonic() if now is None else now
+        self.frames += 1
+        if self.vad.is_speech(pcm):
+            self.sid_level = None
+            self.last_sent = now
+            return self.stream.packet(audio_codec.encode(pcm, self.stream.payload_type, self.channels), timestamp)
+        self.silent_frames += 1
+        level = self.vad.noise_level()
+        if self.sid_level is None or abs(level - self.sid_level) >= self.level_change:
+            self.sid_level = level
+            self.last_sent = now
+            return self.stream.packet(bytes([level]), timestamp, FLAG_DTX)
+        if now - self.last_sent >= self.keepalive_interval:
+            self.last_sent = now
+            return self.keepalive.packet(b'', 0)
+        return None